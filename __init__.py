@@ -18,8 +18,8 @@ import os
     PSMS focus on being simple:
 
     - settings are in Python and most have sensible default
-    - transports are limited to the bare minium: a Gammu transport if you want
-      to set up your own modem, and a Kannel transport for bigger setup
+    - transports are limited to the bare minium: a modem transport if you want
+      to set up your own modem, and Kannel or SMPP transports for bigger setup
     - the smallest SMS application is a class with one method
 
     What PSMS is not:
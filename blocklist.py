@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    A set of phone numbers that can hold millions of them with a few bytes
+    per number, see pragmatic_sms.processors.blocklist.
+"""
+
+import os
+import re
+import math
+import mmap
+import heapq
+import struct
+
+from pragmatic_sms.phone import normalize, FORMATTING
+from pragmatic_sms.watchdog import uninterruptible
+
+
+MASK = 2 ** 64 - 1
+INT64 = struct.Struct('<q')
+BLOOM_HEADER = struct.Struct('<QI')
+
+# at most 18 digits after the kind digit, so the keys fit in 64 bits
+NUMBER = re.compile(r'^(\+?)(\d{1,18})$')
+
+
+def to_int(number):
+    """
+        Turn a phone number into an integer: its normalized form (see
+        pragmatic_sms.phone) prefixed by 2 if it's international, 1 if
+        it's a national number or a short code. So '+2231' and '2231'
+        are different numbers, and leading zeros are kept.
+
+        Return None if it's not a phone number, or if it has more than 18
+        digits and wouldn't fit in the array.
+    """
+    number = FORMATTING.sub('', normalize((number or '').strip()))
+    match = NUMBER.match(number)
+    if match is None:
+        return None
+    return int(('2' if match.group(1) else '1') + match.group(2))
+
+
+
+class BloomFilter(object):
+    """
+        Tell if an integer is maybe in a set or surely not in it, with
+        about 'error_rate' false positives once 'capacity' integers are
+        added, using 'bits' to store the set.
+    """
+
+    def __init__(self, capacity, error_rate=0.01, size=None, hashes=None,
+                 bits=None):
+        capacity = max(capacity, 1)
+        self.size = size or int(-capacity * math.log(error_rate) /
+                                math.log(2) ** 2) or 1
+        self.hashes = hashes or max(1, int(round(self.size * math.log(2) /
+                                                 capacity)))
+        self.bits = bits or bytearray((self.size + 7) // 8)
+
+
+    def positions(self, number):
+        # double hashing: k positions from two hashes of the number
+        h1 = (number * 0x9E3779B97F4A7C15) & MASK
+        h2 = (((number ^ (number >> 31)) * 0xBF58476D1CE4E5B9) & MASK) | 1
+        return [(h1 + i * h2) % self.size for i in xrange(self.hashes)]
+
+
+    def add(self, number):
+        bits = self.bits
+        for position in self.positions(number):
+            bits[position >> 3] |= 1 << (position & 7)
+
+
+    def __contains__(self, number):
+        bits = self.bits
+        for position in self.positions(number):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(BLOOM_HEADER.pack(self.size, self.hashes))
+            f.write(self.bits)
+
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            size, hashes = BLOOM_HEADER.unpack(f.read(BLOOM_HEADER.size))
+            bits = bytearray(f.read())
+        if len(bits) != (size + 7) // 8:
+            raise ValueError('Corrupted bloom filter: %s' % path)
+        return cls(0, size=size, hashes=hashes, bits=bits)
+
+
+
+class Blocklist(object):
+    """
+        Phone numbers stored as a sorted array of 64 bits integers, see
+        to_int(), in the file at 'path', which is memory mapped and binary
+        searched, with a Bloom filter in front of it so most numbers which
+        are not in the list are answered without touching the array.
+
+        Numbers added with add() are kept in a set and appended to a
+        journal file, then merged in the array once there are
+        'merge_threshold' of them.
+
+        A few million numbers take 8 bytes each in the array, shared with
+        the OS page cache, and about 10 bits each in the Bloom filter,
+        while a Python set of strings would take around 100 bytes per
+        number.
+    """
+
+    def __init__(self, path, merge_threshold=10000, error_rate=0.01):
+        self.path = path
+        self.bloom_path = path + '.bloom'
+        self.journal_path = path + '.journal'
+        self.merge_threshold = merge_threshold
+        self.error_rate = error_rate
+        self.map = None
+        self.count = 0
+        self.recent = set()
+        self.load()
+
+
+    def __len__(self):
+        return self.count + len(self.recent)
+
+
+    def load(self):
+        """
+            Map the array, load the Bloom filter and replay the journal.
+        """
+        self.close()
+
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.count = len(self.map) // INT64.size
+
+        try:
+            self.bloom = BloomFilter.load(self.bloom_path)
+        except (IOError, ValueError, struct.error):
+            self.bloom = BloomFilter(self.count + self.merge_threshold,
+                                     self.error_rate)
+            for number in self.numbers():
+                self.bloom.add(number)
+
+        self.recent = set()
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        self.recent.add(int(line))
+                        self.bloom.add(int(line))
+
+        self.journal = open(self.journal_path, 'a')
+
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if getattr(self, 'journal', None) is not None:
+            self.journal.close()
+            self.journal = None
+
+
+    def numbers(self):
+        """
+            Iterate on the numbers of the array, in order.
+        """
+        for i in xrange(self.count):
+            yield INT64.unpack_from(self.map, i * INT64.size)[0]
+
+
+    def search(self, number):
+        """
+            Binary search for this integer in the array.
+        """
+        low, high = 0, self.count
+        unpack, size, data = INT64.unpack_from, INT64.size, self.map
+        while low < high:
+            middle = (low + high) // 2
+            value = unpack(data, middle * size)[0]
+            if value < number:
+                low = middle + 1
+            elif value > number:
+                high = middle
+            else:
+                return True
+        return False
+
+
+    def __contains__(self, number):
+        number = to_int(number)
+        if number is None or number not in self.bloom:
+            return False
+        return number in self.recent or self.search(number)
+
+
+    def add(self, number):
+        """
+            Add this phone number to the list. Return False if it was
+            already in it.
+        """
+        if number in self:
+            return False
+        number = to_int(number)
+        if number is None:
+            return False
+        with uninterruptible():
+            self.recent.add(number)
+            self.bloom.add(number)
+            self.journal.write('%s\n' % number)
+            self.journal.flush()
+            if len(self.recent) >= self.merge_threshold:
+                self.merge()
+        return True
+
+
+    def extend(self, numbers):
+        """
+            Add all these phone numbers at once, with a single merge. Use it
+            to import an existing list.
+        """
+        for number in numbers:
+            number = to_int(number)
+            if number is not None:
+                self.recent.add(number)
+        self.merge()
+
+
+    def merge(self):
+        """
+            Write a new array with the numbers of the journal, and a new
+            Bloom filter, then empty the journal.
+
+            The new files are written next to the old ones then renamed,
+            the Bloom filter first, so readers always see complete files
+            and a filter with all the numbers of the array.
+        """
+        with uninterruptible():
+            self._merge()
+
+
+    def _merge(self):
+        count = 0
+        bloom = BloomFilter(len(self) + self.merge_threshold, self.error_rate)
+        previous = None
+        chunk = []
+        tmp_path = self.path + '.tmp'
+
+        with open(tmp_path, 'wb') as f:
+            for number in heapq.merge(self.numbers(), sorted(self.recent)):
+                if number == previous:
+                    continue
+                previous = number
+                chunk.append(number)
+                bloom.add(number)
+                count += 1
+                if len(chunk) == 10000:
+                    f.write(struct.pack('<%sq' % len(chunk), *chunk))
+                    chunk = []
+            f.write(struct.pack('<%sq' % len(chunk), *chunk))
+        bloom.save(self.bloom_path + '.tmp')
+
+        # the Bloom filter goes first: if the array is not renamed, it only
+        # has false positives, while an array with numbers the filter
+        # doesn't know would let them through
+        self.close()
+        os.rename(self.bloom_path + '.tmp', self.bloom_path)
+        os.rename(tmp_path, self.path)
+        open(self.journal_path, 'w').close()
+        self.load()
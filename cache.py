@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    A small in memory cache, bounded in size and with expiring entries.
+"""
+
+import time
+
+
+# indexes of the fields of a link in the list of entries
+PREVIOUS, NEXT, KEY, VALUE, EXPIRES = range(5)
+
+
+class LRUCache(object):
+    """
+        Keep at most 'max_size' entries, forgetting the least recently used
+        ones first. Entries expire after 'ttl' seconds if it's not None,
+        unless a ttl is given for this entry when it is set.
+
+        Entries are kept in a dict for the lookups and a circular doubly
+        linked list for the order of use, so getting and setting are
+        O(1). OrderedDict would do the same but doesn't exist in Python 2.6.
+
+        Expired entries are removed when they are looked up, or by
+        expire(). 'hits', 'misses' and 'evictions' count what happened
+        since the cache was created.
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = {}
+        self.root = root = []
+        root[:] = [root, root, None, None, None]
+        self.hits = self.misses = self.evictions = 0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __contains__(self, key):
+        link = self.entries.get(key)
+        return link is not None and (link[EXPIRES] is None or
+                                     link[EXPIRES] > time.time())
+
+
+    def unlink(self, link):
+        link[PREVIOUS][NEXT] = link[NEXT]
+        link[NEXT][PREVIOUS] = link[PREVIOUS]
+
+
+    def append(self, link):
+        """
+            Put this link at the most recently used end of the list.
+        """
+        last = self.root[PREVIOUS]
+        link[PREVIOUS], link[NEXT] = last, self.root
+        last[NEXT] = self.root[PREVIOUS] = link
+
+
+    def get(self, key, default=None, now=None):
+        """
+            Return the value of this key, or 'default' if it's not in the
+            cache or it expired.
+        """
+        link = self.entries.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+
+        expires = link[EXPIRES]
+        if expires is not None and expires <= (now or time.time()):
+            self.unlink(link)
+            del self.entries[key]
+            self.misses += 1
+            return default
+
+        self.unlink(link)
+        self.append(link)
+        self.hits += 1
+        return link[VALUE]
+
+
+    def set(self, key, value, ttl=None, now=None):
+        """
+            Add or replace the value of this key, which becomes the most
+            recently used one.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires = (now or time.time()) + ttl if ttl is not None else None
+
+        link = self.entries.get(key)
+        if link is not None:
+            self.unlink(link)
+            link[VALUE], link[EXPIRES] = value, expires
+        else:
+            link = self.entries[key] = [None, None, key, value, expires]
+            if len(self.entries) > self.max_size:
+                oldest = self.root[NEXT]
+                self.unlink(oldest)
+                del self.entries[oldest[KEY]]
+                self.evictions += 1
+        self.append(link)
+
+
+    def pop(self, key, default=None):
+        """
+            Remove this key from the cache and return its value, or 'default'
+            if it's not in the cache.
+        """
+        link = self.entries.pop(key, None)
+        if link is None:
+            return default
+        self.unlink(link)
+        return link[VALUE]
+
+
+    def expire(self, now=None):
+        """
+            Remove all the expired entries and return their number.
+        """
+        now = now or time.time()
+        expired = [key for key, link in self.entries.iteritems()
+                   if link[EXPIRES] is not None and link[EXPIRES] <= now]
+        for key in expired:
+            self.pop(key)
+        return len(expired)
+
+
+    def clear(self):
+        self.entries.clear()
+        self.root[:] = [self.root, self.root, None, None, None]
+
+
+    def keys(self):
+        """
+            Return the keys from the least to the most recently used one.
+        """
+        keys = []
+        link = self.root[NEXT]
+        while link is not self.root:
+            keys.append(link[KEY])
+            link = link[NEXT]
+        return keys
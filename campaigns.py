@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Send one message to each row of a CSV file, which can be too big to
+    fit in memory:
+
+        from pragmatic_sms.campaigns import Campaign
+
+        Campaign('customers.csv', u'Hello %(name)s, your code is %(code)s',
+                 rate=50).run()
+
+    The first row gives the names of the columns. The position in the file
+    of the next row to send is saved in a checkpoint file after each batch,
+    so running the campaign again after a crash starts from there. Or use
+    'manage.py send_campaign'.
+"""
+
+import os
+import csv
+import time
+
+from pragmatic_sms.conf import settings
+from pragmatic_sms.messages import OutgoingMessage
+from pragmatic_sms.templates import get_template
+
+
+class CampaignError(Exception):
+    pass
+
+
+
+class Campaign(object):
+    """
+        Read the rows of the CSV file at 'path' one by one and create an
+        OutgoingMessage for each of them, to the number of the
+        'number_column' column, with the 'template' text rendered with the
+        columns of the row (see pragmatic_sms.templates), or the 'text' 
+        column if there is no template.
+
+        Messages are published one by one, at most 'rate' messages per
+        second if set, and the campaign waits while more than
+        OUTGOING_MESSAGES_HIGH_WATERMARK messages are waiting for the
+        router.
+
+        The checkpoint, 'path'.checkpoint by default, holds the position of
+        the next row and the number of messages sent. It is saved after
+        each 'batch_size' messages. If the campaign stops in the middle of
+        a batch, the messages of this batch already published are sent
+        again, so keep batches small.
+    """
+
+    def __init__(self, path, template=None, transport='default', rate=None,
+                 batch_size=100, number_column='number', encoding='utf-8',
+                 checkpoint_path=None):
+        self.path = path
+        self.template = template and get_template(template)
+        self.transport = transport
+        self.rate = rate
+        self.batch_size = batch_size
+        self.number_column = number_column
+        self.encoding = encoding
+        self.checkpoint_path = checkpoint_path or path + '.checkpoint'
+        self.offset, self.sent = self.load_checkpoint()
+
+
+    def load_checkpoint(self):
+        """
+            Return the position of the next row to send and the number of
+            messages sent, (0, 0) if the campaign never started.
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return 0, 0
+        f = open(self.checkpoint_path)
+        try:
+            offset, sent = f.read().split()
+        finally:
+            f.close()
+        return int(offset), int(sent)
+
+
+    def save_checkpoint(self):
+        """
+            Write the checkpoint in a temporary file then rename it, so a
+            crash can't leave half of it.
+        """
+        tmp_path = self.checkpoint_path + '.tmp'
+        f = open(tmp_path, 'w')
+        try:
+            f.write('%s %s\n' % (self.offset, self.sent))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp_path, self.checkpoint_path)
+
+
+    def reset(self):
+        """
+            Forget the checkpoint so the campaign starts from the first row.
+        """
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        self.offset = self.sent = 0
+
+
+    def rows(self):
+        """
+            Yield the position of the next row and each row as a dict, from
+            the checkpoint.
+        """
+        f = open(self.path, 'rb')
+        try:
+            # don't iterate on the file: it reads ahead so tell() would be
+            # wrong. The csv reader only reads the lines of the current row,
+            # even with quoted line breaks.
+            lines = iter(f.readline, '')
+            reader = csv.reader(lines)
+            try:
+                columns = [c.decode(self.encoding) for c in reader.next()]
+            except StopIteration:
+                return
+            if self.offset > f.tell():
+                f.seek(self.offset)
+            for row in reader:
+                if row:
+                    values = [value.decode(self.encoding) for value in row]
+                    yield f.tell(), dict(zip(columns, values))
+        finally:
+            f.close()
+
+
+    def create_message(self, row):
+        try:
+            number = row[self.number_column]
+            if self.template:
+                text = self.template.render(row)
+            else:
+                text = row['text']
+        except KeyError, e:
+            raise CampaignError('Column %s missing from %s' % (e, self.path))
+        return OutgoingMessage(number, text, self.transport)
+
+
+    def messages(self):
+        """
+            Yield the position of the next row and the message for each row.
+        """
+        for offset, row in self.rows():
+            yield offset, self.create_message(row)
+
+
+    def dispatch(self, messages):
+        OutgoingMessage.worker.dispatch_outgoing_messages(messages)
+
+
+    def wait(self, started, sent):
+        """
+            Sleep until sending 'sent' messages since 'started' respects the
+            rate, and while the router is late.
+        """
+        if self.rate:
+            delay = started + float(sent) / self.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        watermark = settings.OUTGOING_MESSAGES_HIGH_WATERMARK
+        if watermark is not None:
+            worker = OutgoingMessage.worker
+            while worker.get_queue_size('outgoing_messages') > watermark:
+                time.sleep(1)
+
+
+    def run(self, limit=None):
+        """
+            Send the messages from the checkpoint to the end of the file, or
+            'limit' messages at most. Return the number of messages sent.
+        """
+        started = time.time()
+        count = 0
+        batch = []
+
+        for offset, message in self.messages():
+            batch.append(message)
+            if len(batch) >= self.batch_size or count + len(batch) == limit:
+                count += self.flush(batch, offset)
+                batch = []
+                if count == limit:
+                    break
+                self.wait(started, count)
+
+        if batch:
+            count += self.flush(batch, offset)
+
+        return count
+
+
+    def flush(self, batch, offset):
+        self.dispatch(batch)
+        self.offset = offset
+        self.sent += len(batch)
+        self.save_checkpoint()
+        return len(batch)
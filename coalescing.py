@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Merge the short outgoing messages sent to the same person within a few
+    seconds into one SMS, see OUTGOING_COALESCE_DELAY.
+"""
+
+import time
+
+from collections import deque
+
+from pragmatic_sms.encoding import analyze
+
+
+class PendingMessage(object):
+    """
+        An outgoing message body waiting to be relayed, with the ids of the
+        messages merged into it and the broker messages to acknowledge once
+        it is relayed.
+    """
+
+    def __init__(self, due, body, message):
+        self.due = due
+        self.body = body
+        self.merged_ids = []
+        self.messages = [message]
+
+
+
+class Coalescer(object):
+    """
+        Hold each outgoing message for 'delay' seconds, by transport and
+        recipient, and append the text of the next ones to it as long as
+        the whole text fits in 'max_segments' SMS.
+
+        At most 'max_pending' recipients have a message held: the oldest
+        one is released when there are more. 'merged' counts the messages
+        merged into another one.
+    """
+
+    def __init__(self, delay=5, max_segments=1, max_pending=10000,
+                 separator=u'\n'):
+        self.delay = delay
+        self.max_segments = max_segments
+        self.max_pending = max_pending
+        self.separator = separator
+        self.pending = {}
+        # (due, key) from the first to the last message to release
+        self.order = deque()
+        self.merged = 0
+
+
+    def __len__(self):
+        return len(self.pending)
+
+
+    def add(self, body, message, now=None):
+        """
+            Hold this outgoing message body or merge it into the one held
+            for the same recipient. Return the list of PendingMessage to
+            relay right away.
+        """
+        now = now or time.time()
+        ready = []
+        key = (body['transport'], body['recipient'])
+
+        pending = self.pending.get(key)
+        if pending is not None:
+            text = pending.body['text'] + self.separator + body['text']
+            if analyze(text)[2] <= self.max_segments:
+                pending.body['text'] = text
+                pending.merged_ids.append(body['id'])
+                pending.messages.append(message)
+                self.merged += 1
+                return ready
+            ready.append(self.pop(key))
+
+        pending = PendingMessage(now + self.delay, dict(body), message)
+        if analyze(body['text'])[2] > self.max_segments:
+            # too long to be merged with anything
+            ready.append(pending)
+            return ready
+
+        self.pending[key] = pending
+        self.order.append((pending.due, key))
+        while len(self.pending) > self.max_pending:
+            ready.extend(self.release_first())
+        return ready
+
+
+    def flush(self, now=None):
+        """
+            Return the list of PendingMessage held for 'delay' seconds.
+        """
+        now = now or time.time()
+        ready = []
+        while self.order and self.order[0][0] <= now:
+            ready.extend(self.release_first())
+        return ready
+
+
+    def release_first(self):
+        due, key = self.order.popleft()
+        pending = self.pending.get(key)
+        # the message may have been released already
+        if pending is None or pending.due != due:
+            return []
+        return [self.pop(key)]
+
+
+    def pop(self, key):
+        return self.pending.pop(key)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Spot the messages received twice, as modems and aggregators sometimes
+    send the same SMS again a few seconds later.
+"""
+
+from pragmatic_sms.cache import LRUCache
+
+
+class DuplicateFilter(object):
+    """
+        Remember the fingerprints of the last 'max_size' messages, with
+        their date rounded to 'window' seconds, so a message with the same
+        author and text in the same or the previous time window is a
+        duplicate. Checking the previous window too means two copies are
+        always caught if they are less than 'window' seconds apart, even
+        when they are on both sides of a window boundary.
+
+        'checked' and 'hits' count the messages checked and the duplicates
+        found.
+    """
+
+    def __init__(self, window=10, max_size=100000):
+        self.window = window
+        self.cache = LRUCache(max_size, ttl=window * 2)
+        self.checked = self.hits = 0
+
+
+    def is_duplicate(self, message):
+        """
+            Return True if this message was already seen, otherwise
+            remember it and return False.
+        """
+        self.checked += 1
+        bucket = message.time_bucket(self.window)
+        fingerprint = message.fingerprint(bucket)
+        if fingerprint in self.cache or \
+           message.fingerprint(bucket - 1) in self.cache:
+            self.hits += 1
+            return True
+        self.cache.set(fingerprint, True)
+        return False
+
+
+    def filter(self, messages):
+        """
+            Return the messages of this list which are not duplicates.
+        """
+        return [message for message in messages
+                if not self.is_duplicate(message)]
+
+
+    def stats(self):
+        return {'checked': self.checked, 'hits': self.hits,
+                'size': len(self.cache)}
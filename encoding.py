@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Tools to deal with the GSM 03.38 7 bits default alphabet, used by
+    most SMS, and to know how many SMS a text takes.
+"""
+
+import re
+import unicodedata
+
+
+# characters of the basic alphabet, indexed by their septet value
+GSM7_BASIC = (u'@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !"#¤%&\'()*+,-./'
+              u'0123456789:;<=>?¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§'
+              u'¿abcdefghijklmnopqrstuvwxyzäöñüà')
+
+# characters of the extension table, written as ESC + their septet value
+GSM7_EXTENSION = {u'\x0c': 0x0A, u'^': 0x14, u'{': 0x28, u'}': 0x29,
+                  u'\\': 0x2F, u'[': 0x3C, u'~': 0x3D, u']': 0x3E,
+                  u'|': 0x40, u'€': 0x65}
+
+ESCAPE = 0x1B
+
+GSM7_BASIC_CODES = dict((char, code) for code, char in enumerate(GSM7_BASIC))
+GSM7_EXTENSION_CHARS = dict((code, char)
+                            for char, code in GSM7_EXTENSION.iteritems())
+
+
+def encode_gsm7(text):
+    """
+        Return the list of septets for this text. Characters of the
+        extension table take two septets.
+
+        Raise ValueError if a character is not in the GSM 7 bits alphabet.
+    """
+    septets = []
+    for char in text:
+        try:
+            septets.append(GSM7_BASIC_CODES[char])
+        except KeyError:
+            try:
+                septets.extend((ESCAPE, GSM7_EXTENSION[char]))
+            except KeyError:
+                raise ValueError('%r is not in the GSM 7 bits alphabet' % char)
+    return septets
+
+
+def decode_gsm7(septets):
+    """
+        Return the text for this list of septets.
+    """
+    chars = []
+    escaped = False
+    for septet in septets:
+        if escaped:
+            chars.append(GSM7_EXTENSION_CHARS.get(septet, u' '))
+            escaped = False
+        elif septet == ESCAPE:
+            escaped = True
+        else:
+            chars.append(GSM7_BASIC[septet])
+    return u''.join(chars)
+
+
+def pack_septets(septets, padding=0):
+    """
+        Pack septets into a byte string, 8 septets in 7 octets, after
+        'padding' bits set to 0.
+    """
+    octets = []
+    buffer = 0
+    bits = padding
+    for septet in septets:
+        buffer |= (septet & 0x7F) << bits
+        bits += 7
+        while bits >= 8:
+            octets.append(chr(buffer & 0xFF))
+            buffer >>= 8
+            bits -= 8
+    if bits:
+        octets.append(chr(buffer & 0xFF))
+    return ''.join(octets)
+
+
+def unpack_septets(data, count, padding=0):
+    """
+        Return the list of 'count' septets packed in this byte string,
+        skipping the first 'padding' bits.
+    """
+    septets = []
+    buffer = 0
+    bits = 0
+    for octet in data:
+        buffer |= ord(octet) << bits
+        bits += 8
+        if padding:
+            buffer >>= padding
+            bits -= padding
+            padding = 0
+        while bits >= 7 and len(septets) < count:
+            septets.append(buffer & 0x7F)
+            buffer >>= 7
+            bits -= 7
+    return septets
+
+
+GSM7 = 'gsm7'
+UCS2 = 'ucs2'
+
+# max number of characters in one SMS, and in each part of a concatenated
+# SMS as the concatenation header takes 7 septets or 6 octets
+SEGMENT_SIZES = {GSM7: (160, 153), UCS2: (70, 67)}
+
+NOT_GSM7 = re.compile(u'[^%s]' % re.escape(GSM7_BASIC +
+                                            u''.join(GSM7_EXTENSION)))
+GSM7_EXTENDED = re.compile(u'[%s]' % re.escape(u''.join(GSM7_EXTENSION)))
+NOT_GSM7_BASIC = re.compile(u'[^%s]' % re.escape(GSM7_BASIC))
+
+
+def to_unicode(text):
+    if isinstance(text, str):
+        return text.decode('utf-8')
+    return text
+
+
+def analyze(text):
+    """
+        Return the encoding an SMS with this text needs, GSM7 or UCS2, its
+        length in septets or in UTF-16 code units, and the number of SMS
+        it takes.
+
+        The character classes are precompiled regexes over the GSM 7 bits
+        tables, so the common case doesn't loop over the characters in
+        Python.
+    """
+    text = to_unicode(text)
+
+    if NOT_GSM7.search(text) is None:
+        extended = len(GSM7_EXTENDED.findall(text))
+        length = len(text) + extended
+        single, multiple = SEGMENT_SIZES[GSM7]
+        if extended and length > single:
+            # escape sequences are not split between two parts, which may
+            # need one more part
+            return GSM7, length, count_gsm7_segments(text, multiple)
+        return GSM7, length, count_segments(GSM7, length)
+
+    length = len(text.encode('utf-16-be')) // 2
+    return UCS2, length, count_segments(UCS2, length)
+
+
+def count_segments(encoding, length):
+    """
+        Return the number of SMS a text of this length takes with this
+        encoding, without escape sequences.
+    """
+    single, multiple = SEGMENT_SIZES[encoding]
+    if length <= single:
+        return 1
+    return -(-length // multiple)
+
+
+def count_gsm7_segments(text, size):
+    segments = 1
+    used = 0
+    for char in text:
+        septets = 2 if char in GSM7_EXTENSION else 1
+        if used + septets > size:
+            segments += 1
+            used = 0
+        used += septets
+    return segments
+
+
+def classify(texts):
+    """
+        Analyze all these texts at once, like the ones of a campaign, and
+        return a dict with the number of texts, of GSM7 and UCS2 ones,
+        the total number of SMS and the number of texts per number of SMS.
+
+        Identical texts are only analyzed once.
+    """
+    results = {}
+    summary = {'texts': 0, GSM7: 0, UCS2: 0, 'segments': 0, 'histogram': {}}
+    histogram = summary['histogram']
+    for text in texts:
+        result = results.get(text)
+        if result is None:
+            result = results[text] = analyze(text)
+        encoding, length, segments = result
+        summary['texts'] += 1
+        summary[encoding] += 1
+        summary['segments'] += segments
+        histogram[segments] = histogram.get(segments, 0) + 1
+    return summary
+
+
+# replacements for the characters outside of the GSM 7 bits alphabet, when
+# removing their accents is not enough
+TRANSLITERATIONS = {
+    u'‘': u"'", u'’': u"'", u'‚': u"'", u'‛': u"'",
+    u'′': u"'", u'\xb4': u"'", u'`': u"'",
+    u'“': u'"', u'”': u'"', u'„': u'"', u'‟': u'"',
+    u'″': u'"', u'\xab': u'"', u'\xbb': u'"',
+    u'‐': u'-', u'‑': u'-', u'‒': u'-', u'–': u'-',
+    u'—': u'-', u'―': u'-', u'−': u'-', u'•': u'-',
+    u'…': u'...', u'\xa0': u' ', u' ': u' ', u' ': u' ',
+    u'\t': u' ', u'\xa9': u'(c)', u'\xae': u'(R)', u'™': u'TM',
+    u'\xd7': u'x', u'\xf7': u'/', u'Œ': u'OE', u'œ': u'oe',
+    u'\xd0': u'D', u'\xf0': u'd', u'Đ': u'D', u'đ': u'd',
+    u'Ł': u'L', u'ł': u'l', u'ı': u'i', u'\xde': u'TH',
+    u'\xfe': u'th', u'\xb0': u'o',
+}
+
+
+def build_transliteration_table():
+    """
+        Return the table for unicode.translate() turning each character
+        that is not in the GSM 7 bits alphabet into TRANSLITERATIONS or
+        into the character without its accents, if these are GSM 7 bits.
+    """
+    table = {}
+    chars = set(map(unichr, range(0x80, 0x2200) + range(0xFB00, 0xFB07)))
+    chars.update(TRANSLITERATIONS)
+    for char in chars:
+        if NOT_GSM7.search(char) is None:
+            continue
+        replacement = TRANSLITERATIONS.get(char)
+        if replacement is None:
+            replacement = u''.join(c for c in unicodedata.normalize('NFKD', char)
+                                   if not unicodedata.combining(c))
+            if not replacement or NOT_GSM7.search(replacement):
+                continue
+        table[ord(char)] = replacement
+    return table
+
+
+TRANSLITERATION_TABLE = build_transliteration_table()
+
+
+def transliterate(text):
+    """
+        Replace the characters of this text that are not in the GSM 7 bits
+        alphabet by close ones that are, when there is one: "Ça coûte 5€ – 
+        ‘promo’" becomes "Ça coute 5€ - 'promo'".
+    """
+    return to_unicode(text).translate(TRANSLITERATION_TABLE)
@@ -59,6 +59,38 @@ def fake_sms(args):
             raise e
 
 
+def send_campaign(args):
+    try:
+
+        from pragmatic_sms.campaigns import Campaign
+        template = args.template
+        if args.template_file:
+            template = open(args.template_file).read().decode('utf-8').strip()
+        elif template:
+            template = template.decode('utf-8')
+        campaign = Campaign(args.csv_file, template, args.transport_name, 
+                            args.rate, args.batch_size, args.number_column)
+        if args.restart:
+            campaign.reset()
+        elif campaign.sent:
+            print "Resuming after %s messages" % campaign.sent
+        print "%s messages sent" % campaign.run(args.limit)
+    except Exception as e:
+        try:
+            from pragmatic_sms.conf import settings
+        except:
+            sys.stderr.write("Unable to import router settings."\
+                  " You must pass a setting module using the --setting option or"\
+                  " set the \"PSMS_SETTINGS_MODULE\" environnement variable. If "\
+                  " you did so, ensure your setting module contains no error "\
+                  " and is in the Python Path. You can ask manage.py to add a "\
+                  " directory to the Python Path with the --python_path option "\
+                  " or you can pass to --settings a path to the *py file directly.\n")
+           
+        else:
+            raise e
+
+
 
 parser = argparse.ArgumentParser(description='Manage most Pragmatic SMS actions')
 
@@ -100,6 +132,49 @@ runrouter_parser.add_argument("-t", "--transport-name", dest="transport_name",
 
 runrouter_parser.set_defaults(func=fake_sms)
 
+
+# subcomand to send a message to each row of a CSV file
+campaign_parser = subparsers.add_parser('send_campaign', 
+                                        help='Send a message to each row of a '\
+                                             'CSV file')
+
+campaign_parser.add_argument('csv_file', type=str,
+                             help="The CSV file, with the column names in "\
+                                  "the first row")
+campaign_parser.add_argument('-m', '--template', type=str, default=None,
+                             help="The text to send, with the %%(column)s of"\
+                                  " the row. Default to the 'text' column")
+campaign_parser.add_argument('-f', '--template-file', dest="template_file",
+                             type=str, default=None,
+                             help="Read the template from this file")
+campaign_parser.add_argument('-c', '--number-column', dest="number_column",
+                             type=str, default='number',
+                             help="The column with the phone numbers")
+campaign_parser.add_argument('-r', '--rate', type=float, default=None,
+                             help="Send at most this number of messages per "\
+                                  "second")
+campaign_parser.add_argument('-b', '--batch-size', dest="batch_size", type=int,
+                             default=100,
+                             help="Save the position in the file every "\
+                                  "BATCH_SIZE messages")
+campaign_parser.add_argument('-l', '--limit', type=int, default=None,
+                             help="Stop after this number of messages")
+campaign_parser.add_argument('--restart', action='store_true', default=False,
+                             help="Start from the first row again instead of "\
+                                  "where the campaign stopped")
+campaign_parser.add_argument('-s', '--settings', default='settings', type=str,
+                             help="Specified in which module to look for settings",
+                             )
+campaign_parser.add_argument("-p", "--python-path", dest="python_path", 
+                    default='.', type=str, 
+                    help="Add the following directory to the python path")
+
+campaign_parser.add_argument("-t", "--transport-name", dest="transport_name", 
+                    default='default', type=str, 
+                    help="Send the messages with this transport")
+
+campaign_parser.set_defaults(func=send_campaign)
+
 args = parser.parse_args()
 
 os.environ['PYTHON_PATH'] = args.python_path
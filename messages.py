@@ -7,11 +7,21 @@
     API to deal with them.
 """
 
+import os
+import time
+import socket
+import logging
 import datetime
 import uuid
+import hashlib
 
-from kombu.messaging import Queue
+from kombu.messaging import Queue, Consumer
 
+from conf import settings
+from cache import LRUCache
+from phone import normalize
+from encoding import analyze, GSM7
+from duplicates import DuplicateFilter
 from workers import PSMSWorker
 
 
@@ -25,16 +35,59 @@ class MessageWorker(PSMSWorker):
 
     name = 'message worker'
 
+    _duplicates = None
+
+
+    @property
+    def duplicates(self):
+        """
+            The DuplicateFilter the incoming messages go through before 
+            being dispatched, or None if DUPLICATES_WINDOW is not set.
+        """
+        if self._duplicates is None and settings.DUPLICATES_WINDOW:
+            self._duplicates = DuplicateFilter(settings.DUPLICATES_WINDOW,
+                                               settings.DUPLICATES_MAX_SIZE)
+        return self._duplicates
+
 
     def dispatch_incoming_message(self, message):
         """
             Add an incoming message in the queue. Transport transport use this
             method notify all the message processor that they received a new
             message.
+
+            Messages already received in the last DUPLICATES_WINDOW seconds
+            are dropped. Return False if the message was dropped.
+        """
+        if self.duplicates and self.duplicates.is_duplicate(message):
+            self.log(logging.WARNING, 'Duplicate message dropped: %s' % 
+                                      unicode(message))
+            return False
+
+        self.publish(message.to_dict(), "incoming_messages")
+        return True
+
+
+    def dispatch_incoming_messages(self, messages):
+        """
+            Add several incoming messages in the queue at once, as one
+            broker message. Message processors get them one by one anyway.
+
+            Duplicates are dropped as in dispatch_incoming_message(). Return 
+            the number of messages dispatched.
         """
+        if self.duplicates:
+            count = len(messages)
+            messages = self.duplicates.filter(messages)
+            if len(messages) < count:
+                self.log(logging.WARNING, '%s duplicate messages dropped' % 
+                                          (count - len(messages)))
+            if not messages:
+                return 0
 
-        self.producers['psms'].publish(body=message.to_dict(), 
-                                      routing_key="incoming_messages")   
+        self.publish({'batch': [message.to_dict() for message in messages]},
+                     "incoming_messages")
+        return len(messages)
 
 
     def dispatch_outgoing_message(self, message):
@@ -43,13 +96,52 @@ class MessageWorker(PSMSWorker):
             this notify the proper transport that they sent a new
             message.
         """
-        self.producers['psms'].publish(body=message.to_dict(), 
-                                      routing_key="outgoing_messages")     
+        self.publish(message.to_dict(), "outgoing_messages")
+
+
+    def dispatch_outgoing_messages(self, messages):
+        """
+            Add several outgoing messages in the queue, one broker message
+            each: the router handles them one by one, unlike incoming
+            messages, so a batch would only save the publishing calls.
+        """
+        for message in messages:
+            self.publish(message.to_dict(), "outgoing_messages")
+
+
+    def dispatch_broadcast_message(self, message):
+        """
+            Add a broadcast message in the queue. The router sends it to 
+            each recipient little by little, see BroadcastMessage.
+        """
+        self.publish(message.to_dict(), "broadcast_messages")
+
+
+    def dispatch_expired_messages(self, bodies):
+        """
+            Publish the bodies of outgoing messages which expired before
+            being sent on the 'expired_messages' queue, for the record.
+        """
+        body = bodies[0] if len(bodies) == 1 else {'batch': bodies}
+        self.publish(body, "expired_messages")
+
+
+    def dispatch_message_states(self, states):
+        """
+            Publish the new state of one or several messages, as dicts with
+            the 'state' and the 'id' of the message, or its 'smsc_id' and 
+            'transport'. The router records them (see pragmatic_sms.states).
+        """
+        body = states[0] if len(states) == 1 else {'batch': states}
+        self.publish(body, "message_states")
 
 
     def get_queues(self):
         """
-            One queue for incomming messages, one queue for outgoing messages.
+            One queue for incomming messages, one queue for outgoing messages,
+            one for the broadcast messages, one for the state of the 
+            outgoing messages and one for the outgoing messages which 
+            expired before being sent.
         """
 
         queues = {}
@@ -62,9 +154,132 @@ class MessageWorker(PSMSWorker):
                                             exchange=self.exchanges['psms'],
                                             routing_key="outgoing_messages",
                                             durable=self.persistent)
+        queues['broadcast_messages'] = Queue('broadcast_messages',
+                                             exchange=self.exchanges['psms'],
+                                             routing_key="broadcast_messages",
+                                             durable=self.persistent)
+        queues['message_states'] = Queue('message_states',
+                                         exchange=self.exchanges['psms'],
+                                         routing_key="message_states",
+                                         durable=self.persistent)
+        queues['expired_messages'] = Queue('expired_messages',
+                                           exchange=self.exchanges['psms'],
+                                           routing_key="expired_messages",
+                                           durable=self.persistent)
         return queues
 
 
+class ResponseFuture(object):
+    """
+        The responses to an incoming message, as they come back from
+        the router. See IncomingMessage.dispatch().
+    """
+
+    def __init__(self, message, listener, timeout):
+        self.message = message
+        self.listener = listener
+        self.deadline = time.time() + timeout
+        self.responses = []
+
+
+    def done(self):
+        return bool(self.responses)
+
+
+    def result(self, timeout=None):
+        """
+            Return the first OutgoingMessage sent in response to the message,
+            waiting for it until 'timeout' seconds or the timeout given 
+            to dispatch(). Return None if no response came in time.
+        """
+        deadline = self.deadline
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not self.responses:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            self.listener.wait(remaining)
+        return self.responses[0]
+
+
+
+class ResponseListener(PSMSWorker):
+    """
+        Receive the responses to the incoming messages dispatched by this
+        process in its own queue, and give them to the ResponseFuture 
+        of their incoming message.
+
+        The futures are kept until they time out, in a cache holding at 
+        most RESPONSES_MAX_PENDING of them, so waiting for responses which
+        never come costs nothing.
+    """
+
+    name = 'response listener'
+
+    _instance = None
+
+
+    def __init__(self):
+        self.queue_name = 'responses_%s' % uuid.uuid4().hex
+        self.pending = LRUCache(settings.RESPONSES_MAX_PENDING)
+        self.pid = os.getpid()
+        PSMSWorker.__init__(self)
+
+
+    @classmethod
+    def get_listener(cls):
+        """
+            Return the listener of this process, creating it if needed.
+        """
+        if cls._instance is None or cls._instance.pid != os.getpid():
+            cls._instance = cls()
+            cls._instance.connect()
+        return cls._instance
+
+
+    def get_queues(self):
+        return {'responses': Queue(self.queue_name, 
+                                   exchange=self.exchanges['psms'],
+                                   routing_key=self.queue_name,
+                                   durable=False, auto_delete=True)}
+
+
+    def get_consumers(self):
+        consumer = Consumer(self.channel, self.queues['responses'])
+        consumer.register_callback(self.handle_response)
+        consumer.consume()
+        return {'responses': consumer}
+
+
+    def expect(self, message, timeout):
+        """
+            Return a ResponseFuture for the responses to this message.
+        """
+        future = ResponseFuture(message, self, timeout)
+        self.pending.set(message.id, future, ttl=timeout)
+        return future
+
+
+    def handle_response(self, body, message):
+        message.ack()
+        response = OutgoingMessage(**body)
+        future = self.pending.get(response.response_to.id)
+        if future is not None:
+            future.responses.append(response)
+
+
+    def wait(self, timeout):
+        """
+            Wait for one response during 'timeout' seconds at most.
+        """
+        try:
+            self.connection.drain_events(timeout=timeout)
+        except socket.timeout:
+            pass
+
+
+
 class Message(object):
     """
         Base message class with attributes and methods common to incoming and
@@ -80,7 +295,6 @@ class Message(object):
          
     """
 
-    # todo: message id hash of message content ?
     # todo: message are immutable ?
 
     DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
@@ -98,7 +312,35 @@ class Message(object):
     def __eq__(self, message):
         return self.id == message.id
 
+
+    def fingerprint(self, bucket=None):
+        """
+            Return a hash of the transport, number and text of the message,
+            and of 'bucket' if given, usually a time_bucket(): two copies of
+            the same message have the same fingerprint, but not the same id.
+        """
+        content = u'\0'.join((self.transport or u'', self.number or u'', 
+                              self.text or u'', unicode(bucket)))
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+    def time_bucket(self, window):
+        """
+            Return the date of the message rounded to 'window' seconds,
+            as an integer.
+        """
+        return int(time.mktime(self.date.timetuple()) // window)
+
     
+    @classmethod
+    def from_body(cls, body):
+        """
+            Return the list of messages in the body of a broker message,
+            which is either one serialized message or a batch of them.
+        """
+        return [cls(**data) for data in body.get('batch', (body,))]
+
+
     @classmethod
     def serialize_date(cls, date):
         """
@@ -120,15 +362,35 @@ class Message(object):
 class OutgoingMessage(Message):
     """
         Message to be sent by a transport.
+
+        The recipient number is normalized, see pragmatic_sms.phone.
+
+        Transports set 'smsc_id' to the id the operator gave to the message
+        when they send it, or 'error' if the operator refused it. These are
+        not serialized.
+
+        Message processors can call cancel() so the router doesn't give the
+        message to its transport.
+
+        'encoding', 'segments' and 'fits_gsm7' tell how the text will be
+        sent and how many SMS it takes, see pragmatic_sms.encoding.
+
+        Messages with an 'expires_at' date, or a 'ttl' in seconds from their
+        creation, are not sent once this date is passed. Without any,
+        OUTGOING_MESSAGES_TTL applies.
     """
 
     def __init__(self, recipient, text, transport='default', creation_date=None,
-                 id=None, response_to=None):
+                 id=None, response_to=None, cancelled=None, expires_at=None,
+                 ttl=None):
         Message.__init__(self, text, transport, id)
 
         # accept None, and IncomingMessage object or a
         # serialized IncomingMessage object as parameter
-        self.recipient = recipient
+        self.recipient = normalize(recipient)
+        self.smsc_id = None
+        self.error = None
+        self.cancelled = cancelled
 
         if response_to:
             try:
@@ -143,20 +405,35 @@ class OutgoingMessage(Message):
             try:
                 self.creation_date = self.unserialize_date(creation_date)
             except TypeError:
-                self.creation_date = self.creation_date
+                self.creation_date = creation_date
         else:
             self.creation_date = datetime.datetime.now()
 
+        if expires_at:
+            try:
+                self.expires_at = self.unserialize_date(expires_at)
+            except TypeError:
+                self.expires_at = expires_at
+        else:
+            ttl = ttl or settings.OUTGOING_MESSAGES_TTL
+            if ttl:
+                delta = datetime.timedelta(seconds=ttl)
+                self.expires_at = self.creation_date + delta
+            else:
+                self.expires_at = None
+
 
     def to_dict(self):
         """
             Turn this object into a dict that is easy to serialize into JSON
         """
         response_to = self.response_to.to_dict() if self.response_to else self.response_to
+        expires_at = self.expires_at and self.serialize_date(self.expires_at)
         return {'recipient': self.recipient, 'text': self.text, 
                 'transport': self.transport, 'id': self.id, 
                 'response_to': response_to,
-                'creation_date': self.serialize_date(self.creation_date)}
+                'creation_date': self.serialize_date(self.creation_date),
+                'cancelled': self.cancelled, 'expires_at': expires_at}
 
 
     def send(self):
@@ -165,6 +442,95 @@ class OutgoingMessage(Message):
         """
         self.worker.dispatch_outgoing_message(self)
 
+
+    @property
+    def number(self):
+        return self.recipient
+
+
+    @property
+    def date(self):
+        return self.creation_date
+
+
+    @property
+    def analysis(self):
+        """
+            The encoding, length and number of SMS of the text, computed
+            again only if the text changed.
+        """
+        cached = getattr(self, '_analysis', None)
+        if cached is None or cached[0] != self.text:
+            cached = self._analysis = (self.text, analyze(self.text))
+        return cached[1]
+
+
+    @property
+    def encoding(self):
+        """
+            pragmatic_sms.encoding.GSM7 or UCS2.
+        """
+        return self.analysis[0]
+
+
+    @property
+    def segments(self):
+        """
+            The number of SMS needed to send the text.
+        """
+        return self.analysis[2]
+
+
+    @property
+    def fits_gsm7(self):
+        return self.analysis[0] == GSM7
+
+
+    @property
+    def expired(self):
+        return bool(self.expires_at) and \
+               self.expires_at <= datetime.datetime.now()
+
+
+    @classmethod
+    def body_expired(cls, body, now=None):
+        """
+            Tell if the message serialized in this body expired, without
+            creating the message: serialized dates sort like dates, so 
+            they are compared as strings.
+        """
+        expires_at = body.get('expires_at')
+        if not expires_at:
+            return False
+        now = now or datetime.datetime.now()
+        return expires_at <= cls.serialize_date(now)
+
+
+    def cancel(self, reason):
+        """
+            Prevent the message to be sent. Only works in 
+            MessageProcessor.on_send_message(): the router will record the
+            message as failed with 'reason' as an error instead of relaying
+            it.
+        """
+        self.cancelled = reason
+
+
+    def get_state(self, state):
+        """
+            Return the dict to publish to set the state of this message.
+        """
+        return {'id': self.id, 'state': state, 'transport': self.transport,
+                'smsc_id': self.smsc_id, 'error': self.error}
+
+
+    def set_state(self, state):
+        """
+            Publish the new state of this message, one of the constants of
+            pragmatic_sms.states.
+        """
+        self.worker.dispatch_message_states([self.get_state(state)])
+
     
     def __unicode__(self):
         return u"To %(recipient)s: %(text)s" % self.__dict__
@@ -175,23 +541,127 @@ class OutgoingMessage(Message):
 
 
 
+class BroadcastMessage(OutgoingMessage):
+    """
+        Message to be sent to many recipients: 'recipients' is either a 
+        list of numbers or the path to a file with one number per line, 
+        which is better for large broadcasts as it is not copied in the
+        message body.
+
+        The router doesn't put one message per recipient in the outgoing
+        message queue: message processors see the broadcast once, in
+        MessageProcessor.on_send_broadcast(), then the router creates the
+        OutgoingMessage for each recipient and relays them to the transport
+        by chunks of BROADCAST_CHUNK_SIZE recipients. 
+
+        'offset' is where the next chunk starts: an index in the list, or
+        a position in the file.
+    """
+
+    def __init__(self, recipients, text, transport='default', 
+                 creation_date=None, id=None, cancelled=None, expires_at=None,
+                 ttl=None, offset=0):
+        OutgoingMessage.__init__(self, None, text, transport, creation_date, id,
+                                 cancelled=cancelled, expires_at=expires_at, 
+                                 ttl=ttl)
+        self.recipients = recipients
+        self.offset = offset
+
+
+    def to_dict(self):
+        body = OutgoingMessage.to_dict(self)
+        del body['recipient'], body['response_to']
+        body['recipients'] = self.recipients
+        body['offset'] = self.offset
+        return body
+
+
+    def send(self):
+        """
+            Stack the message in the broadcast message queue.
+        """
+        self.worker.dispatch_broadcast_message(self)
+
+
+    def iter_recipients(self):
+        """
+            Yield the offset of the next recipient and the recipient, from
+            the current offset.
+        """
+        if isinstance(self.recipients, basestring):
+            f = open(self.recipients)
+            try:
+                f.seek(self.offset)
+                # don't iterate on the file: it reads ahead so tell() would
+                # be wrong
+                line = f.readline()
+                while line:
+                    if line.strip():
+                        yield f.tell(), line.strip()
+                    line = f.readline()
+            finally:
+                f.close()
+        else:
+            for i in xrange(self.offset, len(self.recipients)):
+                yield i + 1, self.recipients[i]
+
+
+    def next_chunk(self, size):
+        """
+            Return the next 'size' recipients, normalized, and move the 
+            offset after them. The list is empty once all the recipients 
+            got the message.
+        """
+        chunk = []
+        for offset, recipient in self.iter_recipients():
+            chunk.append(normalize(recipient))
+            self.offset = offset
+            if len(chunk) >= size:
+                break
+        return chunk
+
+
+    def create_message(self, recipient):
+        """
+            Return the OutgoingMessage to send to this recipient.
+        """
+        return OutgoingMessage(recipient, self.text, self.transport,
+                               expires_at=self.expires_at)
+
+
+    def __unicode__(self):
+        if isinstance(self.recipients, basestring):
+            return u"To the recipients in %s: %s" % (self.recipients, self.text)
+        return u"To %s recipients: %s" % (len(self.recipients), self.text)
+    
+
+    def __repr__(self):
+        return u"<BroadcastMessage %(id)s via %(transport)s>" % self.__dict__
+
+
+
 class IncomingMessage(Message):
     """
         Received message, waiting to be processed.
+
+        The author number is normalized, see pragmatic_sms.phone.
     """
     
     def __init__(self, author, text, transport='default', reception_date=None,
-                 id=None):
+                 id=None, reply_to=None):
         Message.__init__(self, text, transport, id)
         
-        self.author = author
+        self.author = normalize(author)
+
+        # the queue the router copies the responses to this message to
+        self.reply_to = reply_to
 
         # accept a string as a date or a date object
         if reception_date:
             try:
                 self.reception_date = self.unserialize_date(reception_date)
             except TypeError:
-                self.reception_date = self.reception_date
+                self.reception_date = reception_date
         else:
             self.reception_date = datetime.datetime.now()
 
@@ -202,7 +672,18 @@ class IncomingMessage(Message):
         """
         return {'author': self.author, 
                 'text': self.text, 'transport': self.transport, 'id': self.id,
-                'reception_date': self.serialize_date(self.reception_date)}
+                'reception_date': self.serialize_date(self.reception_date),
+                'reply_to': self.reply_to}
+
+
+    @property
+    def number(self):
+        return self.author
+
+
+    @property
+    def date(self):
+        return self.reception_date
 
 
     def create_response(self, text):
@@ -226,11 +707,23 @@ class IncomingMessage(Message):
         return message
 
 
-    def dispatch(self):
+    def dispatch(self, wait_for_response=None):
         """
             Stack the message in the incoming message queue.
+
+            If 'wait_for_response' is a number of seconds, return a 
+            ResponseFuture: its result() is the first OutgoingMessage sent
+            in response to this message within this delay, or None.
         """
+        if wait_for_response is None:
+            self.worker.dispatch_incoming_message(self)
+            return None
+
+        listener = ResponseListener.get_listener()
+        self.reply_to = listener.queue_name
+        future = listener.expect(self, wait_for_response)
         self.worker.dispatch_incoming_message(self)
+        return future
 
 
     def __unicode__(self):
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Turn the phone numbers into their E.164 form, like "+22376000000", so
+    the same number always gives the same string whatever the way it was
+    written:
+
+        >>> normalize('00223 76 00 00 00')
+        '+22376000000'
+
+    Numbers are normalized when messages are created, so their 'author' and
+    'recipient' can be used as keys for sessions, blocklists, etc.
+"""
+
+import re
+
+from pragmatic_sms.cache import LRUCache
+from pragmatic_sms.conf import settings
+
+
+FORMATTING = re.compile(r'[\s\-\.\(\)/]')
+DIGITS = re.compile(r'^\d+$')
+
+
+class PhoneNormalizer(object):
+    """
+        Normalize phone numbers with these rules:
+
+        - spaces, dashes, dots, slashes and parenthesis are removed;
+        - numbers starting with '+' or one of 'international_prefixes' are
+          international;
+        - numbers with at most 'short_code_max_length' digits are short
+          codes and are left as is;
+        - other numbers are national: the 'trunk_prefix' is removed and
+          'country_code' is added, if it's set.
+
+        Anything else, like alphanumeric sender ids, is left as is. Results
+        are cached in an LRUCache of 'cache_size' numbers as messages are
+        created again each time they are unserialized.
+    """
+
+    def __init__(self, country_code=None, trunk_prefix='0',
+                 international_prefixes=('00',), short_code_max_length=6,
+                 cache_size=100000):
+        self.country_code = country_code
+        self.trunk_prefix = trunk_prefix
+        self.international_prefixes = international_prefixes
+        self.short_code_max_length = short_code_max_length
+        self.cache = LRUCache(cache_size)
+
+
+    def parse(self, number):
+        stripped = FORMATTING.sub('', number)
+
+        if stripped.startswith('+'):
+            digits = stripped[1:]
+            return '+' + digits if DIGITS.match(digits) else number
+
+        if not DIGITS.match(stripped):
+            return number
+
+        for prefix in self.international_prefixes:
+            if stripped.startswith(prefix):
+                return '+' + stripped[len(prefix):]
+
+        if len(stripped) <= self.short_code_max_length:
+            return stripped
+
+        if self.country_code:
+            if self.trunk_prefix and stripped.startswith(self.trunk_prefix):
+                stripped = stripped[len(self.trunk_prefix):]
+            return '+%s%s' % (self.country_code, stripped)
+
+        return stripped
+
+
+    def normalize(self, number):
+        """
+            Return the normalized form of this number.
+        """
+        if not number:
+            return number
+        normalized = self.cache.get(number)
+        if normalized is None:
+            normalized = self.parse(number)
+            self.cache.set(number, normalized)
+        return normalized
+
+
+
+_normalizer = None
+
+def get_normalizer():
+    """
+        Return the PhoneNormalizer configured with the settings, created
+        again if the settings changed.
+    """
+    global _normalizer
+    conf = (settings.PHONE_COUNTRY_CODE, settings.PHONE_TRUNK_PREFIX,
+            tuple(settings.PHONE_INTERNATIONAL_PREFIXES),
+            settings.PHONE_SHORT_CODE_MAX_LENGTH)
+    if _normalizer is None or _normalizer.conf != conf:
+        _normalizer = PhoneNormalizer(*conf)
+        _normalizer.conf = conf
+    return _normalizer
+
+
+def normalize(number):
+    """
+        Normalize this number with the rules of the settings, unless
+        PHONE_NORMALIZATION is False.
+    """
+    if not settings.PHONE_NORMALIZATION:
+        return number
+    return get_normalizer().normalize(number)
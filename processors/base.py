@@ -9,9 +9,14 @@
 
 import socket
 
-from pragmatic_sms.messages import IncomingMessage, OutgoingMessage
+from functools import wraps
+
+from pragmatic_sms.messages import (IncomingMessage, OutgoingMessage, 
+                                    BroadcastMessage)
 from pragmatic_sms.conf import settings
 from pragmatic_sms.workers import PSMSWorker
+from pragmatic_sms.sessions import SessionStore
+from pragmatic_sms.cache import LRUCache
 
 
 
@@ -47,6 +52,10 @@ class MessageProcessor(object):
     worker = PSMSWorker()
     worker.connect()
 
+    # max number of seconds the router lets the processor handle a message,
+    # PROCESSORS_TIMEOUT if None. See pragmatic_sms.watchdog
+    timeout = None
+
 
     # todo: implement on return so we can handle message you can't deliver
     # http://packages.python.org/kombu/reference/kombu.messaging.html?k#message-producer
@@ -61,9 +70,15 @@ class MessageProcessor(object):
             not override it unless you know what you are doing.
 
             To react on the reception of messages, override 'on_receive_message'.
+
+            Transports can dispatch messages by batch, in which case
+            'on_receive_message' is called for each message of the batch
+            and the batch is acknowledged if any of them was handled.
         """
         # todo: try / except message reception and log error
-        if self.on_receive_message(IncomingMessage(**body)):
+        handled = [self.on_receive_message(incoming) 
+                   for incoming in IncomingMessage.from_body(body)]
+        if any(handled):
             message.ack()
 
 
@@ -77,12 +92,35 @@ class MessageProcessor(object):
             not override it unless you know what you are doing.
 
             To react on the reception of messages, override 'on_send_message'.
+
+            The body is updated with the message afterwards, so the next
+            processors and the router see the changes 'on_send_message' 
+            made, like a new text or a cancellation.
         """
         # todo: try / except message reception and log error
-        if self.on_send_message(OutgoingMessage(**body)):
+        outgoing = OutgoingMessage(**body)
+        handled = self.on_send_message(outgoing)
+        body.update(outgoing.to_dict())
+        if handled:
             message.ack()
 
 
+    def handle_broadcast_message(self, body, message):
+        """
+            Callback called when a broadcast message is ready to be sent.
+            It passes the BroadcastMessage to 'on_send_broadcast', only 
+            before its first recipients get it, and updates the body with it.
+
+            This method is used for internal purpose and you should
+            not override it unless you know what you are doing.
+        """
+        if body.get('offset'):
+            return
+        broadcast = BroadcastMessage(**body)
+        self.on_send_broadcast(broadcast)
+        body.update(broadcast.to_dict())
+
+
     def on_receive_message(self, message):
         """
             Override this method to react to any message that is just arriving.
@@ -112,6 +150,84 @@ class MessageProcessor(object):
         pass
 
 
+    def on_send_broadcast(self, message):
+        """
+            Override this method to react once to a broadcast message, a 
+            BroadcastMessage object, rather than for each of its recipients:
+            on_send_message() is not called for the messages the router
+            creates from it.
+
+            You can change its text or cancel it.
+        """
+        pass
+
+
+    def on_message_state(self, state):
+        """
+            Override this method to react to the new state of an outgoing
+            message, a pragmatic_sms.states.MessageState, once the router
+            recorded it: relayed, failed because a processor cancelled it,
+            submitted or delivered according to the transport, etc.
+        """
+        pass
+
+
+    def filter_broadcast_recipients(self, message, recipients):
+        """
+            Override this method to prevent a broadcast message to be sent
+            to some recipients. It's called by the router with each chunk
+            of recipients and must return the list of those to keep.
+        """
+        return recipients
+
+
+    def session(self, key):
+        """
+            Return the Session of this key, usually the phone number of the
+            person you are talking with. Each message processor class has
+            its own sessions, see pragmatic_sms.sessions.
+        """
+        sessions = self.__dict__.get('sessions')
+        if sessions is None:
+            sessions = self.sessions = SessionStore(self.__class__.__name__)
+        return sessions.get(key)
+
+
+    def invalidate_replies(self, *values):
+        """
+            Forget the replies memoized by memoize_replies() for the messages
+            with these values of the fields, or all of them without values,
+            like when the data they come from changed.
+        """
+        replies = self.__dict__.get('replies')
+        if replies is None:
+            return
+        if values:
+            replies.pop(reply_key(values, replies.fields))
+        else:
+            replies.clear()
+
+
+    def reply_stats(self):
+        """
+            Return a dict with the number of replies memoized by 
+            memoize_replies(), and the cache hits, misses and evictions.
+        """
+        replies = self.__dict__.get('replies')
+        if replies is None:
+            return {'size': 0, 'hits': 0, 'misses': 0, 'evictions': 0}
+        return {'size': len(replies), 'hits': replies.hits, 
+                'misses': replies.misses, 'evictions': replies.evictions}
+
+
+    def close(self):
+        """
+            Override this method to release your resources when the router
+            stops, like writing data you kept in memory.
+        """
+        pass
+
+
     # todo: add the 'origin' of the message as the piece of code that produced 
     # the message
 
@@ -127,3 +243,70 @@ class MessageProcessor(object):
         message.send()
         return message
 
+
+
+def reply_key(values, fields):
+    """
+        Return the key of the memoized replies for these values of the
+        fields. The text is compared in upper case, without the extra
+        spaces, so "price  maize" and "PRICE MAIZE" are the same.
+    """
+    return tuple(u' '.join(value.upper().split()) if field == 'text' 
+                 else value for field, value in zip(fields, values))
+
+
+def memoize_replies(fields=('text',), ttl=3600, max_size=10000):
+    """
+        Decorate on_receive_message() when the replies it sends only 
+        depend on these fields of the incoming message, like answers to
+        keywords looked up in a database:
+
+            class PriceMessageProcessor(MessageProcessor):
+
+                @memoize_replies(ttl=600)
+                def on_receive_message(self, message):
+                    ...
+                    message.respond(text)
+
+        The texts given to message.respond() and the return value are kept
+        in an LRUCache of 'max_size' entries for 'ttl' seconds, and sent
+        again to the next messages with the same fields instead of calling
+        the method. Replies sent another way are not memoized.
+
+        See MessageProcessor.invalidate_replies() and reply_stats().
+    """
+    def decorator(on_receive_message):
+
+        @wraps(on_receive_message)
+        def wrapper(self, message):
+            replies = self.__dict__.get('replies')
+            if replies is None:
+                replies = self.replies = LRUCache(max_size, ttl)
+                replies.fields = fields
+
+            key = reply_key([getattr(message, f) for f in fields], fields)
+            cached = replies.get(key)
+            if cached is not None:
+                handled, texts = cached
+                for text in texts:
+                    message.respond(text)
+                return handled
+
+            texts = []
+            respond = message.respond
+            def record(text):
+                texts.append(text)
+                return respond(text)
+
+            message.respond = record
+            try:
+                handled = on_receive_message(self, message)
+            finally:
+                del message.respond
+            replies.set(key, (handled, texts))
+            return handled
+
+        return wrapper
+
+    return decorator
+
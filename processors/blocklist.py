@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Message processor preventing messages to be sent to the people who
+    asked to stop receiving them.
+"""
+
+import os
+import logging
+
+from pragmatic_sms.processors.base import MessageProcessor
+from pragmatic_sms.blocklist import Blocklist
+from pragmatic_sms.conf import settings
+
+
+class BlocklistMessageProcessor(MessageProcessor):
+    """
+        Add the author of any incoming message which is one of the
+        BLOCKLIST_KEYWORDS, like "STOP", to the blocklist, and cancel the
+        outgoing messages to the numbers in the blocklist. These numbers
+        are skipped when broadcast messages are sent.
+
+        The blocklist is stored at BLOCKLIST_PATH, TEMP_DIR/blocklist if
+        None. To import an existing list:
+
+            from pragmatic_sms.blocklist import Blocklist
+            Blocklist(path).extend(open('numbers.txt'))
+
+        Put it first in MESSAGE_PROCESSORS so the other processors know
+        the message is cancelled.
+    """
+
+    def __init__(self, path=None):
+        MessageProcessor.__init__(self)
+        path = path or settings.BLOCKLIST_PATH or \
+               os.path.join(settings.TEMP_DIR, 'blocklist')
+        self.blocklist = Blocklist(path)
+        self.keywords = set(k.upper() for k in settings.BLOCKLIST_KEYWORDS)
+
+
+    def on_receive_message(self, message):
+        if message.text.strip().upper() in self.keywords:
+            if self.blocklist.add(message.author):
+                self.worker.log(logging.INFO, '%s added to the blocklist' %
+                                message.author)
+
+
+    def on_send_message(self, message):
+        if message.recipient in self.blocklist:
+            message.cancel('blocklisted')
+
+
+    def filter_broadcast_recipients(self, message, recipients):
+        return [r for r in recipients if r not in self.blocklist]
+
+
+    def close(self):
+        self.blocklist.close()
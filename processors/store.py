@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Message processor keeping the history of all messages in SQLite.
+"""
+
+import os
+import Queue
+import logging
+import sqlite3
+import itertools
+import threading
+
+from pragmatic_sms.processors.base import MessageProcessor
+from pragmatic_sms.messages import OutgoingMessage, IncomingMessage, Message
+from pragmatic_sms.conf import settings
+from pragmatic_sms.watchdog import uninterruptible
+from pragmatic_sms.phone import normalize
+
+
+SCHEMA = (
+    """
+        CREATE TABLE IF NOT EXISTS messages (
+            id TEXT PRIMARY KEY,
+            incoming INTEGER NOT NULL,
+            number TEXT,
+            text TEXT,
+            transport TEXT,
+            date TEXT,
+            response_to TEXT
+        )
+    """,
+    "CREATE INDEX IF NOT EXISTS messages_number ON messages (number, date)",
+    "CREATE INDEX IF NOT EXISTS messages_transport ON messages (transport, date)",
+    "CREATE INDEX IF NOT EXISTS messages_date ON messages (date)",
+    "CREATE INDEX IF NOT EXISTS messages_response_to ON messages (response_to)",
+    """
+        CREATE TABLE IF NOT EXISTS message_states (
+            id TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            error TEXT
+        )
+    """,
+)
+
+INSERT = """
+    INSERT OR IGNORE INTO messages
+        (id, incoming, number, text, transport, date, response_to)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+# states arrive in the order the router records them, the last one wins
+UPDATE_STATE = """
+    INSERT OR REPLACE INTO message_states (id, state, error) VALUES (?, ?, ?)
+"""
+
+COLUMNS = 'm.id, m.incoming, m.number, m.text, m.transport, m.date, '\
+          'm.response_to, s.state, s.error'
+
+TABLES = 'messages m LEFT JOIN message_states s ON s.id = m.id'
+
+
+class MessageStoreProcessor(MessageProcessor):
+    """
+        Write every incoming and outgoing message to an SQLite database,
+        at MESSAGE_STORE_PATH, so you can query the history of a phone
+        number:
+
+            store.history('+2237000000', since=yesterday, limit=10)
+
+        The router only puts the messages in a queue: a thread writes them
+        by batches of up to 'batch_size' rows, one transaction per batch,
+        and the database is in WAL mode so reading it doesn't block the
+        writes. If the thread can't keep up and more than 'max_pending'
+        messages are waiting, new ones are not recorded.
+
+        Dates are stored as strings with Message.DATE_FORMAT, which sort
+        like the dates they represent.
+
+        Outgoing messages are recorded before the next processors and the
+        router decide what happens to them, so their state is recorded
+        apart as the router gets it, see on_message_state(). The 
+        OutgoingMessage objects returned have the last one in their
+        'state' and 'error' attributes.
+    """
+
+    def __init__(self, path=None, batch_size=500, max_pending=100000):
+
+        MessageProcessor.__init__(self)
+
+        self.path = path or settings.MESSAGE_STORE_PATH or \
+                    os.path.join(settings.TEMP_DIR, 'messages.db')
+        self.batch_size = batch_size
+        self.pending = Queue.Queue(max_pending)
+        self.dropped = 0
+        self.readers = threading.local()
+
+        connection = self.connect()
+        for statement in SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+        connection.close()
+
+        self.writer = threading.Thread(target=self.write_messages)
+        self.writer.daemon = True
+        self.writer.start()
+
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+
+    def record(self, statement, row):
+        try:
+            with uninterruptible():
+                self.pending.put_nowait((statement, row))
+        except Queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                self.worker.log(logging.ERROR, 'Message store is late, %s '\
+                                'messages not recorded' % self.dropped)
+
+
+    def on_receive_message(self, message):
+        self.record(INSERT, (message.id, 1, message.author, message.text,
+                     message.transport,
+                     Message.serialize_date(message.reception_date), None))
+
+
+    def on_send_message(self, message):
+        response_to = getattr(message.response_to, 'id', message.response_to)
+        self.record(INSERT, (message.id, 0, message.recipient, message.text,
+                     message.transport,
+                     Message.serialize_date(message.creation_date),
+                     response_to))
+
+
+    def on_message_state(self, state):
+        self.record(UPDATE_STATE, (state.id, state.state, state.error))
+
+
+    def write_messages(self):
+        """
+            Insert the pending messages and states by batch until close() 
+            is called.
+        """
+        connection = self.connect()
+        while True:
+            rows = [self.pending.get()]
+            while len(rows) < self.batch_size:
+                try:
+                    rows.append(self.pending.get_nowait())
+                except Queue.Empty:
+                    break
+
+            stop = None in rows
+            messages = [row for row in rows if row is not None]
+            try:
+                with connection:
+                    # in the order they came, so the last state of a 
+                    # message wins
+                    for statement, group in itertools.groupby(messages, 
+                                                    lambda item: item[0]):
+                        connection.executemany(statement, 
+                                               [row for s, row in group])
+            except sqlite3.Error, e:
+                # the worker connection belongs to the router thread, so 
+                # log directly in the router log
+                logging.getLogger('psms').error('Unable to record %s messages: '\
+                                                '%s' % (len(messages), e))
+            for row in rows:
+                self.pending.task_done()
+
+            if stop:
+                connection.close()
+                return
+
+
+    def flush(self):
+        """
+            Wait for all the pending messages to be written.
+        """
+        self.pending.join()
+
+
+    def close(self):
+        """
+            Write the pending messages then stop the writing thread.
+        """
+        self.pending.put(None)
+        self.writer.join()
+
+
+    def query(self, sql, params):
+        """
+            Run this query with the connection of the current thread.
+        """
+        connection = getattr(self.readers, 'connection', None)
+        if connection is None:
+            connection = self.readers.connection = self.connect()
+        return connection.execute(sql, params).fetchall()
+
+
+    def to_message(self, row):
+        (id, incoming, number, text, transport, date, response_to, 
+         state, error) = row
+        if incoming:
+            return IncomingMessage(number, text, transport, date, id)
+        message = OutgoingMessage(number, text, transport, date, id, 
+                                  response_to)
+        message.state, message.error = state, error
+        return message
+
+
+    def history(self, number, since=None, limit=100):
+        """
+            Return the messages from and to this number, the latest first,
+            as IncomingMessage and OutgoingMessage objects. Only the ones
+            more recent than the 'since' datetime if it's given. The
+            number is normalized like the ones of the messages are.
+        """
+        number = normalize(number)
+        since = Message.serialize_date(since) if since else ''
+        rows = self.query('SELECT %s FROM %s WHERE m.number = ? AND '\
+                          'm.date >= ? ORDER BY m.date DESC LIMIT ?' % (
+                                                            COLUMNS, TABLES),
+                          (number, since, limit))
+        return [self.to_message(row) for row in rows]
+
+
+    def responses(self, message):
+        """
+            Return the messages sent in response to this message.
+        """
+        id = getattr(message, 'id', message)
+        rows = self.query('SELECT %s FROM %s WHERE m.response_to = ? '\
+                          'ORDER BY m.date' % (COLUMNS, TABLES), (id,))
+        return [self.to_message(row) for row in rows]
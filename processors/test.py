@@ -8,8 +8,11 @@
     message processors work.
 """
 
+import time
+
 from pragmatic_sms.processors.base import MessageProcessor
 from pragmatic_sms.messages import OutgoingMessage, IncomingMessage
+from pragmatic_sms.templates import Template
 
 
 class EchoMessageProcessor(MessageProcessor):
@@ -20,18 +23,22 @@ class EchoMessageProcessor(MessageProcessor):
         It just respond "Echo" + the text you sent to it.
     """
 
+    template = Template(u'Echo "%(text)s"')
+
     def on_receive_message(self, message):
 
-        message.respond(text='Echo "%s"' % message.text)
+        message.respond(text=self.template.render(text=message.text))
 
 
 class CounterMessageProcessor(MessageProcessor):
     """
-        Increment a global counter for each message sent or received.
+        Increment a global counter for each message sent or received, and
+        for each broadcast message.
     """
      
     message_received = 0
     message_sent = 0
+    message_broadcast = 0
 
     def __init__(self, *args, **kwargs):
         """
@@ -51,6 +58,11 @@ class CounterMessageProcessor(MessageProcessor):
         if isinstance(message, OutgoingMessage):
             from pragmatic_sms.processors.test import CounterMessageProcessor
             CounterMessageProcessor.message_sent += 1
+
+
+    def on_send_broadcast(self, message):
+        from pragmatic_sms.processors.test import CounterMessageProcessor
+        CounterMessageProcessor.message_broadcast += 1
         
 
     @classmethod
@@ -59,4 +71,20 @@ class CounterMessageProcessor(MessageProcessor):
             Reset counters to 0
         """
         CounterMessageProcessor.message_received = 0
-        CounterMessageProcessor.message_sent = 0
\ No newline at end of file
+        CounterMessageProcessor.message_sent = 0
+        CounterMessageProcessor.message_broadcast = 0
+
+
+
+class SlowMessageProcessor(MessageProcessor):
+    """
+        Take 'delay' seconds to handle each incoming message, more than its
+        time budget, to test the watchdog of the router.
+    """
+
+    timeout = 0.05
+    delay = 1
+
+    def on_receive_message(self, message):
+        time.sleep(self.delay)
+        return True
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Message processor keeping the outgoing messages in the GSM 7 bits 
+    alphabet, which fits 160 characters in one SMS instead of 70.
+"""
+
+import logging
+
+from pragmatic_sms.processors.base import MessageProcessor
+from pragmatic_sms.encoding import transliterate, analyze, GSM7
+from pragmatic_sms.cache import LRUCache
+from pragmatic_sms.conf import settings
+
+
+ALWAYS = 'always'
+IF_GSM7 = 'gsm7'
+IF_LESS_SEGMENTS = 'segments'
+
+
+class TransliterationMessageProcessor(MessageProcessor):
+    """
+        Replace the characters that are not in the GSM 7 bits alphabet, 
+        like curly quotes or some accented letters, with
+        pragmatic_sms.encoding.transliterate(), according to the policy of
+        the message transport in TRANSLITERATION_POLICIES.
+
+        Campaigns send the same texts again and again, so the new texts
+        are kept in an LRUCache of 'cache_size' texts.
+
+        'transliterated' counts the messages changed, and 'segments_saved'
+        the SMS not sent thanks to it. They are logged every 
+        'report_every' messages changed.
+    """
+
+    def __init__(self, cache_size=10000, report_every=1000):
+        MessageProcessor.__init__(self)
+        self.cache = LRUCache(cache_size)
+        self.report_every = report_every
+        self.transliterated = 0
+        self.segments_saved = 0
+
+
+    def get_policy(self, transport):
+        return settings.TRANSLITERATION_POLICIES.get(transport, 
+                                        settings.TRANSLITERATION_DEFAULT_POLICY)
+
+
+    def convert(self, text, policy):
+        """
+            Return the new text and the number of SMS saved, or None and 0
+            if the policy says the text should not change.
+        """
+        new_text = transliterate(text)
+        if new_text == text:
+            return None, 0
+        encoding, length, segments = analyze(new_text)
+        saved = analyze(text)[2] - segments
+        if (policy == IF_GSM7 and encoding != GSM7) or \
+           (policy == IF_LESS_SEGMENTS and saved <= 0):
+            return None, 0
+        return new_text, saved
+
+
+    def on_send_message(self, message):
+        policy = self.get_policy(message.transport)
+        if not policy or message.fits_gsm7:
+            return
+
+        key = (policy, message.text)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.convert(message.text, policy)
+            self.cache.set(key, result)
+
+        text, saved = result
+        if text is not None:
+            message.text = text
+            self.transliterated += 1
+            self.segments_saved += saved
+            if self.transliterated % self.report_every == 0:
+                self.report()
+
+
+    def report(self):
+        self.worker.log(logging.INFO, 'Transliteration saved %s SMS on %s '\
+                        'messages' % (self.segments_saved, self.transliterated))
+
+
+    def close(self):
+        if self.transliterated:
+            self.report()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Put back together the parts of long incoming messages, which phones
+    send as several SMS, so message processors only see whole messages.
+    See MessageTransport.receive_fragment().
+"""
+
+import time
+
+from collections import deque, namedtuple
+
+
+# 'complete' is False if some parts never arrived
+Reassembled = namedtuple('Reassembled', 'author text complete')
+
+
+class ReassemblyBuffer(object):
+    """
+        Keep the parts of concatenated messages, by author, reference and
+        total number of parts, until all of them arrived.
+
+        Incomplete messages are flushed with the parts that arrived after
+        'timeout' seconds, or, oldest first, when more than 'max_fragments'
+        parts are held, so a phone sending garbage can't make it grow
+        forever.
+
+        'held' is the number of parts held, 'completed', 'flushed' and
+        'duplicates' count what happened since the buffer was created.
+    """
+
+    def __init__(self, timeout=3600, max_fragments=10000):
+        self.timeout = timeout
+        self.max_fragments = max_fragments
+        # key: (created, {sequence: text})
+        self.messages = {}
+        # (created, key) from the oldest to the most recent message
+        self.order = deque()
+        self.held = 0
+        self.completed = self.flushed = self.duplicates = 0
+
+
+    def __len__(self):
+        return len(self.messages)
+
+
+    def add(self, author, reference, total, sequence, text, now=None):
+        """
+            Keep this part and return the list of Reassembled messages which
+            are now complete, and of the ones flushed to make room.
+        """
+        now = now or time.time()
+        key = (author, reference, total)
+
+        entry = self.messages.get(key)
+        if entry is None:
+            entry = self.messages[key] = (now, {})
+            self.order.append((now, key))
+            if len(self.order) > 2 * len(self.messages) + 1000:
+                self.compact()
+
+        parts = entry[1]
+        if sequence in parts:
+            self.duplicates += 1
+            return []
+        parts[sequence] = text
+        self.held += 1
+
+        if len(parts) == total:
+            self.pop(key)
+            self.completed += 1
+            return [Reassembled(author, self.join(parts), True)]
+
+        flushed = []
+        while self.held > self.max_fragments:
+            flushed.extend(self.flush_oldest())
+        return flushed
+
+
+    def expire(self, now=None):
+        """
+            Return the list of Reassembled messages which waited for their
+            missing parts for more than 'timeout' seconds.
+        """
+        limit = (now or time.time()) - self.timeout
+        expired = []
+        while self.order and self.order[0][0] <= limit:
+            expired.extend(self.flush_oldest())
+        return expired
+
+
+    def flush_oldest(self):
+        created, key = self.order.popleft()
+        entry = self.messages.get(key)
+        # the message may have been completed, or started again since
+        if entry is None or entry[0] != created:
+            return []
+        self.pop(key)
+        self.flushed += 1
+        return [Reassembled(key[0], self.join(entry[1]), False)]
+
+
+    def compact(self):
+        """
+            Remove the completed messages from self.order, which are
+            otherwise only removed once they are the oldest.
+        """
+        self.order = deque((created, key) for created, key in self.order
+                           if self.messages.get(key, (None,))[0] == created)
+
+
+    def pop(self, key):
+        created, parts = self.messages.pop(key)
+        self.held -= len(parts)
+        return parts
+
+
+    def join(self, parts):
+        return u''.join(parts[i] for i in sorted(parts))
+
+
+    def stats(self):
+        return {'messages': len(self.messages), 'fragments': self.held,
+                'completed': self.completed, 'flushed': self.flushed,
+                'duplicates': self.duplicates}
@@ -22,8 +22,17 @@ from kombu.exceptions import NotBoundError
 from pragmatic_sms.settings.dictconfig import dictConfig
 dictConfig(settings.LOGGING)
 
-from messages import MessageWorker
+from cache import LRUCache
+from coalescing import Coalescer
+from duplicates import DuplicateFilter
+from messages import MessageWorker, OutgoingMessage, BroadcastMessage
+from processors.base import MessageProcessor
+from states import store, QUEUED, RELAYED, FAILED
 from workers import PSMSWorker, WorkerError
+from transports.pool import SenderPool
+from transports.supervisor import supervisor
+from transports.health import HealthTable
+from watchdog import Watchdog, RETRY_KEY
 
 
 class RoutingError(WorkerError):
@@ -36,7 +45,29 @@ class SmsRouter(PSMSWorker):
 
         Start and stop the message processors and transports. 
 
-        Each transport are started as separated child processes.
+        Each transport are started as separated child processes, all at once,
+        and the router waits for them to be connected to the message broker
+        before listening for messages. Transports
+        can have several processes sending messages, the router starts and
+        stops them according to the number of messages waiting to be sent.
+
+        Transports processes send heartbeats to the router, which keeps 
+        their health in self.health and restarts the ones that crashed 
+        or stalled.
+
+        The router records the state of the outgoing messages in 
+        self.message_states as they go through it and as transports and
+        processors publish them.
+
+        Depending on the settings, it drops the outgoing messages sent
+        twice (OUTGOING_DUPLICATES_WINDOW) and merges the ones sent to the
+        same recipient within a few seconds (OUTGOING_COALESCE_DELAY).
+        Expired outgoing messages are never relayed, see OutgoingMessage.
+        Broadcast messages are relayed by chunks of recipients, see 
+        BroadcastMessage.
+
+        Message processors running for too long are interrupted, see
+        PROCESSORS_TIMEOUT and pragmatic_sms.watchdog.
     """
 
     name = "SMS router"
@@ -47,6 +78,32 @@ class SmsRouter(PSMSWorker):
         self.no_transports = no_transports
 
         self.transports = self.get_transports()
+        self.sender_pools = self.get_sender_pools()
+
+        self.health = HealthTable(settings.TRANSPORTS_STALL_DELAY,
+                                  settings.TRANSPORTS_RESTART_MIN_DELAY,
+                                  settings.TRANSPORTS_RESTART_MAX_DELAY)
+        self.last_health_check = 0
+
+        self.message_states = store
+
+        # the queues of the processes waiting for responses
+        self.reply_queues = LRUCache(1000)
+
+        # outgoing messages which expired before being relayed
+        self.expired = 0
+
+        self.outgoing_duplicates = None
+        if settings.OUTGOING_DUPLICATES_WINDOW:
+            self.outgoing_duplicates = DuplicateFilter(
+                                        settings.OUTGOING_DUPLICATES_WINDOW,
+                                        settings.OUTGOING_DUPLICATES_MAX_SIZE)
+
+        self.coalescer = None
+        if settings.OUTGOING_COALESCE_DELAY:
+            self.coalescer = Coalescer(settings.OUTGOING_COALESCE_DELAY,
+                                       settings.OUTGOING_COALESCE_MAX_SEGMENTS,
+                                       settings.OUTGOING_COALESCE_MAX_PENDING)
 
         PSMSWorker.__init__(self, *args, **kwargs)
 
@@ -85,6 +142,19 @@ class SmsRouter(PSMSWorker):
         mps = (import_class(mp) for mp in settings.MESSAGE_PROCESSORS)
         self.message_processors = [mp() for mp in mps]
 
+        # the processors which want to know the states of the messages
+        default = MessageProcessor.on_message_state.im_func
+        self.message_states.listeners = [mp.on_message_state 
+                        for mp in self.message_processors
+                        if mp.on_message_state.im_func is not default]
+
+        # the callbacks of the processors are run with a time budget
+        self.watchdog = Watchdog(settings.PROCESSORS_TIMEOUT,
+                                 settings.PROCESSORS_QUARANTINE_AFTER,
+                                 settings.PROCESSORS_QUARANTINE_DELAY,
+                                 self.logger)
+        guard = self.watchdog.wrap
+
         # Just a log loop to say that we do
         mps = (mp.rsplit('.', 1)[1] for mp in settings.MESSAGE_PROCESSORS)
         self.logger.info('Loading message processors: %s' % ', '.join(mps))
@@ -95,8 +165,9 @@ class SmsRouter(PSMSWorker):
         c = consumers['incoming_messages'] = Consumer(self.channel, queue)
 
         for mp in self.message_processors:
-            c.register_callback(mp.handle_incoming_message)
+            c.register_callback(guard(mp, mp.handle_incoming_message))
 
+        c.register_callback(self.requeue_interrupted_message)
         c.consume()
 
         # Create the consumer for incoming messages and attach the callback
@@ -106,12 +177,25 @@ class SmsRouter(PSMSWorker):
         queue = self.queues['outgoing_messages']
         c = consumers['outgoing_messages'] = Consumer(self.channel, queue)
 
+        c.register_callback(self.record_outgoing_message)
+
         for mp in self.message_processors:
-            c.register_callback(mp.handle_outgoing_message)
+            c.register_callback(guard(mp, mp.handle_outgoing_message))
 
         c.register_callback(self.relay_message_to_transport)
         c.consume()
 
+        # Same thing for broadcast messages, which the router sends to
+        # their recipients by chunks
+        queue = self.queues['broadcast_messages']
+        c = consumers['broadcast_messages'] = Consumer(self.channel, queue)
+
+        for mp in self.message_processors:
+            c.register_callback(guard(mp, mp.handle_broadcast_message))
+
+        c.register_callback(self.relay_broadcast_chunk)
+        c.consume()
+
         # Create the consumer for the log messages and attach a callback
         # from the SMS router: all messages sent to this queue are going
         # to be logged in the router log
@@ -119,6 +203,18 @@ class SmsRouter(PSMSWorker):
         consumers['logs'].register_callback(self.handle_log)
         consumers['logs'].consume()
 
+        # Create the consumer for the states of the outgoing messages
+        consumers['message_states'] = Consumer(self.channel, 
+                                               self.queues['message_states'])
+        consumers['message_states'].register_callback(self.handle_message_states)
+        consumers['message_states'].consume()
+
+        # Create the consumer for the heartbeats of the transports processes
+        consumers['heartbeats'] = Consumer(self.channel, 
+                                           self.queues['heartbeats'])
+        consumers['heartbeats'].register_callback(self.handle_heartbeat)
+        consumers['heartbeats'].consume()
+
         # attach a fall back functions to handle message that kombu can't deliver
         queue = self.queues['undelivered_kombu_message']
         c = consumers['undeliverd_kombu_messages'] = Consumer(self.channel, 
@@ -141,34 +237,171 @@ class SmsRouter(PSMSWorker):
         return transports
 
 
+    def get_sender_pools(self):
+        """
+            Return a dict of sender pools, one for each transport, configured
+            with the 'senders' entry of the transport settings.
+        """
+        pools = {}
+        for name, transport in self.transports.iteritems():
+            conf = settings.MESSAGE_TRANSPORTS[name].get('senders')
+            pools[name] = SenderPool.from_settings(transport, conf)
+        return pools
+
+
     def on_main_loop(self):
         if not self.no_transports:
             self.start_transports_daemons()
-            time.sleep(1)
 
 
-    def on_worker_stops(self):
+    def on_main_loop_iteration(self):
+        if not self.no_transports:
+            self.adjust_sender_pools()
+            self.check_transports_health()
+        if self.coalescer is not None:
+            for pending in self.coalescer.flush():
+                self.relay(pending.body, pending.messages, pending.merged_ids)
+
+
+    def on_worker_stopped(self):
         if not self.no_transports:
             self.stop_transports_daemons()
+        self.message_states.listeners = []
+        for mp in getattr(self, 'message_processors', ()):
+            mp.close()
 
 
     def start_transports_daemons(self):
         """
-            Start the transports daemons as separate processes
+            Start the transports daemons as separate processes, in parallel,
+            and wait for all of them to be ready.
         """
-        self.transports = {}
-        for name, transport in self.transports.iteritems():
-            self.logger.info('Start transport: %s' % name)
-            transport.start_daemons()
+        with supervisor.parallel():
+            for name, transport in self.transports.iteritems():
+                self.logger.info('Start transport: %s' % name)
+                transport.start_receiving_messages_daemon()
+                self.sender_pools[name].start()
 
 
     def stop_transports_daemons(self):
         """
-            Stop the transports daemons.
+            Stop the transports daemons, in parallel.
         """
-        for name, transport in self.transports.iteritems():
-            self.logger.info('Stop transport: %s' % name)
-            transport.stop_daemons()
+        with supervisor.parallel():
+            for name, transport in self.transports.iteritems():
+                self.logger.info('Stop transport: %s' % name)
+                transport.stop_receiving_messages_daemon()
+                self.sender_pools[name].stop()
+
+
+    def adjust_sender_pools(self):
+        """
+            Give each sender pool the number of messages waiting in its 
+            transport queue so it can start or stop senders.
+        """
+        for name, pool in self.sender_pools.iteritems():
+            if pool.is_due():
+                backlog = self.get_queue_size('%s_transport' % name)
+                before = pool.senders
+                after = pool.adjust(backlog)
+                if before != after:
+                    self.logger.info('Transport "%s" now has %s senders '\
+                                     '(%s messages waiting)' % (name, after, 
+                                                                backlog))
+
+
+    def check_transports_health(self):
+        """
+            Restart the transports processes that crashed or stopped 
+            sending heartbeats, if their restart backoff delay is over.
+
+            A process that exited normally, like a receiving loop with
+            nothing to do, is not restarted.
+
+            The router doesn't wait for the new processes to be ready, 
+            which is checked at the next calls instead, so it keeps routing
+            messages in the meantime.
+        """
+        now = time.time()
+        if now - self.last_health_check < 1:
+            return
+        self.last_health_check = now
+
+        for key in self.health.entries.keys():
+            if key not in supervisor.processes:
+                self.health.forget(key)
+
+        for key in supervisor.check_unready(now):
+            self.logger.error('Transport process %s_%s_%s not ready after '\
+                              'being restarted. Check its stderr file.' % key)
+
+        for key in supervisor.processes.keys():
+
+            code = supervisor.exit_code(*key)
+            if code not in (None, 0):
+                reason = 'exited with code %s' % code
+            elif self.health.is_stalled(key, now):
+                reason = 'stalled'
+            else:
+                continue
+
+            if not self.health.can_restart(key, now):
+                continue
+
+            self.logger.warning('Transport process %s_%s_%s %s, restarting it' %
+                                (key + (reason,)))
+            self.health.restarted(key, now)
+            supervisor.respawn_process(*key)
+
+
+    def handle_heartbeat(self, body, message):
+        """
+            Record the heartbeat of a transport process in the health table.
+        """
+        self.health.update(body)
+        message.ack()
+
+
+    def record_outgoing_message(self, body, message):
+        """
+            Record that the router got this outgoing message, before the
+            message processors see it, and cancel it if it's a duplicate.
+        """
+        self.message_states.update(body.get('id'), QUEUED, 
+                                   transport=body.get('transport'))
+        if self.outgoing_duplicates is not None and not body.get('cancelled'):
+            if self.outgoing_duplicates.is_duplicate(OutgoingMessage(**body)):
+                body['cancelled'] = 'duplicate'
+
+
+    def requeue_interrupted_message(self, body, message):
+        """
+            Put back in the queue the incoming message a processor was
+            interrupted with, unless another processor acknowledged it, so 
+            it's not left unacknowledged until the router stops. Only the
+            interrupted processors get it again, until they are in
+            quarantine: the others already handled it.
+
+            The message is published again then acknowledged rather than
+            requeued: kombu virtual transports lose track of a message
+            requeued twice.
+        """
+        if self.watchdog.interrupted is message:
+            self.watchdog.interrupted = None
+            if not message.acknowledged:
+                body = dict(body)
+                body[RETRY_KEY] = self.watchdog.interrupted_by
+                self.producers['psms'].publish(body=body, 
+                                               routing_key="incoming_messages")
+                message.ack()
+
+
+    def handle_message_states(self, body, message):
+        """
+            Record the states published by the transports and processors.
+        """
+        self.message_states.handle(body)
+        message.ack()
 
 
     def relay_message_to_transport(self, body, message):
@@ -182,14 +415,124 @@ class SmsRouter(PSMSWorker):
 
             For this reason, it should be the last callback on the outgoing
             messages queue and set the message as 'acknowledged'.
+
+            Messages cancelled by a message processor are recorded as failed
+            and not relayed, and so are expired messages, which are 
+            published on the 'expired_messages' queue. Messages which are 
+            not responses are given to the coalescer, if any, which tells 
+            when to relay them.
         """
-        key = "%s_transport" % body['transport']
+        if body.get('cancelled'):
+            self.message_states.update(body.get('id'), FAILED,
+                                       error=body['cancelled'])
+            message.ack()
+            return
 
+        if OutgoingMessage.body_expired(body):
+            self.expired += 1
+            self.message_states.update(body.get('id'), FAILED, error='expired')
+            self.producers['psms'].publish(body=body, 
+                                           routing_key="expired_messages")
+            message.ack()
+            return
 
-        self.producers['psms'].publish(body=body, routing_key=key) 
+        if self.coalescer is not None and not body.get('response_to'):
+            for pending in self.coalescer.add(body, message):
+                self.relay(pending.body, pending.messages, pending.merged_ids)
+            return
+
+        self.relay(body, [message])
+
+
+    def relay_broadcast_chunk(self, body, message):
+        """
+            Create the messages for the next BROADCAST_CHUNK_SIZE recipients
+            of a broadcast message and relay them to the transport, then
+            put the broadcast back at the end of the queue with the offset
+            of the next chunk. 
+
+            This way a large broadcast doesn't hold the other messages, and
+            if the router stops the broker gives back the broadcast where
+            it was. 
+
+            Message processors filter the recipients of each chunk, see 
+            MessageProcessor.filter_broadcast_recipients(). The broadcast
+            is recorded as relayed once all the recipients got it.
+        """
+        broadcast = BroadcastMessage(**body)
+
+        if not broadcast.offset:
+            self.message_states.update(broadcast.id, QUEUED, 
+                                       transport=broadcast.transport)
+
+        if not broadcast.cancelled and broadcast.expired:
+            self.expired += 1
+            broadcast.cancel('expired')
+
+        if broadcast.cancelled:
+            self.message_states.update(broadcast.id, FAILED, 
+                                       error=broadcast.cancelled)
+            message.ack()
+            return
+
+        recipients = broadcast.next_chunk(settings.BROADCAST_CHUNK_SIZE)
+        if not recipients:
+            self.message_states.update(broadcast.id, RELAYED)
+            message.ack()
+            return
+
+        for mp in self.message_processors:
+            recipients = mp.filter_broadcast_recipients(broadcast, recipients)
+        for recipient in recipients:
+            self.relay(broadcast.create_message(recipient).to_dict(), [])
+
+        self.producers['psms'].publish(body=broadcast.to_dict(), 
+                                       routing_key="broadcast_messages")
         message.ack()
 
 
+    def relay(self, body, messages, merged_ids=()):
+        """
+            Publish this outgoing message body to its transport queue, then
+            acknowledge the broker messages it was made of. 
+
+            Messages merged into it are recorded as relayed too, but their
+            later states are only recorded for the message they were merged
+            into.
+        """
+        key = "%s_transport" % body['transport']
+
+        self.producers['psms'].publish(body=body, routing_key=key) 
+        self.message_states.update(body.get('id'), RELAYED)
+        for id in merged_ids:
+            self.message_states.update(id, RELAYED)
+
+        response_to = body.get('response_to') or {}
+        if response_to.get('reply_to'):
+            self.copy_response(body, response_to['reply_to'])
+
+        # held messages are not acknowledged before, so the broker gives
+        # them back if the router stops meanwhile
+        for message in messages:
+            message.ack()
+
+
+    def copy_response(self, body, reply_to):
+        """
+            Send a copy of an outgoing message to the queue of the process
+            waiting for a response to the incoming message.
+
+            The queue is declared here as well, because some brokers keep
+            the bindings in the memory of each process.
+        """
+        if reply_to not in self.reply_queues:
+            Queue(reply_to, exchange=self.exchanges['psms'], 
+                  routing_key=reply_to, durable=False,
+                  auto_delete=True)(self.channel).declare()
+            self.reply_queues.set(reply_to, True)
+        self.producers['psms'].publish(body=body, routing_key=reply_to)
+
+
     def handle_undelivered_kombu_message(self, body, message):
         """
             Called when a message is delivered to a transport exchange but
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Keep some state per phone number between messages, for dialogs that
+    take several messages like a registration:
+
+        class RegistrationProcessor(MessageProcessor):
+
+            def on_receive_message(self, message):
+                session = self.session(message.author)
+                if 'name' not in session:
+                    session['name'] = message.text
+                    session.save()
+                    message.respond('What is your age?')
+                ...
+
+    Sessions live in memory and expire after SESSIONS_TTL seconds without
+    being saved. The expired ones are purged as sessions are saved. If SESSIONS_PATH is set, they are written to an SQLite
+    database as well, so they survive a restart and several processes
+    using the same database see each other's changes.
+"""
+
+import sys
+import time
+import uuid
+import sqlite3
+import cPickle as pickle
+
+from pragmatic_sms.cache import LRUCache, VALUE
+from pragmatic_sms.conf import settings
+from pragmatic_sms.watchdog import uninterruptible
+
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        namespace TEXT,
+        key TEXT,
+        version TEXT,
+        updated REAL,
+        data BLOB,
+        PRIMARY KEY (namespace, key)
+    )
+"""
+
+
+class Session(dict):
+    """
+        A dict of the data of a session. Changes are kept in memory only
+        until save() is called.
+    """
+
+    def __init__(self, store, key, data=(), version=None):
+        dict.__init__(self, data)
+        self.store = store
+        self.key = key
+        self.version = version
+
+
+    def save(self):
+        self.store.save(self)
+
+
+    def delete(self):
+        """
+            Remove all the data of this session, everywhere.
+        """
+        self.clear()
+        self.store.delete(self.key)
+
+
+
+class SessionStore(object):
+    """
+        Sessions of one namespace, in an LRUCache of 'max_size' entries
+        expiring after 'ttl' seconds.
+
+        With a 'path', each save() writes the session to the database with
+        a new version token. Getting a cached session then costs one lookup
+        by primary key to check its version, and the session is only
+        loaded again if another process saved it in the meantime.
+
+        save() removes the expired sessions, from memory and from the
+        database, at most every 'expire_interval' seconds.
+    """
+
+    expire_interval = 60
+
+    def __init__(self, namespace='default', max_size=None, ttl=None,
+                 path=None):
+        self.namespace = namespace
+        self.ttl = settings.SESSIONS_TTL if ttl is None else ttl
+        self.path = path or settings.SESSIONS_PATH
+        self.cache = LRUCache(max_size or settings.SESSIONS_MAX_SIZE, self.ttl)
+        self.connection = None
+        self.expired = 0
+        if self.path:
+            self.connection = sqlite3.connect(self.path, timeout=30)
+            self.connection.execute(SCHEMA)
+            self.connection.commit()
+
+
+    def get(self, key, now=None):
+        """
+            Return the Session of this key, an empty one if it doesn't
+            exist or expired.
+        """
+        now = now or time.time()
+        session = self.cache.get(key, now=now)
+
+        if self.connection is None:
+            if session is None:
+                session = Session(self, key)
+                self.cache.set(key, session, now=now)
+            return session
+
+        row = self.connection.execute('SELECT version, updated FROM sessions '\
+                                      'WHERE namespace = ? AND key = ?',
+                                      (self.namespace, key)).fetchone()
+        if row is None or (self.ttl is not None and row[1] + self.ttl <= now):
+            if session is None or session.version is not None:
+                session = Session(self, key)
+                self.cache.set(key, session, now=now)
+            return session
+
+        if session is None or session.version != row[0]:
+            data, = self.connection.execute('SELECT data FROM sessions '\
+                                            'WHERE namespace = ? AND key = ?',
+                                            (self.namespace, key)).fetchone()
+            session = Session(self, key, pickle.loads(str(data)), row[0])
+            self.cache.set(key, session, ttl=row[1] + self.ttl - now
+                                             if self.ttl is not None else None,
+                           now=now)
+        return session
+
+
+    def save(self, session, now=None):
+        now = now or time.time()
+        if self.connection is not None:
+            session.version = uuid.uuid4().hex
+            data = pickle.dumps(dict(session), pickle.HIGHEST_PROTOCOL)
+            with uninterruptible():
+                with self.connection:
+                    self.connection.execute('INSERT OR REPLACE INTO sessions '\
+                                            'VALUES (?, ?, ?, ?, ?)',
+                                            (self.namespace, session.key,
+                                             session.version, now,
+                                             sqlite3.Binary(data)))
+        self.cache.set(session.key, session, now=now)
+        if now - self.expired >= self.expire_interval:
+            self.expire(now)
+
+
+    def delete(self, key):
+        self.cache.pop(key)
+        if self.connection is not None:
+            with uninterruptible():
+                with self.connection:
+                    self.connection.execute('DELETE FROM sessions WHERE '\
+                                            'namespace = ? AND key = ?',
+                                            (self.namespace, key))
+
+
+    def expire(self, now=None):
+        """
+            Remove the expired sessions from memory and from the database.
+        """
+        now = now or time.time()
+        self.expired = now
+        self.cache.expire(now)
+        if self.connection is not None and self.ttl is not None:
+            with uninterruptible():
+                with self.connection:
+                    self.connection.execute('DELETE FROM sessions WHERE '\
+                                            'namespace = ? AND updated <= ?',
+                                            (self.namespace, now - self.ttl))
+
+
+    def stats(self):
+        """
+            Return a dict with the number of sessions in memory, an estimate
+            of the memory they use in bytes, and the cache hit rate.
+        """
+        memory = 0
+        for link in self.cache.entries.itervalues():
+            session = link[VALUE]
+            memory += sys.getsizeof(session)
+            for key, value in session.iteritems():
+                memory += sys.getsizeof(key) + sys.getsizeof(value)
+        lookups = self.cache.hits + self.cache.misses
+        return {'size': len(self.cache), 'memory': memory,
+                'hits': self.cache.hits, 'misses': self.cache.misses,
+                'evictions': self.cache.evictions,
+                'hit_rate': float(self.cache.hits) / lookups if lookups else 0}
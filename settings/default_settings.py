@@ -24,6 +24,148 @@ MESSAGE_TRANSPORTS = {
 }
 
 
+# Number of seconds the router waits for the transports processes to
+# be connected to the message broker when it starts them
+TRANSPORTS_READY_TIMEOUT = 10
+
+
+# Transports processes send a heartbeat to the router every
+# HEARTBEAT_INTERVAL seconds. The router restarts the ones that don't
+# for TRANSPORTS_STALL_DELAY seconds, or that crash, waiting longer 
+# each time, up to TRANSPORTS_RESTART_MAX_DELAY seconds
+HEARTBEAT_INTERVAL = 5
+TRANSPORTS_STALL_DELAY = 30
+TRANSPORTS_RESTART_MIN_DELAY = 1
+TRANSPORTS_RESTART_MAX_DELAY = 300
+
+
+# Transports dispatching incoming messages with dispatch_messages() wait 
+# before publishing more if more than INCOMING_MESSAGES_HIGH_WATERMARK 
+# messages are waiting to be processed. None disables it: use it only with
+# a broker giving the real size of its queues, which sqlakombu doesn't
+# as it counts the messages already consumed
+INCOMING_MESSAGES_HIGH_WATERMARK = None
+
+# Same thing for the campaigns sending messages from a CSV file, see 
+# pragmatic_sms.campaigns, and the outgoing message queue
+OUTGOING_MESSAGES_HIGH_WATERMARK = None
+
+
+# The router keeps the state of the last MESSAGE_STATES_MAX_SIZE outgoing
+# messages in memory, see pragmatic_sms.states
+MESSAGE_STATES_MAX_SIZE = 1000000
+
+
+# Max number of incoming messages a process can wait responses for at once,
+# see IncomingMessage.dispatch()
+RESPONSES_MAX_PENDING = 10000
+
+
+# SQLite database of pragmatic_sms.processors.store.MessageStoreProcessor,
+# TEMP_DIR/messages.db if None
+MESSAGE_STORE_PATH = None
+
+
+# Message processors keep the session of at most SESSIONS_MAX_SIZE numbers
+# in memory, forgotten SESSIONS_TTL seconds after they were last saved.
+# If SESSIONS_PATH is set, sessions are saved in this SQLite database as
+# well, and processes sharing it see each other's sessions
+SESSIONS_MAX_SIZE = 10000
+SESSIONS_TTL = 3600
+SESSIONS_PATH = None
+
+
+# pragmatic_sms.processors.blocklist.BlocklistMessageProcessor adds the 
+# authors of messages which are one of BLOCKLIST_KEYWORDS to the blocklist 
+# stored at BLOCKLIST_PATH, TEMP_DIR/blocklist if None
+BLOCKLIST_PATH = None
+BLOCKLIST_KEYWORDS = ('STOP', 'UNSUBSCRIBE')
+
+
+# Phone numbers of messages are normalized to their E.164 form, see
+# pragmatic_sms.phone. Numbers without international prefix have the 
+# PHONE_TRUNK_PREFIX removed and PHONE_COUNTRY_CODE added, if it is set,
+# unless they are short codes
+PHONE_NORMALIZATION = True
+PHONE_COUNTRY_CODE = None
+PHONE_TRUNK_PREFIX = '0'
+PHONE_INTERNATIONAL_PREFIXES = ('00',)
+PHONE_SHORT_CODE_MAX_LENGTH = 6
+
+
+# pragmatic_sms.processors.transliteration.TransliterationMessageProcessor 
+# replaces the characters of the outgoing messages which are not in the 
+# GSM 7 bits alphabet by close ones, according to the policy of their 
+# transport in TRANSLITERATION_POLICIES, or TRANSLITERATION_DEFAULT_POLICY:
+# - None: never;
+# - 'gsm7': if the new text fits in GSM 7 bits;
+# - 'segments': if the new text takes less SMS;
+# - 'always': replace all the characters it can, even if it saves nothing.
+TRANSLITERATION_POLICIES = {}
+TRANSLITERATION_DEFAULT_POLICY = None
+
+
+# Transports keep the parts of long incoming messages until all of them 
+# arrived, or for REASSEMBLY_TIMEOUT seconds, and at most 
+# REASSEMBLY_MAX_FRAGMENTS parts, see MessageTransport.receive_fragment()
+REASSEMBLY_TIMEOUT = 3600
+REASSEMBLY_MAX_FRAGMENTS = 10000
+
+
+# If DUPLICATES_WINDOW is set, incoming messages with the same author and 
+# text as one received less than DUPLICATES_WINDOW seconds before are 
+# dropped before being dispatched, see pragmatic_sms.duplicates. The 
+# fingerprints of the last DUPLICATES_MAX_SIZE messages are kept. It's off
+# by default as people do send the same text twice on purpose, like "YES"
+DUPLICATES_WINDOW = None
+DUPLICATES_MAX_SIZE = 100000
+
+
+# The router drops the outgoing messages with the same recipient and text
+# as one queued less than OUTGOING_DUPLICATES_WINDOW seconds before, if set
+OUTGOING_DUPLICATES_WINDOW = None
+OUTGOING_DUPLICATES_MAX_SIZE = 100000
+
+
+# If OUTGOING_COALESCE_DELAY is set, the router holds the outgoing messages
+# which are not responses for this number of seconds and merges the ones 
+# for the same recipient meanwhile, as long as the text fits in 
+# OUTGOING_COALESCE_MAX_SEGMENTS SMS. At most OUTGOING_COALESCE_MAX_PENDING
+# recipients have messages held. See pragmatic_sms.coalescing
+OUTGOING_COALESCE_DELAY = None
+OUTGOING_COALESCE_MAX_SEGMENTS = 1
+OUTGOING_COALESCE_MAX_PENDING = 10000
+
+
+# Outgoing messages created without 'ttl' nor 'expires_at' expire
+# OUTGOING_MESSAGES_TTL seconds after their creation, if set. Expired 
+# messages are not sent: they are recorded as failed and published on the
+# 'expired_messages' queue instead
+OUTGOING_MESSAGES_TTL = None
+
+# The router sends broadcast messages to BROADCAST_CHUNK_SIZE recipients at
+# a time, between the other messages, see BroadcastMessage
+BROADCAST_CHUNK_SIZE = 1000
+
+
+# The router interrupts message processors handling a message for more 
+# than PROCESSORS_TIMEOUT seconds, unless they set their own 'timeout'. 
+# After PROCESSORS_QUARANTINE_AFTER timeouts in a row, a processor is 
+# skipped for PROCESSORS_QUARANTINE_DELAY seconds. See 
+# pragmatic_sms.watchdog
+PROCESSORS_TIMEOUT = 5
+PROCESSORS_QUARANTINE_AFTER = 3
+PROCESSORS_QUARANTINE_DELAY = 300
+
+# If set, the broker itself drops the messages waiting for more than 
+# TRANSPORT_QUEUES_TTL seconds in the queues of the transports, with the
+# 'x-message-ttl' argument of AMQP brokers like RabbitMQ. These are not
+# counted nor published on 'expired_messages', so make it longer than the
+# TTL of the messages. Queues declared with another value must be deleted 
+# first
+TRANSPORT_QUEUES_TTL = None
+
+
 # Check http://packages.python.org/kombu/reference/kombu.connection.html
 # for a list of all the available message broker
 # 'memory' is requires no setup and fits well for dev while 'rabbitmq' is
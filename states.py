@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Keep track of the state of the outgoing messages, from the moment the
+    router gets them to the moment the operator tells whether they were
+    delivered or not.
+
+    The router records the states in the 'store' singleton as they are
+    published on the 'message_states' queue. Message processors run in
+    the router process, so they can query it:
+
+        from pragmatic_sms.states import store, DELIVERED
+
+        state = store.get(message.id)
+        if state and state.state == DELIVERED:
+            ...
+"""
+
+import time
+import uuid
+
+from collections import deque, namedtuple
+
+from pragmatic_sms.conf import settings
+
+
+# the router received the message from the application
+QUEUED = 'queued'
+# the message is in the queue of its transport
+RELAYED = 'relayed'
+# the transport gave the message to the operator
+SUBMITTED = 'submitted'
+# the operator delivered the message, or will never do it
+DELIVERED = 'delivered'
+FAILED = 'failed'
+
+STATES = (QUEUED, RELAYED, SUBMITTED, DELIVERED, FAILED)
+
+# messages are published and consumed by several processes so their
+# states can arrive out of order: a state never replaces a later one
+RANKS = {QUEUED: 0, RELAYED: 1, SUBMITTED: 2, DELIVERED: 3, FAILED: 3}
+
+FINAL_STATES = (DELIVERED, FAILED)
+
+
+MessageState = namedtuple('MessageState', 'id state updated smsc_id error')
+
+
+def compact_id(id):
+    """
+        Message ids are usually UUIDs, stored as integers, which take half
+        the memory of their 36 characters. Other ids are kept as is.
+    """
+    try:
+        return uuid.UUID(id).int
+    except (ValueError, TypeError, AttributeError):
+        return id
+
+
+def expand_id(key):
+    if isinstance(key, (int, long)):
+        return str(uuid.UUID(int=key))
+    return key
+
+
+class MessageStateStore(object):
+    """
+        The last state of each message, indexed by message id and by the id
+        the operator gave to the message, as delivery receipts only refer
+        to the later. Both lookups are dict lookups.
+
+        Each record is a tuple (state, updated, smsc key, error). Only the
+        last 'max_size' messages are kept, the oldest ones being forgotten
+        first.
+
+        The functions in 'listeners' are called with the MessageState of
+        each state recorded, like the router does for the message 
+        processors (see MessageProcessor.on_message_state()).
+    """
+
+    def __init__(self, max_size=1000000):
+        self.max_size = max_size
+        self.records = {}
+        self.smsc_index = {}
+        self.history = deque()
+        self.counts = dict((state, 0) for state in STATES)
+        self.listeners = []
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def update(self, message_id=None, state=None, smsc_id=None, transport=None,
+               error=None, now=None):
+        """
+            Record the new state of a message, known either by its id or by
+            the id the operator of its transport gave it.
+
+            Return False if the message is unknown or if this state is older
+            than the one already recorded.
+        """
+        assert state in RANKS, 'Unknown message state: %s' % state
+
+        smsc_key = (transport, smsc_id) if smsc_id is not None else None
+
+        if message_id is None:
+            key = self.smsc_index.get(smsc_key)
+            if key is None:
+                return False
+        else:
+            key = compact_id(message_id)
+
+        record = self.records.get(key)
+
+        if record is None:
+            self.history.append(key)
+            if len(self.history) > self.max_size:
+                self.forget(self.history.popleft())
+        else:
+            current = record[0]
+            if current in FINAL_STATES or RANKS[state] < RANKS[current]:
+                return False
+            self.counts[current] -= 1
+            smsc_key = smsc_key or record[2]
+
+        if smsc_key is not None:
+            self.smsc_index[smsc_key] = key
+
+        updated = now or time.time()
+        self.records[key] = (state, updated, smsc_key, error)
+        self.counts[state] += 1
+
+        if self.listeners:
+            recorded = MessageState(expand_id(key), state, updated,
+                                    smsc_key and smsc_key[1], error)
+            for listener in self.listeners:
+                listener(recorded)
+        return True
+
+
+    def forget(self, key):
+        record = self.records.pop(key, None)
+        if record is not None:
+            self.counts[record[0]] -= 1
+            self.smsc_index.pop(record[2], None)
+
+
+    def get(self, message_id):
+        """
+            Return the MessageState of the message with this id, or None
+            if it's unknown.
+        """
+        key = compact_id(message_id)
+        record = self.records.get(key)
+        if record is None:
+            return None
+        state, updated, smsc_key, error = record
+        return MessageState(message_id, state, updated,
+                            smsc_key and smsc_key[1], error)
+
+
+    def get_by_smsc_id(self, transport, smsc_id):
+        """
+            Return the MessageState of the message the operator of this
+            transport knows with this id, or None if it's unknown.
+        """
+        key = self.smsc_index.get((transport, smsc_id))
+        if key is None:
+            return None
+        return self.get(expand_id(key))
+
+
+    def handle(self, body):
+        """
+            Record the states in the body of a message from the
+            'message_states' queue, which holds one state or a batch
+            of them.
+        """
+        for data in body.get('batch', (body,)):
+            self.update(data.get('id'), data['state'], data.get('smsc_id'),
+                        data.get('transport'), data.get('error'))
+
+
+
+store = MessageStateStore(settings.MESSAGE_STATES_MAX_SIZE)
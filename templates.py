@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Texts with fields, like u'Hello %(name)s, your code is %(code)s',
+    compiled once then rendered for each recipient:
+
+        >>> template = get_template(u'Hello %(name)s')
+        >>> template.render(name=u'Awa')
+        u'Hello Awa'
+
+    The encoding and length of the fixed parts are computed when the
+    template is compiled, so Template.analyze() only looks at the values
+    of the fields to know how many SMS the text takes.
+"""
+
+import re
+
+from pragmatic_sms.cache import LRUCache
+from pragmatic_sms.encoding import (to_unicode, count_segments,
+                                    count_gsm7_segments, GSM7, UCS2,
+                                    NOT_GSM7, NOT_GSM7_BASIC, GSM7_EXTENDED,
+                                    SEGMENT_SIZES)
+
+
+FIELD = re.compile(r'%\((\w+)\)s|%%')
+
+GSM7_SINGLE, GSM7_MULTIPLE = SEGMENT_SIZES[GSM7]
+UCS2_SINGLE = SEGMENT_SIZES[UCS2][0]
+
+
+class Template(object):
+    """
+        A compiled template: 'parts' are the fixed parts of the text, around
+        the 'fields'. Any '%' which is not part of a field, or written
+        '%%', is kept as is.
+
+        The 'fixed_*' attributes are the cost of the fixed parts: whether
+        they fit in GSM 7 bits, their number of extended characters, and
+        their length in septets and in UTF-16 code units.
+    """
+
+    def __init__(self, source):
+        self.source = source = to_unicode(source)
+
+        parts = []
+        fields = []
+        current = []
+        position = 0
+        for match in FIELD.finditer(source):
+            current.append(source[position:match.start()])
+            if match.group(1) is None:
+                current.append(u'%')
+            else:
+                parts.append(u''.join(current))
+                fields.append(match.group(1))
+                current = []
+            position = match.end()
+        current.append(source[position:])
+        parts.append(u''.join(current))
+
+        self.parts = tuple(parts)
+        self.fields = tuple(fields)
+
+        # the same template as a format string, so render() is done by
+        # the % operator
+        format = []
+        for part, field in zip(parts, fields):
+            format.append(part.replace(u'%', u'%%'))
+            format.append(u'%%(%s)s' % field)
+        format.append(parts[-1].replace(u'%', u'%%'))
+        self.format = u''.join(format)
+
+        fixed = u''.join(parts)
+        self.fixed_gsm7 = NOT_GSM7.search(fixed) is None
+        self.fixed_extended = len(GSM7_EXTENDED.findall(fixed))
+        self.fixed_septets = len(fixed) + self.fixed_extended
+        self.fixed_units = len(fixed.encode('utf-16-be')) // 2
+
+
+    def render(self, context=None, **kwargs):
+        """
+            Return the text with the fields replaced by the values in
+            'context', a dict, or the keyword arguments. Raise KeyError if
+            one is missing. Byte strings values must be ASCII.
+        """
+        return self.format % (context or kwargs)
+
+
+    def analyze(self, context=None, **kwargs):
+        """
+            Return what pragmatic_sms.encoding.analyze() would return for
+            the rendered text, looking only at the values of the fields.
+        """
+        context = context or kwargs
+        try:
+            variable = u''.join(map(context.__getitem__, self.fields))
+        except TypeError:
+            # numbers
+            variable = u''.join([u'%s' % context[field] 
+                                 for field in self.fields])
+
+        if self.fixed_gsm7:
+            if NOT_GSM7_BASIC.search(variable) is None:
+                # the most common case, with only one regex
+                length = self.fixed_septets + len(variable)
+                if length <= GSM7_SINGLE:
+                    return GSM7, length, 1
+                return self.analyze_gsm7(context, len(variable), 0)
+            if NOT_GSM7.search(variable) is None:
+                extended = len(GSM7_EXTENDED.findall(variable))
+                return self.analyze_gsm7(context, len(variable) + extended,
+                                         extended)
+
+        length = self.fixed_units + len(variable.encode('utf-16-be')) // 2
+        if length <= UCS2_SINGLE:
+            return UCS2, length, 1
+        return UCS2, length, count_segments(UCS2, length)
+
+
+    def analyze_gsm7(self, context, septets, extended):
+        length = self.fixed_septets + septets
+        if (extended or self.fixed_extended) and length > GSM7_SINGLE:
+            # escape sequences are not split between two parts, the text
+            # is needed to know where they fall
+            return GSM7, length, count_gsm7_segments(self.render(context),
+                                                     GSM7_MULTIPLE)
+        return GSM7, length, count_segments(GSM7, length)
+
+
+    def __repr__(self):
+        return '<Template %r>' % self.source
+
+
+
+_templates = LRUCache(1000)
+
+def get_template(source):
+    """
+        Return the compiled Template of this text, compiled only the first
+        time.
+    """
+    template = _templates.get(source)
+    if template is None:
+        template = Template(source)
+        _templates.set(source, template)
+    return template
+
+
+def render(source, context=None, **kwargs):
+    """
+        Shortcut to render a text with get_template().
+    """
+    return get_template(source).render(context, **kwargs)
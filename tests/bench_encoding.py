@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Measure how fast texts are analyzed, one by one and as a campaign:
+
+        python -m pragmatic_sms.tests.bench_encoding [messages]
+"""
+
+import sys
+import time
+
+from pragmatic_sms.encoding import analyze, classify
+
+
+TEXTS = (
+    u'Your code is %s',
+    u'Hello %s, your appointment is confirmed for tomorrow at 10:00. '
+    u'Reply STOP to unsubscribe.',
+    u'Votre colis n°%s est arrivé, 5€ à régler à la livraison. '
+    u'Répondez STOP pour ne plus recevoir de messages de notre part. '
+    u'Vous pouvez aussi suivre votre colis sur notre site.',
+    u'Ваш код подтверждения: %s',
+)
+
+
+def bench(name, function, count):
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    print '%-30s %8.2fs %10.0f messages/s' % (name, elapsed, count / elapsed)
+
+
+if __name__ == '__main__':
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    # each text different, like personalized messages
+    texts = [TEXTS[i % len(TEXTS)] % i for i in xrange(count)]
+    # the same texts again and again, like a campaign
+    campaign = [TEXTS[i % len(TEXTS)] % 0 for i in xrange(count)]
+
+    print '%s messages' % count
+    bench('analyze(), different texts', lambda: [analyze(t) for t in texts],
+          count)
+    bench('classify(), different texts', lambda: classify(texts), count)
+    bench('classify(), same texts', lambda: classify(campaign), count)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Measure the SMPP transport throughput against the fake SMSC for
+    several window sizes:
+
+        python -m pragmatic_sms.tests.bench_smpp [messages] [latency in ms]
+"""
+
+import os
+import sys
+import time
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.messages import OutgoingMessage
+from pragmatic_sms.transports.smpp import SMPPMessageTransport
+from pragmatic_sms.tests.test_smpp import FakeSMSC
+
+
+WINDOWS = (1, 2, 5, 10, 20, 50, 100)
+
+
+def bench(window, count, latency):
+
+    smsc = FakeSMSC(latency)
+    transport = SMPPMessageTransport('smpp', 'send_messages', host='127.0.0.1',
+                                     port=smsc.port, window=window,
+                                     batch_size=count)
+    messages = [OutgoingMessage('+223%s' % i, 'hello') for i in range(count)]
+
+    start = time.time()
+    transport.on_send_messages(messages)
+    elapsed = time.time() - start
+
+    transport.client.unbind()
+    smsc.close()
+    return elapsed
+
+
+if __name__ == '__main__':
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.01
+
+    print "%s messages, SMSC latency %sms" % (count, latency * 1000)
+    print "window\tseconds\tmsg/s"
+    for window in WINDOWS:
+        elapsed = bench(window, count, latency)
+        print "%s\t%.2f\t%.0f" % (window, elapsed, count / elapsed)
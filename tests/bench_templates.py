@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Measure how fast templates are rendered and analyzed, with the cost of
+    their fixed parts precomputed or not, compared to formatting and 
+    analyzing the texts:
+
+        python -m pragmatic_sms.tests.bench_templates [messages]
+"""
+
+import sys
+import time
+
+from pragmatic_sms.encoding import analyze
+from pragmatic_sms.templates import get_template
+
+
+TEMPLATES = (
+    u'Your code is %(code)s',
+    u'Hello %(name)s, your appointment is confirmed for tomorrow at 10:00. '
+    u'Reply STOP to unsubscribe.',
+    u'Votre colis n°%(code)s est arrivé, 5€ à régler à la livraison. '
+    u'Répondez STOP pour ne plus recevoir de messages de notre part. '
+    u'Vous pouvez aussi suivre votre colis sur notre site.',
+    u'Ваш код подтверждения: %(code)s',
+)
+
+
+def bench(name, function, count):
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    print '%-30s %8.2fs %10.0f messages/s' % (name, elapsed, count / elapsed)
+
+
+if __name__ == '__main__':
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    rows = [(TEMPLATES[i % len(TEMPLATES)], 
+             {'code': unicode(i), 'name': u'Awa %s' % i})
+            for i in xrange(count)]
+    compiled = [(get_template(source), row) for source, row in rows]
+
+    print '%s messages' % count
+    bench('% then analyze()', 
+          lambda: [analyze(source % row) for source, row in rows], count)
+    bench('render()', 
+          lambda: [t.render(row) for t, row in compiled], count)
+    bench('render() then analyze()', 
+          lambda: [analyze(t.render(row)) for t, row in compiled], count)
+    bench('render() and Template.analyze()', 
+          lambda: [(t.render(row), t.analyze(row)) for t, row in compiled],
+          count)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+import os
+import shutil
+import tempfile
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.blocklist import Blocklist, BloomFilter, to_int
+from pragmatic_sms.messages import IncomingMessage, OutgoingMessage
+from pragmatic_sms.processors.blocklist import BlocklistMessageProcessor
+
+
+class TestBlocklist(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'blocklist')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+    def test_bloom_filter(self):
+
+        bloom = BloomFilter(1000)
+        for number in xrange(0, 2000, 2):
+            bloom.add(number)
+        self.assertTrue(all(number in bloom for number in xrange(0, 2000, 2)))
+        false_positives = sum(number in bloom for number in xrange(1, 2000, 2))
+        self.assertTrue(false_positives < 30)
+
+
+    def test_to_int(self):
+
+        self.assertEqual(to_int('+223 76 00 00 00'), 222376000000)
+        self.assertEqual(to_int('0022376000000'), 222376000000)
+        self.assertEqual(to_int('22376000000'), 122376000000)
+        self.assertEqual(to_int('0612'), 10612)
+        self.assertNotEqual(to_int('0612'), to_int('612'))
+        self.assertEqual(to_int('+' + '9' * 18), int('2' + '9' * 18))
+        for number in ('+' + '9' * 19, 'PSMS', '', None):
+            self.assertEqual(to_int(number), None)
+
+
+    def test_extend_and_lookup(self):
+
+        blocklist = Blocklist(self.path)
+        blocklist.extend('+223%08d' % i for i in xrange(0, 10000, 3))
+        self.assertEqual(len(blocklist), 3334)
+        self.assertTrue('+22300000003' in blocklist)
+        self.assertTrue('+223 00 00 99 99' in blocklist)
+        self.assertFalse('+22300000004' in blocklist)
+        self.assertFalse('22300000003' in blocklist)
+        self.assertFalse('' in blocklist)
+        self.assertEqual(os.path.getsize(self.path), 3334 * 8)
+
+
+    def test_add_is_journaled_then_merged(self):
+
+        blocklist = Blocklist(self.path, merge_threshold=3)
+        blocklist.extend(['1', '5'])
+        self.assertTrue(blocklist.add('3'))
+        self.assertFalse(blocklist.add('3'))
+        self.assertTrue(blocklist.add('4'))
+
+        # reload from the array and the journal
+        blocklist.close()
+        blocklist = Blocklist(self.path, merge_threshold=3)
+        self.assertEqual((blocklist.count, blocklist.recent), (2, set([13, 14])))
+        self.assertTrue('3' in blocklist)
+
+        blocklist.add('2')
+        self.assertEqual((blocklist.count, blocklist.recent), (5, set()))
+        self.assertEqual(list(blocklist.numbers()), [11, 12, 13, 14, 15])
+        self.assertEqual(os.path.getsize(self.path + '.journal'), 0)
+
+
+    def test_interrupted_merge(self):
+
+        blocklist = Blocklist(self.path)
+        blocklist.extend(['1', '2'])
+        rename = os.rename
+
+        # stopped before each rename, the numbers of the array are always
+        # in the Bloom filter
+        for renames in (0, 1):
+            calls = []
+            def failing_rename(source, destination):
+                if len(calls) == renames:
+                    raise OSError('Interrupted')
+                calls.append(source)
+                rename(source, destination)
+            os.rename = failing_rename
+            try:
+                self.assertRaises(OSError, blocklist.extend, ['3', '4'])
+            finally:
+                os.rename = rename
+            blocklist = Blocklist(self.path)
+            self.assertTrue(all(number in blocklist.bloom 
+                                for number in blocklist.numbers()))
+            self.assertTrue('1' in blocklist)
+
+
+    def test_processor(self):
+
+        processor = BlocklistMessageProcessor(self.path)
+        processor.on_receive_message(IncomingMessage('+22370000000', ' stop '))
+        processor.on_receive_message(IncomingMessage('+22370000001', 'hello'))
+
+        blocked = OutgoingMessage('+22370000000', 'hello')
+        processor.on_send_message(blocked)
+        self.assertEqual(blocked.cancelled, 'blocklisted')
+
+        allowed = OutgoingMessage('+22370000001', 'hello')
+        processor.on_send_message(allowed)
+        self.assertEqual(allowed.cancelled, None)
+        processor.close()
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
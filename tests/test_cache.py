@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+
+from pragmatic_sms.cache import LRUCache
+
+
+class TestLRUCache(unittest2.TestCase):
+
+
+    def test_get_set(self):
+
+        cache = LRUCache()
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.get('foo', 1), 1)
+        cache.set('foo', 'bar')
+        self.assertEqual(cache.get('foo'), 'bar')
+        self.assertTrue('foo' in cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+
+    def test_least_recently_used_are_evicted(self):
+
+        cache = LRUCache(max_size=3)
+        for key in 'abc':
+            cache.set(key, key)
+        cache.get('a')
+        cache.set('d', 'd')
+        self.assertEqual(cache.keys(), ['c', 'a', 'd'])
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.evictions, 1)
+
+        cache.set('c', 'C')
+        cache.set('e', 'e')
+        self.assertEqual(cache.keys(), ['d', 'c', 'e'])
+        self.assertEqual(cache.get('c'), 'C')
+
+
+    def test_expiration(self):
+
+        cache = LRUCache(ttl=10)
+        cache.set('foo', 1, now=100)
+        cache.set('bar', 2, ttl=20, now=100)
+        cache.set('baz', 3, now=105)
+        self.assertEqual(cache.get('foo', now=109), 1)
+        self.assertEqual(cache.get('foo', now=110), None)
+        self.assertEqual(len(cache), 2)
+
+        self.assertEqual(cache.expire(now=116), 1)
+        self.assertEqual(cache.keys(), ['bar'])
+
+
+    def test_pop_and_clear(self):
+
+        cache = LRUCache()
+        cache.set('foo', 1)
+        cache.set('bar', 2)
+        self.assertEqual(cache.pop('foo'), 1)
+        self.assertEqual(cache.pop('foo', 3), 3)
+        self.assertEqual(cache.keys(), ['bar'])
+        cache.clear()
+        self.assertEqual(cache.keys(), [])
+        self.assertEqual(len(cache), 0)
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+import os
+import shutil
+import tempfile
+import time
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.campaigns import Campaign, CampaignError
+
+
+class RecordingCampaign(Campaign):
+    """
+        Record the batches of messages instead of publishing them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        Campaign.__init__(self, *args, **kwargs)
+        self.batches = []
+
+
+    def dispatch(self, messages):
+        self.batches.append([(m.recipient, m.text) for m in messages])
+
+
+
+class TestCampaign(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'campaign.csv')
+        f = open(self.path, 'wb')
+        f.write('number,name,code\n'
+                '+2231,Ali,1\n'
+                '+2232,"Awa\nTraore",2\n'
+                '\n'
+                '+2233,Mo\xc3\xafse,3\n')
+        f.close()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_send_campaign(self):
+
+        campaign = RecordingCampaign(self.path, u'%(name)s: %(code)s',
+                                     batch_size=2)
+        self.assertEqual(campaign.run(), 3)
+        self.assertEqual(campaign.batches,
+                         [[('+2231', u'Ali: 1'), ('+2232', u'Awa\nTraore: 2')],
+                          [('+2233', u'Mo\xefse: 3')]])
+        self.assertEqual(campaign.sent, 3)
+
+        # already done
+        campaign = RecordingCampaign(self.path, u'%(name)s', batch_size=2)
+        self.assertEqual(campaign.sent, 3)
+        self.assertEqual(campaign.run(), 0)
+
+        campaign.reset()
+        self.assertEqual(campaign.run(), 3)
+
+
+    def test_resume(self):
+
+        campaign = RecordingCampaign(self.path, u'%(name)s', batch_size=1)
+        self.assertEqual(campaign.run(limit=2), 2)
+
+        campaign = RecordingCampaign(self.path, u'%(name)s', batch_size=1)
+        self.assertEqual((campaign.sent, campaign.run()), (2, 1))
+        self.assertEqual(campaign.batches, [[('+2233', u'Mo\xefse')]])
+
+
+    def test_text_column(self):
+
+        f = open(self.path, 'wb')
+        f.write('phone,text\n+2231,hello\n')
+        f.close()
+
+        campaign = RecordingCampaign(self.path, number_column='phone')
+        campaign.run()
+        self.assertEqual(campaign.batches, [[('+2231', u'hello')]])
+
+        campaign = RecordingCampaign(self.path, u'%(name)s')
+        campaign.reset()
+        self.assertRaises(CampaignError, campaign.run)
+
+
+    def test_rate(self):
+
+        campaign = RecordingCampaign(self.path, u'%(name)s', batch_size=1, 
+                                     rate=20)
+        start = time.time()
+        campaign.run()
+        # no need to wait after the last message
+        self.assertTrue(0.1 <= time.time() - start < 0.5)
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+import os
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.coalescing import Coalescer
+
+
+class TestCoalescer(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.coalescer = Coalescer(delay=5, max_pending=2)
+
+
+    def body(self, id, text, recipient='+2231'):
+        return {'id': id, 'text': text, 'recipient': recipient, 
+                'transport': 'default'}
+
+
+    def test_merge(self):
+
+        self.assertEqual(self.coalescer.add(self.body(1, u'a'), 'm1', now=1), [])
+        self.assertEqual(self.coalescer.add(self.body(2, u'b'), 'm2', now=2), [])
+        self.assertEqual(self.coalescer.add(self.body(3, u'c', '+2232'), 'm3', 
+                                            now=2), [])
+        self.assertEqual(self.coalescer.flush(now=5), [])
+
+        first, = self.coalescer.flush(now=6)
+        self.assertEqual((first.body['id'], first.body['text']), (1, u'a\nb'))
+        self.assertEqual(first.merged_ids, [2])
+        self.assertEqual(first.messages, ['m1', 'm2'])
+        self.assertEqual(self.coalescer.merged, 1)
+        self.assertEqual(len(self.coalescer), 1)
+
+
+    def test_segment_limit(self):
+
+        self.coalescer.add(self.body(1, u'a' * 100), 'm1', now=1)
+        ready = self.coalescer.add(self.body(2, u'b' * 100), 'm2', now=1)
+        self.assertEqual([p.body['id'] for p in ready], [1])
+        self.assertEqual(self.coalescer.pending.values()[0].body['id'], 2)
+
+        # too long to be held
+        ready = self.coalescer.add(self.body(3, u'c' * 200, '+2232'), 'm3', 
+                                   now=1)
+        self.assertEqual([p.body['id'] for p in ready], [3])
+
+
+    def test_max_pending(self):
+
+        for i in range(3):
+            ready = self.coalescer.add(self.body(i, u'a', '+223%s' % i), i, 
+                                       now=i)
+        self.assertEqual([p.body['id'] for p in ready], [0])
+        self.assertEqual(len(self.coalescer), 2)
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+import os
+import datetime
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.conf import settings
+from pragmatic_sms.messages import IncomingMessage, OutgoingMessage
+from pragmatic_sms.duplicates import DuplicateFilter
+
+
+class TestDuplicateFilter(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.filter = DuplicateFilter(window=10)
+        self.start = datetime.datetime(2011, 1, 1)
+
+
+    def receive(self, author, text, seconds):
+        date = self.start + datetime.timedelta(seconds=seconds)
+        return IncomingMessage(author, text, reception_date=date)
+
+
+    def test_fingerprint(self):
+
+        message = IncomingMessage('+2231', u'hello')
+        copy = IncomingMessage('+2231', u'hello')
+        self.assertNotEqual(message.id, copy.id)
+        self.assertEqual(message.fingerprint(), copy.fingerprint())
+        self.assertNotEqual(message.fingerprint(1), copy.fingerprint(2))
+        self.assertNotEqual(message.fingerprint(), 
+                            IncomingMessage('+2232', u'hello').fingerprint())
+        self.assertNotEqual(message.fingerprint(), 
+                            OutgoingMessage('+2231', u'hello', 
+                                            'other').fingerprint())
+
+
+    def test_duplicates(self):
+
+        self.assertFalse(self.filter.is_duplicate(self.receive('+2231', 'a', 0)))
+        self.assertTrue(self.filter.is_duplicate(self.receive('+2231', 'a', 2)))
+        self.assertFalse(self.filter.is_duplicate(self.receive('+2231', 'b', 2)))
+        self.assertFalse(self.filter.is_duplicate(self.receive('+2232', 'a', 2)))
+        self.assertEqual(self.filter.stats(), 
+                         {'checked': 4, 'hits': 1, 'size': 3})
+
+
+    def test_window_boundary(self):
+
+        self.assertFalse(self.filter.is_duplicate(self.receive('+2231', 'a', 9)))
+        self.assertTrue(self.filter.is_duplicate(self.receive('+2231', 'a', 11)))
+        self.assertFalse(self.filter.is_duplicate(self.receive('+2231', 'a', 25)))
+
+
+    def test_filter(self):
+
+        messages = [self.receive('+2231', 'a', 0), self.receive('+2231', 'a', 1),
+                    self.receive('+2231', 'b', 1)]
+        self.assertEqual([m.text for m in self.filter.filter(messages)],
+                         ['a', 'b'])
+
+
+    def test_worker_drops_duplicates(self):
+
+        worker = IncomingMessage.worker
+        # off by default
+        self.assertTrue(worker.duplicates is None)
+
+        settings.DUPLICATES_WINDOW = 10
+        try:
+            self.assertTrue(worker.dispatch_incoming_message(
+                                    IncomingMessage('+2231', 'test_worker')))
+            self.assertFalse(worker.dispatch_incoming_message(
+                                    IncomingMessage('+2231', 'test_worker')))
+            self.assertEqual(worker.dispatch_incoming_messages(
+                                    [IncomingMessage('+2231', 'test_worker'),
+                                     IncomingMessage('+2231', 'test_worker 2')]),
+                             1)
+        finally:
+            settings.DUPLICATES_WINDOW = None
+            worker._duplicates = None
+            worker.purge()
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+import os
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.encoding import analyze, classify, GSM7, UCS2
+from pragmatic_sms.messages import OutgoingMessage
+from pragmatic_sms.transports.pdu import split_text
+
+
+class TestAnalyze(unittest2.TestCase):
+
+
+    def test_gsm7(self):
+
+        self.assertEqual(analyze(u'hello'), (GSM7, 5, 1))
+        self.assertEqual(analyze('hello'), (GSM7, 5, 1))
+        self.assertEqual(analyze(u''), (GSM7, 0, 1))
+        self.assertEqual(analyze(u'é' * 160), (GSM7, 160, 1))
+        self.assertEqual(analyze(u'a' * 161), (GSM7, 161, 2))
+        self.assertEqual(analyze(u'a' * 306), (GSM7, 306, 2))
+        self.assertEqual(analyze(u'a' * 307), (GSM7, 307, 3))
+
+
+    def test_gsm7_extension(self):
+
+        self.assertEqual(analyze(u'€' * 80), (GSM7, 160, 1))
+        self.assertEqual(analyze(u'€' * 81), (GSM7, 162, 2))
+        # the last escape sequence of the first part would be split
+        self.assertEqual(analyze(u'a' * 152 + u'€' + u'a' * 152), 
+                         (GSM7, 306, 3))
+
+
+    def test_ucs2(self):
+
+        self.assertEqual(analyze(u'привет'), (UCS2, 6, 1))
+        self.assertEqual(analyze(u'a' * 69 + u'ж'), (UCS2, 70, 1))
+        self.assertEqual(analyze(u'ж' * 71), (UCS2, 71, 2))
+        self.assertEqual(analyze(u'\U0001F600'), (UCS2, 2, 1))
+
+
+    def test_same_segments_as_pdu(self):
+
+        for text in (u'a' * 400, u'a€' * 150, u'a' * 152 + u'€' * 10,
+                     u'ж' * 200):
+            dcs, parts = split_text(text)
+            self.assertEqual(analyze(text)[2], len(parts))
+
+
+    def test_classify(self):
+
+        summary = classify([u'hello', u'hello', u'ж' * 71, u'a' * 200])
+        self.assertEqual(summary['texts'], 4)
+        self.assertEqual((summary[GSM7], summary[UCS2]), (3, 1))
+        self.assertEqual(summary['segments'], 6)
+        self.assertEqual(summary['histogram'], {1: 2, 2: 2})
+
+
+    def test_outgoing_message(self):
+
+        message = OutgoingMessage('foo', u'hello')
+        self.assertEqual((message.encoding, message.segments, 
+                          message.fits_gsm7), (GSM7, 1, True))
+        message.text = u'ж' * 71
+        self.assertEqual((message.encoding, message.segments, 
+                          message.fits_gsm7), (UCS2, 2, False))
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
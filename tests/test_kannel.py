@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+import os
+import cgi
+import time
+import urllib2
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.messages import OutgoingMessage
+from pragmatic_sms.transports.kannel import KannelMessageTransport
+from pragmatic_sms.transports.httppool import HTTPConnectionPool
+
+
+class FakeKannelHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+        Answer sendsms requests like Kannel, after 'latency' seconds,
+        with a 503 error for recipients in 'failing', a 403 error
+        for recipients in 'refused' and a 400 error for the ones in 
+        'invalid'.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+
+    def do_GET(self):
+        params = cgi.parse_qs(urlparse.urlsplit(self.path).query)
+        recipients = params['to'][0].split(' ')
+
+        with self.server.lock:
+            self.server.requests.append(params)
+        time.sleep(self.server.latency)
+
+        if set(recipients) & self.server.failing:
+            status, body = 503, 'Queue full'
+        elif set(recipients) & self.server.refused:
+            status, body = 403, 'Authorization failed for sendsms'
+        elif set(recipients) & self.server.invalid:
+            status, body = 400, 'Invalid receiver'
+        else:
+            status, body = 202, '0: Accepted for delivery'
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeKannel(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 50
+
+    def __init__(self, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakeKannelHandler)
+        self.latency = latency
+        self.failing = set()
+        self.refused = set()
+        self.invalid = set()
+        self.requests = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/cgi-bin/sendsms' % self.server_address[1]
+
+
+
+class TestKannelMessageTransport(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.kannel = FakeKannel()
+        self.transport = KannelMessageTransport('kannel', 'send_messages',
+                                                sendsms_url=self.kannel.url,
+                                                username='foo', password='bar',
+                                                max_in_flight=10, per_host=10)
+        self.transport.connect()
+
+
+    def tearDown(self):
+        self.transport.http.stop()
+        self.kannel.shutdown()
+        self.kannel.server_close()
+
+
+    def test_send_message(self):
+
+        self.assertTrue(self.transport.on_send_message(
+                        OutgoingMessage('+2231', u'héhé')))
+        params = self.kannel.requests[0]
+        self.assertEqual(params['to'], ['+2231'])
+        self.assertEqual(params['text'][0].decode('utf-8'), u'héhé')
+        # 'é' is in the GSM 7 bit alphabet
+        self.assertNotIn('coding', params)
+        self.assertEqual(params['username'], ['foo'])
+
+        self.assertTrue(self.transport.on_send_message(
+                        OutgoingMessage('+2231', u'Привет')))
+        params = self.kannel.requests[1]
+        self.assertEqual(params['text'][0].decode('utf-8'), u'Привет')
+        self.assertEqual(params['coding'], ['2'])
+
+
+    def test_same_text_sent_in_one_request(self):
+
+        messages = [OutgoingMessage('+223%s' % i, 'hello') for i in range(5)]
+        self.assertEqual(self.transport.on_send_messages(messages), [True] * 5)
+        self.assertEqual(len(self.kannel.requests), 1)
+        self.assertEqual(self.kannel.requests[0]['to'][0].split(' '),
+                         ['+223%s' % i for i in range(5)])
+
+
+    def test_errors(self):
+
+        self.kannel.failing.add('+2232')
+        self.kannel.refused.add('+2233')
+        self.kannel.invalid.add('+2234')
+        messages = [OutgoingMessage('+223%s' % i, str(i)) for i in range(5)]
+        # only the invalid message is dropped, the others are put back in
+        # the queue
+        self.assertEqual(self.transport.on_send_messages(messages),
+                         [True, True, False, False, True])
+        self.assertEqual(messages[3].error, None)
+        self.assertEqual(messages[4].error, 'Kannel status 400')
+
+
+    def test_parallel_requests_on_keep_alive_connections(self):
+
+        self.kannel.latency = 0.05
+        messages = [OutgoingMessage('+223%s' % i, str(i)) for i in range(40)]
+
+        start = time.time()
+        self.assertEqual(self.transport.on_send_messages(messages), [True] * 40)
+        elapsed = time.time() - start
+
+        # one request at a time would take 2 seconds
+        self.assertLess(elapsed, 1)
+        self.assertLessEqual(self.kannel.connections, 10)
+
+        self.transport.on_send_messages(messages)
+        self.assertLessEqual(self.kannel.connections, 10)
+
+
+    def test_receive_messages(self):
+
+        received = []
+        self.transport.receive_message = lambda *args: received.append(args)
+        self.transport.listen_host = '127.0.0.1'
+        self.transport.listen_port = 0
+        server = self.transport.get_server()
+        url = 'http://127.0.0.1:%s/?from=%%2B2231&text=h%%C3%%A9' % (
+               server.server_address[1])
+        response = []
+        client = threading.Thread(target=lambda: response.append(
+                                                 urllib2.urlopen(url).code))
+        client.start()
+        server.handle_request()
+        client.join()
+        server.server_close()
+
+        self.assertEqual(response, [200])
+        self.assertEqual(received, [('+2231', u'hé')])
+
+
+
+class TestHTTPConnectionPool(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.kannel = FakeKannel(latency=0.05)
+        self.pool = HTTPConnectionPool(max_in_flight=8, per_host=2)
+
+
+    def tearDown(self):
+        self.pool.stop()
+        self.kannel.shutdown()
+        self.kannel.server_close()
+
+
+    def test_per_host_limit(self):
+
+        url = self.kannel.url + '?to=1'
+        start = time.time()
+        requests = [self.pool.request('GET', url) for i in range(8)]
+        for request in requests:
+            self.assertTrue(request.wait(5).ok)
+
+        # 8 requests, 2 at a time
+        self.assertGreaterEqual(time.time() - start, 0.18)
+        self.assertLessEqual(self.kannel.connections, 8)
+        self.assertEqual(self.pool.requests_sent, 8)
+
+
+    def test_connection_error(self):
+
+        self.kannel.shutdown()
+        self.kannel.server_close()
+        request = self.pool.request('GET', self.kannel.url + '?to=1').wait(5)
+        self.assertFalse(request.ok)
+        self.assertTrue(request.error)
+        self.kannel = FakeKannel()
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -7,6 +7,7 @@ import unittest2
 import os
 import sys
 import datetime
+import tempfile
 
 from kombu.connection import BrokerConnection
 from kombu.messaging import Exchange, Queue
@@ -20,7 +21,8 @@ from pragmatic_sms.settings import default_settings
 from pragmatic_sms.tests import dummy_settings
 from pragmatic_sms.conf import settings
 from pragmatic_sms.routing import SmsRouter
-from pragmatic_sms.messages import OutgoingMessage, IncomingMessage, Message
+from pragmatic_sms.messages import (OutgoingMessage, IncomingMessage, Message,
+                                    BroadcastMessage)
 
 
 class TestMessage(unittest2.TestCase):
@@ -71,7 +73,58 @@ class TestMessage(unittest2.TestCase):
         self.assertIn("id", d)
 
 
-    
+    def test_expiry(self):
+
+        m = OutgoingMessage("to", "test", ttl=60)
+        self.assertEqual(m.expires_at - m.creation_date,
+                         datetime.timedelta(seconds=60))
+        self.assertFalse(m.expired)
+        self.assertFalse(OutgoingMessage.body_expired(m.to_dict()))
+        self.assertEqual(OutgoingMessage(**m.to_dict()).expires_at, 
+                         m.expires_at)
+
+        past = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        m = OutgoingMessage("to", "test", expires_at=past)
+        self.assertTrue(m.expired)
+        self.assertTrue(OutgoingMessage.body_expired(m.to_dict()))
+
+        m = OutgoingMessage("to", "test")
+        self.assertEqual(m.expires_at, None)
+        self.assertFalse(OutgoingMessage.body_expired(m.to_dict()))
+
+        settings.OUTGOING_MESSAGES_TTL = 30
+        try:
+            m = OutgoingMessage("to", "test")
+        finally:
+            settings.OUTGOING_MESSAGES_TTL = None
+        self.assertEqual(m.expires_at - m.creation_date,
+                         datetime.timedelta(seconds=30))
+
+
+    def test_broadcast_chunks(self):
+
+        m = BroadcastMessage(['a', 'b', 'c'], 'test')
+        self.assertEqual(m.next_chunk(2), ['a', 'b'])
+        m = BroadcastMessage(**m.to_dict())
+        self.assertEqual(m.next_chunk(2), ['c'])
+        self.assertEqual(m.next_chunk(2), [])
+
+        fd, path = tempfile.mkstemp()
+        os.write(fd, '0022376000001\n+223 76 00 00 02\n\n0022376000003\n')
+        os.close(fd)
+        try:
+            m = BroadcastMessage(path, 'test')
+            self.assertEqual(m.next_chunk(2), ['+22376000001', '+22376000002'])
+            m = BroadcastMessage(**m.to_dict())
+            self.assertEqual(m.next_chunk(2), ['+22376000003'])
+            self.assertEqual(m.next_chunk(2), [])
+        finally:
+            os.remove(path)
+
+        outgoing = m.create_message('+22376000001')
+        self.assertEqual((outgoing.recipient, outgoing.text), 
+                         ('+22376000001', 'test'))
+
 
 
 
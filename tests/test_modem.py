@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+import os
+import pty
+import threading
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.messages import OutgoingMessage
+from pragmatic_sms.transports.pdu import (encode_submit, decode_submit,
+                                          encode_deliver, decode_deliver)
+from pragmatic_sms.transports.modem import ModemMessageTransport
+
+
+class FakeModem(object):
+    """
+        A stand-in modem on a pseudo terminal, answering the AT commands
+        used by the transport. It records the commands and the sent PDUs.
+
+        Commands listed in 'errors' fail with the given response.
+    """
+
+    def __init__(self):
+        self.master, self.slave = pty.openpty()
+        self.device = os.ttyname(self.slave)
+        self.commands = []
+        self.sent = []
+        self.stored = {}
+        self.errors = {}
+        self.mute = False
+        self.next_index = 0
+
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+
+    def reply(self, data):
+        os.write(self.master, data)
+
+
+    def serve(self):
+        buffer = ''
+        waiting_pdu = False
+        while True:
+            try:
+                buffer += os.read(self.master, 4096)
+            except OSError:
+                return
+            while True:
+                if waiting_pdu:
+                    if '\x1a' not in buffer:
+                        break
+                    pdu, buffer = buffer.split('\x1a', 1)
+                    self.sent.append(pdu)
+                    self.reply('\r\n+CMGS: %s\r\n\r\nOK\r\n' % len(self.sent))
+                    waiting_pdu = False
+                elif '\r' in buffer:
+                    command, buffer = buffer.split('\r', 1)
+                    waiting_pdu = self.handle(command.strip())
+                else:
+                    break
+
+
+    def handle(self, command):
+        self.commands.append(command)
+
+        if self.mute:
+            return False
+
+        if command in self.errors:
+            self.reply('\r\n%s\r\n' % self.errors[command])
+            return False
+
+        if command.startswith('AT+CMGS='):
+            self.reply('\r\n> ')
+            return True
+
+        if command == 'AT+CMGL=4':
+            response = ''
+            for index in sorted(self.stored):
+                pdu, read = self.stored[index]
+                response += '+CMGL: %s,%s,,%s\r\n%s\r\n' % (index, int(read),
+                                                            len(pdu) // 2 - 1,
+                                                            pdu)
+                self.stored[index][1] = True
+            self.reply('\r\n%s\r\nOK\r\n' % response)
+
+        elif command == 'AT+CMGD=1,1':
+            for index in self.stored.keys():
+                if self.stored[index][1]:
+                    del self.stored[index]
+            self.reply('\r\nOK\r\n')
+
+        elif command in ('ATE0', 'AT+CMGF=0', 'AT+CMMS=1'):
+            self.reply('\r\nOK\r\n')
+
+        else:
+            self.reply('\r\nERROR\r\n')
+
+        return False
+
+
+    def receive(self, number, text):
+        for pdu in encode_deliver(number, text):
+            self.next_index += 1
+            self.stored[self.next_index] = [pdu, False]
+
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+
+class RecordingModemTransport(ModemMessageTransport):
+
+    def __init__(self, *args, **kwargs):
+        ModemMessageTransport.__init__(self, *args, **kwargs)
+        self.received = []
+
+
+    def publish_incoming_messages(self, messages):
+        self.received.extend((message.author, message.text)
+                             for message in messages)
+        return len(messages)
+
+
+
+class TestPDU(unittest2.TestCase):
+
+
+    def test_encode_submit(self):
+
+        self.assertEqual(encode_submit('46708251358', u'hellohello', 0),
+                         [(22, '0001000B816407281553F800000AE8329BFD4697D9EC37')])
+
+
+    def test_round_trip(self):
+
+        for text in (u'hello', u'héhé {€}', u'مرحبا', u'a' * 200,
+                     u'€' * 100, u'م' * 100):
+            pdus = encode_submit('+22370000000', text)
+            parts = [decode_submit(pdu) for length, pdu in pdus]
+            self.assertEqual(u''.join(part.text for part in parts), text)
+            self.assertTrue(all(part.number == '+22370000000'
+                                for part in parts))
+
+            parts = [decode_deliver(pdu)
+                     for pdu in encode_deliver('+22370000000', text)]
+            self.assertEqual(u''.join(part.text for part in parts), text)
+
+
+    def test_escapes_are_not_split(self):
+
+        pdus = encode_submit('+2231', u'a' * 152 + u'€' * 10)
+        parts = [decode_submit(pdu).text for length, pdu in pdus]
+        self.assertEqual(parts, [u'a' * 152, u'€' * 10])
+
+
+
+class TestModemMessageTransport(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.modem = FakeModem()
+        self.transport = RecordingModemTransport('modem', 'send_messages',
+                                                 device=self.modem.device,
+                                                 timeout=2, poll_interval=0.1)
+        self.transport.connect()
+
+
+    def tearDown(self):
+        self.transport.modem.close()
+        self.modem.close()
+
+
+    def test_send_messages(self):
+
+        messages = [OutgoingMessage('+223%s' % i, u'hé %s' % i)
+                    for i in range(5)]
+        self.assertEqual(self.transport.on_send_messages(messages), [True] * 5)
+        self.assertEqual([decode_submit(pdu).text for pdu in self.modem.sent],
+                         [u'hé %s' % i for i in range(5)])
+
+        # setup, then one command per message and one for the whole batch
+        self.assertEqual(self.modem.commands[:2], ['ATE0', 'AT+CMGF=0'])
+        self.assertEqual(len(self.modem.commands), 2 + 1 + 5)
+        self.assertEqual(self.transport.modem.commands, 8)
+
+
+    def test_send_long_message(self):
+
+        message = OutgoingMessage('+2231', u'a' * 300)
+        self.assertEqual(self.transport.on_send_messages([message]), [True])
+        parts = [decode_submit(pdu) for pdu in self.modem.sent]
+        self.assertEqual([(part.total, part.sequence) for part in parts],
+                         [(2, 1), (2, 2)])
+        self.assertEqual(u''.join(part.text for part in parts), u'a' * 300)
+
+
+    def test_send_errors(self):
+
+        self.transport.ensure_ready()
+        messages = [OutgoingMessage('+2231', 'hello')]
+        command = 'AT+CMGS=%s' % encode_submit('+2231', 'hello')[0][0]
+
+        self.modem.errors[command] = '+CMS ERROR: 331'
+        self.assertEqual(self.transport.on_send_messages(messages), [False])
+
+        self.modem.errors[command] = '+CMS ERROR: 21'
+        self.assertEqual(self.transport.on_send_messages(messages), [True])
+        self.assertFalse(self.modem.sent)
+
+
+    def test_modem_not_responding(self):
+
+        self.transport.ensure_ready()
+        self.transport.modem.timeout = 0.2
+        self.modem.mute = True
+        messages = [OutgoingMessage('+2231', 'hello') for i in range(3)]
+        self.assertEqual(self.transport.on_send_messages(messages),
+                         [False] * 3)
+
+        # the modem is set up again for the next batch
+        self.assertFalse(self.transport.modem.ready)
+        self.modem.mute = False
+        self.assertEqual(self.transport.on_send_messages(messages), [True] * 3)
+
+
+    def test_receive_messages(self):
+
+        self.modem.receive('+2231', u'hello')
+        self.modem.receive('+2232', u'hé' * 100)
+        self.modem.receive('+2233', u'a' * 400)
+        self.transport.ensure_ready()
+        commands = self.transport.modem.commands
+
+        self.transport.receive_messages()
+        self.assertEqual(sorted(self.transport.received),
+                         [('+2231', u'hello'), ('+2232', u'hé' * 100),
+                          ('+2233', u'a' * 400)])
+        self.assertFalse(self.modem.stored)
+
+        # all the messages are listed and deleted with one command each
+        self.assertEqual(self.transport.modem.commands - commands, 2)
+
+        # nothing is deleted if there is nothing to read
+        self.transport.receive_messages()
+        self.assertEqual(self.transport.modem.commands - commands, 3)
+
+
+    def test_reassemble_parts_across_polls(self):
+
+        self.modem.receive('+2231', u'a' * 400)
+        first = self.modem.stored.pop(1)
+        self.transport.ensure_ready()
+        self.transport.receive_messages()
+        self.assertFalse(self.transport.received)
+        self.assertEqual(self.transport.reassembly.held, 2)
+
+        self.modem.stored[1] = first
+        self.transport.receive_messages()
+        self.assertEqual(self.transport.received, [('+2231', u'a' * 400)])
+        self.assertFalse(self.transport.reassembly.held)
+
+
+    def test_expire_fragments(self):
+
+        pdus = encode_deliver('+2231', u'a' * 400)
+        self.assertEqual(self.transport.receive_part(pdus[0], now=100), [])
+        self.assertFalse(self.transport.expire_fragments(now=100 + 3599))
+        expired = self.transport.expire_fragments(now=100 + 3601)
+        self.assertEqual([message.text for message in expired], [u'a' * 153])
+        self.assertFalse(self.transport.reassembly.held)
+
+
+    def test_incoming_messages_loop(self):
+
+        self.modem.receive('+2231', u'hello')
+        threading.Timer(0.5,
+                        self.transport.stop_incoming_messages_loop).start()
+        self.transport.start_incoming_messages_loop()
+        self.assertEqual(self.transport.received, [('+2231', u'hello')])
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
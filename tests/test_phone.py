@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+import os
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.conf import settings
+from pragmatic_sms.phone import PhoneNormalizer, normalize
+from pragmatic_sms.messages import IncomingMessage, OutgoingMessage
+
+
+class TestPhoneNormalizer(unittest2.TestCase):
+
+
+    def test_international_numbers(self):
+
+        normalizer = PhoneNormalizer()
+        self.assertEqual(normalizer.normalize('+223 76 00-00-00'),
+                         '+22376000000')
+        self.assertEqual(normalizer.normalize('0022376000000'), '+22376000000')
+        self.assertEqual(normalizer.normalize('(223) 76.00.00.00'), 
+                         '22376000000')
+
+
+    def test_national_numbers(self):
+
+        normalizer = PhoneNormalizer(country_code='33')
+        self.assertEqual(normalizer.normalize('06 12 34 56 78'), 
+                         '+33612345678')
+        self.assertEqual(normalizer.normalize('612345678'), '+33612345678')
+        self.assertEqual(normalizer.normalize('0033612345678'), 
+                         '+33612345678')
+        self.assertEqual(normalizer.normalize('36 15'), '3615')
+
+
+    def test_sender_ids_are_left_as_is(self):
+
+        normalizer = PhoneNormalizer(country_code='33')
+        self.assertEqual(normalizer.normalize('Orange'), 'Orange')
+        self.assertEqual(normalizer.normalize('+33 Info'), '+33 Info')
+        self.assertEqual(normalizer.normalize(''), '')
+        self.assertEqual(normalizer.normalize(None), None)
+
+
+    def test_cache(self):
+
+        normalizer = PhoneNormalizer()
+        normalizer.normalize('0022376000000')
+        normalizer.normalize('0022376000000')
+        self.assertEqual((normalizer.cache.hits, normalizer.cache.misses), 
+                         (1, 1))
+
+
+    def test_settings(self):
+
+        try:
+            settings.PHONE_COUNTRY_CODE = '223'
+            self.assertEqual(normalize('76000000'), '+22376000000')
+            settings.PHONE_NORMALIZATION = False
+            self.assertEqual(normalize('76000000'), '76000000')
+        finally:
+            settings.PHONE_COUNTRY_CODE = None
+            settings.PHONE_NORMALIZATION = True
+
+
+    def test_messages_numbers_are_normalized(self):
+
+        self.assertEqual(IncomingMessage('0022376000000', 'foo').author, 
+                         '+22376000000')
+        self.assertEqual(OutgoingMessage('+223 76 00 00 00', 'foo').recipient, 
+                         '+22376000000')
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
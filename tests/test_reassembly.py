@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+
+from pragmatic_sms.reassembly import ReassemblyBuffer, Reassembled
+
+
+class TestReassemblyBuffer(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.buffer = ReassemblyBuffer(timeout=10, max_fragments=5)
+
+
+    def test_parts_in_any_order(self):
+
+        self.assertEqual(self.buffer.add('+2231', 1, 3, 3, u'c', now=1), [])
+        self.assertEqual(self.buffer.add('+2231', 1, 3, 1, u'a', now=1), [])
+        self.assertEqual(self.buffer.held, 2)
+        self.assertEqual(self.buffer.add('+2231', 1, 3, 2, u'b', now=1),
+                         [Reassembled('+2231', u'abc', True)])
+        self.assertEqual((len(self.buffer), self.buffer.held), (0, 0))
+        self.assertEqual(self.buffer.completed, 1)
+
+
+    def test_messages_are_kept_apart(self):
+
+        self.buffer.add('+2231', 1, 2, 1, u'a')
+        self.buffer.add('+2232', 1, 2, 1, u'x')
+        self.buffer.add('+2231', 2, 2, 1, u'1')
+        self.assertEqual(self.buffer.add('+2232', 1, 2, 2, u'y'),
+                         [Reassembled('+2232', u'xy', True)])
+        self.assertEqual(len(self.buffer), 2)
+
+
+    def test_duplicates(self):
+
+        self.buffer.add('+2231', 1, 2, 1, u'a')
+        self.assertEqual(self.buffer.add('+2231', 1, 2, 1, u'a'), [])
+        self.assertEqual((self.buffer.held, self.buffer.duplicates), (1, 1))
+
+
+    def test_expire(self):
+
+        self.buffer.add('+2231', 1, 3, 1, u'a', now=1)
+        self.buffer.add('+2231', 1, 3, 3, u'c', now=2)
+        self.buffer.add('+2232', 1, 2, 1, u'x', now=5)
+        self.assertEqual(self.buffer.expire(now=10), [])
+        self.assertEqual(self.buffer.expire(now=11),
+                         [Reassembled('+2231', u'ac', False)])
+        self.assertEqual(self.buffer.stats(), 
+                         {'messages': 1, 'fragments': 1, 'completed': 0,
+                          'flushed': 1, 'duplicates': 0})
+
+
+    def test_completed_messages_do_not_expire(self):
+
+        self.buffer.add('+2231', 1, 2, 1, u'a', now=1)
+        self.buffer.add('+2231', 1, 2, 2, u'b', now=1)
+        self.buffer.add('+2231', 1, 2, 1, u'c', now=5)
+        self.assertEqual(self.buffer.expire(now=12), [])
+        self.assertEqual(self.buffer.held, 1)
+
+
+    def test_max_fragments(self):
+
+        for i in range(3):
+            self.buffer.add('+2231', i, 3, 1, u'a', now=i)
+            self.buffer.add('+2231', i, 3, 2, u'b', now=i)
+        self.assertEqual(self.buffer.held, 4)
+        self.assertEqual(self.buffer.flushed, 1)
+        self.assertFalse(('+2231', 0, 3) in self.buffer.messages)
+
+
+    def test_compact(self):
+
+        buffer = ReassemblyBuffer()
+        for i in range(2000):
+            buffer.add('+2231', i, 2, 1, u'a')
+            buffer.add('+2231', i, 2, 2, u'b')
+        self.assertTrue(len(buffer.order) <= 1001)
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+import os
+import time
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.messages import IncomingMessage
+from pragmatic_sms.processors.base import MessageProcessor, memoize_replies
+
+
+class RecordingMessage(IncomingMessage):
+    """
+        Record the responses instead of sending them.
+    """
+
+    def respond(self, text):
+        self.responses = getattr(self, 'responses', []) + [text]
+
+
+
+class PriceMessageProcessor(MessageProcessor):
+
+    def __init__(self):
+        MessageProcessor.__init__(self)
+        self.prices = {u'PRICE MAIZE': 150}
+        self.lookups = 0
+
+
+    @memoize_replies(ttl=0.2, max_size=2)
+    def on_receive_message(self, message):
+        self.lookups += 1
+        price = self.prices.get(message.text.strip().upper())
+        if price is not None:
+            message.respond(u'%s: %s F' % (message.text, price))
+            return True
+
+
+
+class TestMemoizeReplies(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.processor = PriceMessageProcessor()
+
+
+    def receive(self, text, author='+2231'):
+        message = RecordingMessage(author, text)
+        handled = self.processor.on_receive_message(message)
+        return handled, getattr(message, 'responses', [])
+
+
+    def test_memoize_replies(self):
+
+        self.assertEqual(self.receive(u'price maize'),
+                         (True, [u'price maize: 150 F']))
+        self.assertEqual(self.receive(u'PRICE   Maize ', '+2232'),
+                         (True, [u'price maize: 150 F']))
+        self.assertEqual(self.processor.lookups, 1)
+
+        self.assertEqual(self.receive(u'hello'), (None, []))
+        self.assertEqual(self.receive(u'hello'), (None, []))
+        self.assertEqual(self.processor.lookups, 2)
+
+        self.assertEqual(self.processor.reply_stats(),
+                         {'size': 2, 'hits': 2, 'misses': 2, 'evictions': 0})
+
+        # the method is used again once the reply expired
+        time.sleep(0.2)
+        self.receive(u'PRICE MAIZE')
+        self.assertEqual(self.processor.lookups, 3)
+
+
+    def test_invalidate_replies(self):
+
+        self.receive(u'PRICE MAIZE')
+        self.processor.prices[u'PRICE MAIZE'] = 200
+        self.assertEqual(self.receive(u'PRICE MAIZE')[1],
+                         [u'PRICE MAIZE: 150 F'])
+
+        self.processor.invalidate_replies(u'price maize')
+        self.assertEqual(self.receive(u'PRICE MAIZE')[1],
+                         [u'PRICE MAIZE: 200 F'])
+
+        self.processor.invalidate_replies()
+        self.assertEqual(self.processor.reply_stats()['size'], 0)
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -5,6 +5,9 @@
 import unittest2
 import os
 import sys
+import shutil
+import tempfile
+import datetime
 
 from kombu.connection import BrokerConnection
 from kombu.messaging import Exchange, Queue
@@ -15,11 +18,14 @@ declare_settings_module('pragmatic_sms.tests.dummy_settings')
 
 from pragmatic_sms.conf import settings
 from pragmatic_sms.routing import SmsRouter
-from pragmatic_sms.messages import OutgoingMessage, IncomingMessage, Message, MessageWorker
+from pragmatic_sms.messages import (OutgoingMessage, IncomingMessage, Message,
+                                    MessageWorker, BroadcastMessage)
 from pragmatic_sms.utils import import_class
 from pragmatic_sms.processors.test import EchoMessageProcessor, CounterMessageProcessor
 from pragmatic_sms.processors.base import MessageProcessor
 from pragmatic_sms.settings import default_settings
+from pragmatic_sms.states import store, RELAYED, SUBMITTED, FAILED
+from pragmatic_sms.blocklist import Blocklist
 
 
 class TestRouting(unittest2.TestCase):
@@ -90,6 +96,15 @@ class TestRouting(unittest2.TestCase):
         self.assertTrue(CounterMessageProcessor.message_received)
 
 
+    def test_dispatch_incoming_messages_by_batch(self):
+
+        messages = [IncomingMessage('foo', 'test_dispatch_incoming_messages %s' % i)
+                    for i in range(3)]
+        self.message_worker.dispatch_incoming_messages(messages)
+        self.router.start(timeout=1, limit=1)
+        self.assertEqual(CounterMessageProcessor.message_received, 3)
+
+
     def test_handle_outgoing_message(self):
 
         self.router.producers['psms'].publish(body={'recipient': 'foo', 
@@ -122,6 +137,198 @@ class TestRouting(unittest2.TestCase):
         self.assertEqual(CounterMessageProcessor.message_received, 2)
 
 
+    def test_message_states(self):
+
+        relayed = OutgoingMessage('foo', 'test_message_states relayed')
+        relayed.send()
+        submitted = OutgoingMessage('foo', 'test_message_states submitted')
+        submitted.smsc_id = 'abc'
+        submitted.set_state(SUBMITTED)
+
+        self.router.start(timeout=1, limit=2)
+        self.assertEqual(store.get(relayed.id).state, RELAYED)
+        self.assertEqual(store.get(submitted.id).state, SUBMITTED)
+        self.assertEqual(store.get_by_smsc_id('default', 'abc').id, 
+                         submitted.id)
+
+
+    def test_cancelled_messages_are_not_relayed(self):
+
+        tmp_dir = tempfile.mkdtemp()
+        settings.BLOCKLIST_PATH = os.path.join(tmp_dir, 'blocklist')
+        Blocklist(settings.BLOCKLIST_PATH).extend(['+223 70 00 00 00'])
+        settings.MESSAGE_PROCESSORS = (
+            'pragmatic_sms.processors.blocklist.BlocklistMessageProcessor',
+        )
+        self.router = SmsRouter(no_transports=True)
+        self.router.connect()
+
+        blocked = OutgoingMessage('+22370000000', 'test_cancelled blocked')
+        blocked.send()
+        allowed = OutgoingMessage('+22370000001', 'test_cancelled allowed')
+        allowed.send()
+        self.router.start(timeout=1, limit=2)
+        shutil.rmtree(tmp_dir)
+
+        self.assertEqual(store.get(blocked.id).state, FAILED)
+        self.assertEqual(store.get(blocked.id).error, 'blocklisted')
+        self.assertEqual(store.get(allowed.id).state, RELAYED)
+
+
+    def test_expired_messages_are_not_relayed(self):
+
+        self.router = SmsRouter(no_transports=True)
+        self.router.connect()
+
+        expired = OutgoingMessage('+22370000000', 'test_expired', 
+                                  expires_at=datetime.datetime(2000, 1, 1))
+        expired.send()
+        self.router.start(timeout=1, limit=1)
+
+        self.assertEqual(store.get(expired.id).state, FAILED)
+        self.assertEqual(store.get(expired.id).error, 'expired')
+        self.assertEqual(self.router.expired, 1)
+
+
+    def test_broadcast_message(self):
+
+        tmp_dir = tempfile.mkdtemp()
+        settings.BLOCKLIST_PATH = os.path.join(tmp_dir, 'blocklist')
+        Blocklist(settings.BLOCKLIST_PATH).extend(['+22370000002'])
+        settings.MESSAGE_PROCESSORS = (
+            'pragmatic_sms.processors.test.CounterMessageProcessor',
+            'pragmatic_sms.processors.blocklist.BlocklistMessageProcessor',
+        )
+        settings.BROADCAST_CHUNK_SIZE = 2
+        self.router = SmsRouter(no_transports=True)
+        self.router.connect()
+        self.router.purge()
+
+        recipients = ['+2237000000%s' % i for i in range(5)]
+        broadcast = BroadcastMessage(recipients, 'test_broadcast_message')
+        broadcast.send()
+        self.router.start(timeout=1, limit=1)
+        shutil.rmtree(tmp_dir)
+
+        self.assertEqual(CounterMessageProcessor.message_broadcast, 1)
+        self.assertEqual(CounterMessageProcessor.message_sent, 0)
+        self.assertEqual(store.get(broadcast.id).state, RELAYED)
+        self.assertEqual(self.router.get_queue_size('default_transport'), 4)
+
+
+    def test_outgoing_duplicates(self):
+
+        settings.OUTGOING_DUPLICATES_WINDOW = 60
+        try:
+            self.router = SmsRouter(no_transports=True)
+            self.router.connect()
+
+            first = OutgoingMessage('+22370000000', 'test_outgoing_duplicates')
+            first.send()
+            second = OutgoingMessage('+22370000000', 'test_outgoing_duplicates')
+            second.send()
+            self.router.start(timeout=1, limit=2)
+        finally:
+            settings.OUTGOING_DUPLICATES_WINDOW = None
+
+        self.assertEqual(store.get(first.id).state, RELAYED)
+        self.assertEqual(store.get(second.id).state, FAILED)
+        self.assertEqual(store.get(second.id).error, 'duplicate')
+
+
+    def test_coalesce_outgoing_messages(self):
+
+        settings.OUTGOING_COALESCE_DELAY = 2
+        try:
+            self.router = SmsRouter(no_transports=True)
+            self.router.connect()
+
+            first = OutgoingMessage('+22370000000', 'test_coalesce 1')
+            first.send()
+            second = OutgoingMessage('+22370000000', 'test_coalesce 2')
+            second.send()
+            self.router.start(timeout=1, limit=4)
+        finally:
+            settings.OUTGOING_COALESCE_DELAY = None
+
+        self.assertEqual(self.router.coalescer.merged, 1)
+        self.assertEqual(len(self.router.coalescer), 0)
+        self.assertEqual(store.get(first.id).state, RELAYED)
+        self.assertEqual(store.get(second.id).state, RELAYED)
+
+
+    def test_wait_for_response(self):
+
+        settings.MESSAGE_PROCESSORS = ('pragmatic_sms.processors.test.EchoMessageProcessor',)
+        router = SmsRouter(no_transports=True)
+        router.connect()
+
+        ignored = IncomingMessage('foo', 'test_wait_for_response ignored')
+        ignored_future = ignored.dispatch(wait_for_response=5)
+        message = IncomingMessage('foo', 'test_wait_for_response')
+        future = message.dispatch(wait_for_response=5)
+        ignored_future.listener.pending.pop(ignored.id)
+
+        # incoming message, then the two responses
+        router.start(timeout=1, limit=4)
+
+        response = future.result()
+        self.assertEqual(response.text, 'Echo "test_wait_for_response"')
+        self.assertEqual(response.response_to.id, message.id)
+        self.assertEqual(future.responses, [response])
+        self.assertFalse(ignored_future.done())
+
+
+    def test_no_response(self):
+
+        message = IncomingMessage('foo', 'test_no_response')
+        future = message.dispatch(wait_for_response=0.5)
+        self.assertEqual(future.result(), None)
+
+
+    def test_message_store_gets_the_final_state(self):
+
+        tmp_dir = tempfile.mkdtemp()
+        settings.MESSAGE_STORE_PATH = os.path.join(tmp_dir, 'messages.db')
+        settings.MESSAGE_PROCESSORS = (
+                        'pragmatic_sms.processors.store.MessageStoreProcessor',)
+        try:
+            router = SmsRouter(no_transports=True)
+            router.connect()
+            past = datetime.datetime.now() - datetime.timedelta(seconds=1)
+            OutgoingMessage('+2231', 'late', expires_at=past).send()
+            OutgoingMessage('+2231', 'on time').send()
+            router.start(timeout=1, limit=1)
+
+            history = router.message_processors[0].history('+2231')
+            self.assertEqual(sorted((m.text, m.state, m.error) 
+                                    for m in history),
+                             [('late', FAILED, 'expired'), 
+                              ('on time', RELAYED, None)])
+            self.assertEqual(router.message_states.listeners, [])
+        finally:
+            settings.MESSAGE_STORE_PATH = None
+            shutil.rmtree(tmp_dir)
+
+
+    def test_requeue_interrupted_message(self):
+
+        settings.MESSAGE_PROCESSORS = (
+                        'pragmatic_sms.processors.test.SlowMessageProcessor',
+                        'pragmatic_sms.processors.test.CounterMessageProcessor')
+        router = SmsRouter(no_transports=True)
+        router.connect()
+
+        IncomingMessage('+2231', 'test_requeue_interrupted_message').dispatch()
+        router.start(timeout=1, limit=1)
+
+        # requeued for the slow processor only after each timeout, then
+        # not handled once it is in quarantine
+        stats = router.watchdog.stats()['SlowMessageProcessor']
+        self.assertEqual((stats['timeouts'], stats['skipped']), (3, 1))
+        self.assertEqual(CounterMessageProcessor.message_received, 1)
+
+
     def test_message_send_method(self):
         message = OutgoingMessage('foo', 'test_message_send_method')
         message.send()
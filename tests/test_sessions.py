@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+import os
+import shutil
+import tempfile
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.sessions import SessionStore
+from pragmatic_sms.processors.base import MessageProcessor
+
+
+class TestSessionStore(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'sessions.db')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+    def test_sessions_in_memory(self):
+
+        store = SessionStore(max_size=2, ttl=10)
+        session = store.get('123', now=1)
+        session['step'] = 1
+        self.assertEqual(store.get('123', now=2)['step'], 1)
+        self.assertEqual(store.get('123', now=12), {})
+
+        store.get('456', now=20)
+        store.get('789', now=20)
+        store.get('000', now=20)
+        stats = store.stats()
+        self.assertEqual((stats['size'], stats['evictions']), (2, 2))
+        self.assertEqual((stats['hits'], stats['misses']), (1, 5))
+        self.assertAlmostEqual(stats['hit_rate'], 1 / 6.0)
+        self.assertTrue(stats['memory'] > 0)
+
+
+    def test_sessions_on_disk(self):
+
+        store = SessionStore(ttl=10, path=self.path)
+        session = store.get('123', now=1)
+        session['step'] = 1
+        session.save()
+
+        other = SessionStore(ttl=10, path=self.path)
+        self.assertEqual(other.get('123', now=2), {'step': 1})
+        other_session = other.get('123', now=2)
+        other_session['step'] = 2
+        other.save(other_session, now=3)
+
+        self.assertEqual(store.get('123', now=4), {'step': 2})
+        self.assertEqual(store.get('123', now=14), {})
+
+        store.get('123', now=4).delete()
+        self.assertEqual(other.get('123', now=4), {})
+
+
+    def test_expired_sessions_purged(self):
+
+        store = SessionStore(ttl=10, path=self.path)
+        store.expire_interval = 30
+        for key, now in (('123', 100), ('456', 105), ('789', 120)):
+            store.save(store.get(key, now=now), now=now)
+
+        count = lambda: store.connection.execute('SELECT COUNT(*) FROM '\
+                                                 'sessions').fetchone()[0]
+        # not purged before 'expire_interval' seconds
+        self.assertEqual(count(), 3)
+        store.save(store.get('000', now=131), now=131)
+        self.assertEqual(count(), 1)
+        self.assertEqual(len(store.cache), 1)
+
+
+    def test_namespaces(self):
+
+        store = SessionStore('foo', path=self.path)
+        session = store.get('123')
+        session['step'] = 1
+        session.save()
+        self.assertEqual(SessionStore('bar', path=self.path).get('123'), {})
+
+
+    def test_processor_session(self):
+
+        processor = MessageProcessor()
+        processor.session('123')['step'] = 1
+        self.assertEqual(processor.session('123'), {'step': 1})
+        self.assertEqual(processor.sessions.namespace, 'MessageProcessor')
+        self.assertEqual(MessageProcessor().session('123'), {})
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+import os
+import time
+import socket
+import struct
+import threading
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.messages import OutgoingMessage
+from pragmatic_sms.transports import smpp
+from pragmatic_sms.transports.smpp import (SMPPMessageTransport, SMPPClient,
+                                           PDU, pack_short_message,
+                                           unpack_short_message)
+
+
+class FakeSMSC(object):
+    """
+        A stand-in SMSC answering each submit_sm after 'latency' seconds,
+        with the status set in 'statuses' for its destination, or ESME_ROK.
+
+        It records the submitted messages and the max number of submit_sm
+        waiting for a response at once.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.statuses = {}
+        self.submitted = []
+        self.enquire_links = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.connections = []
+        self.lock = threading.Lock()
+
+        self.socket = socket.socket()
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(5)
+        self.port = self.socket.getsockname()[1]
+
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+
+    def accept(self):
+        while True:
+            try:
+                connection, address = self.socket.accept()
+            except socket.error:
+                return
+            self.connections.append(connection)
+            thread = threading.Thread(target=self.serve, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+
+    def read_pdu(self, connection, buffer):
+        while len(buffer[0]) < 4 or \
+              len(buffer[0]) < struct.unpack('>I', buffer[0][:4])[0]:
+            chunk = connection.recv(4096)
+            if not chunk:
+                return None
+            buffer[0] += chunk
+        length = struct.unpack('>I', buffer[0][:4])[0]
+        data, buffer[0] = buffer[0][:length], buffer[0][length:]
+        return PDU.unpack(data)
+
+
+    def send_pdu(self, connection, pdu):
+        with self.lock:
+            connection.sendall(pdu.pack())
+
+
+    def serve(self, connection):
+        buffer = ['']
+        while True:
+            try:
+                pdu = self.read_pdu(connection, buffer)
+            except socket.error:
+                return
+            if pdu is None:
+                return
+
+            if pdu.command_id in (smpp.BIND_RECEIVER, smpp.BIND_TRANSMITTER,
+                                  smpp.BIND_TRANSCEIVER):
+                self.send_pdu(connection, PDU(pdu.command_id | smpp.RESPONSE,
+                                              pdu.sequence, 'fake\0'))
+
+            elif pdu.command_id == smpp.SUBMIT_SM:
+                source, destination, esm, text, concat = \
+                                                unpack_short_message(pdu.body)
+                with self.lock:
+                    self.submitted.append((destination, text))
+                    self.in_flight += 1
+                    self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                timer = threading.Timer(self.latency, self.respond,
+                                        (connection, pdu, destination))
+                timer.start()
+
+            elif pdu.command_id == smpp.ENQUIRE_LINK:
+                self.enquire_links += 1
+                self.send_pdu(connection, PDU(smpp.ENQUIRE_LINK | smpp.RESPONSE,
+                                              pdu.sequence))
+
+            elif pdu.command_id == smpp.UNBIND:
+                self.send_pdu(connection, PDU(smpp.UNBIND | smpp.RESPONSE,
+                                              pdu.sequence))
+                connection.close()
+                return
+
+
+    def respond(self, connection, pdu, destination):
+        with self.lock:
+            self.in_flight -= 1
+        status = self.statuses.get(destination, smpp.ESME_ROK)
+        body = 'id%s\0' % pdu.sequence if status == smpp.ESME_ROK else ''
+        try:
+            self.send_pdu(connection, PDU(smpp.SUBMIT_SM | smpp.RESPONSE,
+                                          pdu.sequence, body, status))
+        except socket.error:
+            pass
+
+
+    def deliver(self, source, text, esm_class=0):
+        body = pack_short_message(source, '1234', text)
+        if esm_class:
+            offset = body.index('1234\0') + 5
+            body = body[:offset] + chr(esm_class) + body[offset + 1:]
+        self.send_pdu(self.connections[-1], PDU(smpp.DELIVER_SM, 1, body))
+
+
+    def close(self):
+        self.socket.close()
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            connection.close()
+
+
+
+class TestSMPPMessageTransport(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.smsc = FakeSMSC()
+
+
+    def tearDown(self):
+        self.smsc.close()
+
+
+    def get_transport(self, **kwargs):
+        transport = SMPPMessageTransport('smpp', 'send_messages',
+                                         host='127.0.0.1', port=self.smsc.port,
+                                         source_addr='1234', timeout=5,
+                                         **kwargs)
+        transport.connect()
+        return transport
+
+
+    def test_pack_unpack_short_message(self):
+
+        body = pack_short_message('1234', '+2231', u'héhé')
+        self.assertEqual(unpack_short_message(body),
+                         ('1234', '+2231', 0, u'héhé', None))
+        body = pack_short_message(u'1234', u'+2231', u'héhé')
+        self.assertEqual(type(body), str)
+        self.assertEqual(unpack_short_message(body),
+                         ('1234', '+2231', 0, u'héhé', None))
+        for sender in (u'Société', 'Soci\xc3\xa9t\xc3\xa9'):
+            self.assertRaises(smpp.SMPPError, pack_short_message, sender,
+                              '+2231', 'hello')
+        body = pack_short_message('1234', '+2231', 'a' * 300)
+        self.assertEqual(unpack_short_message(body)[3], 'a' * 300)
+
+
+    def test_send_messages(self):
+
+        transport = self.get_transport()
+        messages = [OutgoingMessage('+223%s' % i, u'hé %s' % i)
+                    for i in range(3)]
+        self.assertEqual(transport.on_send_messages(messages), [True] * 3)
+        self.assertEqual(sorted(self.smsc.submitted),
+                         [('+223%s' % i, u'hé %s' % i) for i in range(3)])
+        transport.client.unbind()
+
+
+    def test_errors(self):
+
+        self.smsc.statuses['+2231'] = smpp.ESME_RTHROTTLED
+        self.smsc.statuses['+2232'] = 0x0b  # invalid destination
+        transport = self.get_transport()
+        messages = [OutgoingMessage('+223%s' % i, 'hello') for i in range(3)]
+        self.assertEqual(transport.on_send_messages(messages),
+                         [True, False, True])
+        transport.client.unbind()
+
+
+    def test_not_ascii_addresses(self):
+
+        transport = self.get_transport()
+        messages = [OutgoingMessage(u'+2231', u'hello'), 
+                    OutgoingMessage(u'+223é', u'hello')]
+        self.assertEqual(transport.on_send_messages(messages), [True, True])
+        self.assertEqual(messages[0].error, None)
+        self.assertTrue(messages[1].error.startswith('Address'))
+        self.assertEqual(self.smsc.submitted, [('+2231', u'hello')])
+        transport.client.unbind()
+
+
+    def test_window_pipelining(self):
+
+        self.smsc.latency = 0.05
+        transport = self.get_transport(window=10)
+        messages = [OutgoingMessage('+223%s' % i, 'hello') for i in range(40)]
+
+        start = time.time()
+        self.assertEqual(transport.on_send_messages(messages), [True] * 40)
+
+        # one message at a time would take 2 seconds
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(self.smsc.max_in_flight, 10)
+        transport.client.unbind()
+
+
+    def test_batch_timeout(self):
+
+        self.smsc.latency = 0.2
+        transport = self.get_transport(window=2)
+        transport.timeout = 0.3
+        messages = [OutgoingMessage('+223%s' % i, 'hello') for i in range(6)]
+
+        # one deadline for the whole batch: the second group runs out of
+        # time, and the last one is not sent but put back in the queue
+        start = time.time()
+        self.assertEqual(transport.on_send_messages(messages),
+                         [True] * 4 + [False] * 2)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(len(self.smsc.submitted), 4)
+        self.assertEqual(len(transport.unconfirmed), 2)
+        transport.client.unbind()
+
+
+    def test_window_of_one(self):
+
+        transport = self.get_transport(window=1)
+        messages = [OutgoingMessage('+223%s' % i, 'hello') for i in range(5)]
+        self.assertEqual(transport.on_send_messages(messages), [True] * 5)
+        self.assertEqual(self.smsc.max_in_flight, 1)
+        transport.client.unbind()
+
+
+    def test_connection_lost(self):
+
+        transport = self.get_transport()
+        messages = [OutgoingMessage('+2231', 'hello')]
+        self.assertEqual(transport.on_send_messages(messages), [True])
+        self.smsc.close()
+        time.sleep(0.1)
+        self.assertFalse(transport.client.bound)
+        transport.client.port = 1
+        self.assertEqual(transport.on_send_messages(messages), [False])
+
+
+    def test_late_response(self):
+
+        self.smsc.latency = 0.3
+        self.smsc.statuses['+2232'] = 0x0b  # invalid destination
+        transport = self.get_transport()
+        transport.timeout = 0.1
+        published = []
+        transport.publish_message_states = published.extend
+
+        # not sent again, as the SMSC may have accepted them
+        messages = [OutgoingMessage('+223%s' % i, 'hello') for i in (1, 2)]
+        self.assertEqual(transport.on_send_messages(messages), [True, True])
+        self.assertEqual(len(transport.unconfirmed), 2)
+        self.assertEqual(transport.client.pending, {})
+
+        time.sleep(0.4)
+        transport.reconcile_submits()
+        self.assertEqual(transport.unconfirmed, {})
+        self.assertEqual(published, messages)
+        self.assertTrue(messages[0].smsc_id.startswith('id'))
+        self.assertEqual(messages[1].error, 'SMSC status 0xb')
+
+        # the responses which will never arrive
+        messages = [OutgoingMessage('+2231', 'hello')]
+        transport.on_send_messages(messages)
+        transport.client.connection_lost(smpp.SMPPError('Lost'))
+        transport.reconcile_submits()
+        self.assertEqual(transport.unconfirmed, {})
+        self.assertEqual(len(published), 2)
+
+
+    def test_deliver_sm(self):
+
+        delivered = []
+        client = SMPPClient('127.0.0.1', self.smsc.port, 'psms', 'secret',
+                            on_deliver=lambda *args: delivered.append(args))
+        client.bind(smpp.BIND_RECEIVER)
+        self.smsc.deliver('+2231', u'héhé')
+        client.process_pdus()
+        self.assertEqual(delivered, [('+2231', '1234', 0, u'héhé', None)])
+        client.unbind()
+
+
+    def test_unpack_concatenated_message(self):
+
+        body = pack_short_message('1234', '+2231', 'hello')
+        offset = body.index('+2231\0') + 6
+        body = body[:offset] + chr(smpp.ESM_UDHI) + body[offset + 1:]
+        offset = body.index('hello') - 1
+        body = body[:offset] + chr(11) + '\x05\x00\x03\x2a\x02\x01hello'
+        self.assertEqual(unpack_short_message(body), 
+                         ('1234', '+2231', smpp.ESM_UDHI, u'hello', 
+                          (0x2a, 2, 1)))
+
+        body = pack_short_message('1234', '+2231', 'hello')
+        body += struct.pack('>HHH', smpp.SAR_MSG_REF_NUM_TAG, 2, 300)
+        body += struct.pack('>HHB', smpp.SAR_TOTAL_SEGMENTS_TAG, 1, 2)
+        body += struct.pack('>HHB', smpp.SAR_SEGMENT_SEQNUM_TAG, 1, 2)
+        self.assertEqual(unpack_short_message(body)[3:], 
+                         (u'hello', (300, 2, 2)))
+
+
+    def test_receive_concatenated_message(self):
+
+        transport = self.get_transport()
+        dispatched = []
+
+        class FakeMessage(object):
+            def __init__(self, reassembled):
+                self.text = reassembled.text
+            def dispatch(self):
+                dispatched.append(self.text)
+
+        transport.create_reassembled_message = FakeMessage
+        transport.receive_message('+2231', '1234', smpp.ESM_UDHI, u'world', 
+                                  (1, 2, 2))
+        self.assertEqual(transport.reassembly.held, 1)
+        transport.receive_message('+2231', '1234', smpp.ESM_UDHI, u'hello ', 
+                                  (1, 2, 1))
+        self.assertEqual(dispatched, [u'hello world'])
+        self.assertEqual(transport.reassembly.held, 0)
+
+
+    def test_delivery_receipts(self):
+
+        transport = self.get_transport()
+        receipts = []
+        transport.publish_delivery_receipt = lambda *args: receipts.append(args)
+        transport.receive_message('+2231', '1234', 0x04, 'id:1 sub:001 '\
+                                  'dlvrd:001 submit date:1101011200 '\
+                                  'done date:1101011201 stat:DELIVRD err:000')
+        transport.receive_message('+2231', '1234', 0x04, 'id:2 stat:UNDELIV')
+        transport.receive_message('+2231', '1234', 0x04, 'id:3 stat:ENROUTE')
+        self.assertEqual(receipts, [('1', 'delivered', None),
+                                    ('2', 'failed', 'UNDELIV')])
+
+
+    def test_smsc_ids(self):
+
+        self.smsc.statuses['+2232'] = 0x0b  # invalid destination
+        transport = self.get_transport()
+        messages = [OutgoingMessage('+223%s' % i, 'hello') for i in (1, 2)]
+        transport.on_send_messages(messages)
+        self.assertTrue(messages[0].smsc_id.startswith('id'))
+        self.assertEqual(messages[0].error, None)
+        self.assertEqual(messages[1].error, 'SMSC status 0xb')
+        transport.client.unbind()
+
+
+    def test_enquire_link(self):
+
+        client = SMPPClient('127.0.0.1', self.smsc.port, 'psms', 'secret',
+                            enquire_link_interval=0)
+        client.poll_interval = 0.1
+        client.bind(smpp.BIND_RECEIVER)
+        client.process_pdus()
+        client.process_pdus()
+        time.sleep(0.1)
+        self.assertTrue(self.smsc.enquire_links)
+        client.unbind()
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+import os
+import uuid
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.states import (MessageStateStore, QUEUED, RELAYED,
+                                  SUBMITTED, DELIVERED, FAILED)
+
+
+class TestMessageStateStore(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.store = MessageStateStore()
+        self.id = str(uuid.uuid4())
+
+
+    def test_update_and_get(self):
+
+        self.assertEqual(self.store.get(self.id), None)
+        self.assertTrue(self.store.update(self.id, QUEUED, now=1))
+        self.assertTrue(self.store.update(self.id, RELAYED, now=2))
+        state = self.store.get(self.id)
+        self.assertEqual((state.id, state.state, state.updated),
+                         (self.id, RELAYED, 2))
+        self.assertEqual(self.store.counts[RELAYED], 1)
+        self.assertEqual(self.store.counts[QUEUED], 0)
+
+
+    def test_ids_which_are_not_uuids(self):
+
+        self.store.update('foo', QUEUED)
+        self.assertEqual(self.store.get('foo').state, QUEUED)
+
+
+    def test_states_never_go_back(self):
+
+        self.store.update(self.id, SUBMITTED)
+        self.assertFalse(self.store.update(self.id, RELAYED))
+        self.store.update(self.id, FAILED, error='UNDELIV')
+        self.assertFalse(self.store.update(self.id, DELIVERED))
+        self.assertEqual(self.store.get(self.id).state, FAILED)
+        self.assertEqual(self.store.get(self.id).error, 'UNDELIV')
+
+
+    def test_delivery_receipt(self):
+
+        self.store.update(self.id, SUBMITTED, smsc_id='abc', transport='smpp')
+        self.assertTrue(self.store.update(state=DELIVERED, smsc_id='abc',
+                                          transport='smpp'))
+        self.assertEqual(self.store.get(self.id).state, DELIVERED)
+        self.assertEqual(self.store.get(self.id).smsc_id, 'abc')
+        self.assertEqual(self.store.get_by_smsc_id('smpp', 'abc').id, self.id)
+
+        # SMSC ids are unique per transport only
+        self.assertEqual(self.store.get_by_smsc_id('kannel', 'abc'), None)
+        self.assertFalse(self.store.update(state=DELIVERED, smsc_id='abc',
+                                           transport='kannel'))
+
+
+    def test_max_size(self):
+
+        store = MessageStateStore(max_size=2)
+        ids = [str(uuid.uuid4()) for i in range(3)]
+        for i, id in enumerate(ids):
+            store.update(id, SUBMITTED, smsc_id=str(i), transport='smpp')
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.get(ids[0]), None)
+        self.assertEqual(store.get_by_smsc_id('smpp', '0'), None)
+        self.assertEqual(store.counts[SUBMITTED], 2)
+
+
+    def test_handle_batch(self):
+
+        other = str(uuid.uuid4())
+        self.store.handle({'batch': [{'id': self.id, 'state': SUBMITTED},
+                                     {'id': other, 'state': FAILED,
+                                      'error': 'refused'}]})
+        self.assertEqual(self.store.get(self.id).state, SUBMITTED)
+        self.assertEqual(self.store.get(other).error, 'refused')
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
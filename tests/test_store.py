@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+import os
+import shutil
+import Queue
+import tempfile
+import datetime
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.messages import IncomingMessage, OutgoingMessage
+from pragmatic_sms.processors.store import MessageStoreProcessor
+from pragmatic_sms.states import MessageState, QUEUED, RELAYED, FAILED
+
+
+class TestMessageStoreProcessor(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = MessageStoreProcessor(os.path.join(self.dir, 'test.db'),
+                                           batch_size=3)
+        self.start = datetime.datetime(2011, 1, 1)
+
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+
+    def date(self, minutes):
+        return self.start + datetime.timedelta(minutes=minutes)
+
+
+    def test_history(self):
+
+        for i in range(5):
+            message = IncomingMessage('123', 'ping %s' % i,
+                                      reception_date=self.date(i))
+            response = message.create_response('pong %s' % i)
+            response.creation_date = self.date(i + 0.5)
+            self.store.on_receive_message(message)
+            self.store.on_send_message(response)
+        self.store.on_receive_message(IncomingMessage('456', 'other'))
+        self.store.flush()
+
+        history = self.store.history('123')
+        self.assertEqual(len(history), 10)
+        self.assertEqual([m.text for m in history[-2:]], ['pong 0', 'ping 0'])
+        self.assertTrue(isinstance(history[-1], IncomingMessage))
+        self.assertTrue(isinstance(history[-2], OutgoingMessage))
+        self.assertEqual(history[-1].reception_date, self.date(0))
+
+        history = self.store.history('123', since=self.date(3), limit=3)
+        self.assertEqual([m.text for m in history], 
+                         ['pong 4', 'ping 4', 'pong 3'])
+
+
+    def test_history_normalizes_the_number(self):
+
+        self.store.on_receive_message(IncomingMessage('0022376000000', 'hi'))
+        self.store.flush()
+        self.assertEqual([m.text for m in 
+                          self.store.history('00223 76 00 00 00')], ['hi'])
+        self.assertEqual([m.text for m in 
+                          self.store.history('+22376000000')], ['hi'])
+
+
+    def test_responses(self):
+
+        message = IncomingMessage('123', 'ping')
+        self.store.on_receive_message(message)
+        self.store.on_send_message(message.create_response('pong'))
+        self.store.on_send_message(message.create_response('pong again'))
+        self.store.flush()
+
+        responses = self.store.responses(message)
+        self.assertEqual([m.text for m in responses], ['pong', 'pong again'])
+        self.assertEqual(responses[0].response_to, message.id)
+
+
+    def test_messages_are_recorded_once(self):
+
+        message = OutgoingMessage('123', 'hello', creation_date=self.date(0))
+        self.store.on_send_message(message)
+        self.store.on_send_message(message)
+        self.store.flush()
+        self.assertEqual(len(self.store.history('123')), 1)
+
+
+    def test_message_states(self):
+
+        message = OutgoingMessage('123', 'hello', creation_date=self.date(0))
+        # the router records the message as queued before the processors
+        self.store.on_message_state(MessageState(message.id, QUEUED, 0, 
+                                                 None, None))
+        self.store.on_send_message(message)
+        self.store.on_message_state(MessageState(message.id, FAILED, 1, 
+                                                 None, 'blocklisted'))
+        other = OutgoingMessage('123', 'hi', creation_date=self.date(1))
+        self.store.on_send_message(other)
+        self.store.flush()
+
+        self.assertEqual([(m.text, m.state, m.error) 
+                          for m in self.store.history('123')],
+                         [('hi', None, None), 
+                          ('hello', FAILED, 'blocklisted')])
+
+
+    def test_messages_are_dropped_when_the_queue_is_full(self):
+
+        self.store.close()
+        self.store = MessageStoreProcessor(os.path.join(self.dir, 'full.db'),
+                                           max_pending=2)
+        # stop the writer so the messages stay in the queue
+        self.store.close()
+        for i in range(3):
+            self.store.on_receive_message(IncomingMessage('123', 'ping'))
+        self.assertEqual(self.store.dropped, 1)
+        self.store.pending = Queue.Queue()
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+import os
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.templates import Template, get_template, render
+from pragmatic_sms.encoding import analyze, GSM7, UCS2
+
+
+class TestTemplate(unittest2.TestCase):
+
+
+    def test_compile(self):
+
+        template = Template('Hello %(name)s, 100%% sure, 5% off: %(code)s')
+        self.assertEqual(template.parts, 
+                         (u'Hello ', u', 100% sure, 5% off: ', u''))
+        self.assertEqual(template.fields, ('name', 'code'))
+        self.assertEqual(template.render(name=u'Awa', code=12),
+                         u'Hello Awa, 100% sure, 5% off: 12')
+        self.assertEqual(Template(u'No field').render(), u'No field')
+
+
+    def test_render(self):
+
+        contexts = [{'name': u'Awa'}, {'name': u'Moïse'}, {'name': u'Ваня'},
+                    {'name': u'%(name)s'}, {'name': 42}]
+        sources = [u'Hello %(name)s', u'Prix: 5€, 100%% %(name)s', 
+                   u'%(name)s' * 3]
+
+        for source in sources:
+            template = Template(source)
+            for context in contexts:
+                self.assertEqual(template.render(context), 
+                                 unicode(context['name']).join(
+                                    [part.replace(u'%%', u'%') 
+                                     for part in source.split(u'%(name)s')]))
+
+        self.assertRaises(KeyError, template.render, {'code': 1})
+
+
+    def test_analyze(self):
+
+        template = Template(u'Prix: 5€, code %(code)s')
+        self.assertEqual((template.fixed_gsm7, template.fixed_extended,
+                          template.fixed_septets, template.fixed_units),
+                         (True, 1, 16, 15))
+
+        contexts = [{'name': u'Awa'}, {'name': u'Moïse'}, {'name': u'Ваня'},
+                    {'name': u'{Awa}' * 40}, {'name': u'a' * 150}, 
+                    {'name': u'é' * 80}, {'name': 42}, {'name': ''}]
+        sources = [u'Hello %(name)s', u'Prix: 5€, 100%% %(name)s', 
+                   u'%(name)s' * 3, u'Привет %(name)s', u'No field', 
+                   u'[%(name)s]' + u'x' * 150]
+
+        for source in sources:
+            template = Template(source)
+            for context in contexts:
+                self.assertEqual(template.analyze(context),
+                                 analyze(template.render(context)))
+        self.assertEqual(Template(u'Hi %(name)s').analyze(name=u'Awa'),
+                         (GSM7, 6, 1))
+        self.assertEqual(Template(u'Hi %(name)s').analyze(name=u'Ваня'),
+                         (UCS2, 7, 1))
+
+
+    def test_cache(self):
+
+        template = get_template(u'Your code is %(code)s')
+        self.assertTrue(get_template(u'Your code is %(code)s') is template)
+        self.assertEqual(render(u'Your code is %(code)s', code=1),
+                         u'Your code is 1')
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
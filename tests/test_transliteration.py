@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+import os
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.conf import settings
+from pragmatic_sms.encoding import transliterate, GSM7, UCS2
+from pragmatic_sms.messages import OutgoingMessage
+from pragmatic_sms.processors.transliteration import \
+                                            TransliterationMessageProcessor
+
+
+class FakeKombuMessage(object):
+
+    acked = False
+
+    def ack(self):
+        self.acked = True
+
+
+
+class TestTransliteration(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.processor = TransliterationMessageProcessor()
+
+
+    def tearDown(self):
+        settings.TRANSLITERATION_POLICIES = {}
+        settings.TRANSLITERATION_DEFAULT_POLICY = None
+
+
+    def test_transliterate(self):
+
+        self.assertEqual(transliterate(u'Ça coûte 5€ – ‘promo’…'),
+                         u"Ça coute 5€ - 'promo'...")
+        self.assertEqual(transliterate(u'ÈÊÁ ﬁn'), u'EEA fin')
+        self.assertEqual(transliterate(u'привет'), u'привет')
+        self.assertEqual(transliterate('plain'), u'plain')
+
+
+    def send(self, text, transport='default'):
+        message = OutgoingMessage('foo', text, transport)
+        self.processor.on_send_message(message)
+        return message
+
+
+    def test_no_policy(self):
+
+        self.assertEqual(self.send(u'‘promo’').text, u'‘promo’')
+
+
+    def test_gsm7_policy(self):
+
+        settings.TRANSLITERATION_DEFAULT_POLICY = 'gsm7'
+        message = self.send(u'‘promo’ ' * 20)
+        self.assertEqual(message.text, u"'promo' " * 20)
+        self.assertEqual(message.encoding, GSM7)
+        self.assertEqual(self.processor.segments_saved, 2)
+
+        # a text still in UCS-2 afterwards is left as is
+        self.assertEqual(self.send(u'‘привет’').text, u'‘привет’')
+        self.assertEqual(self.processor.transliterated, 1)
+
+
+    def test_segments_policy(self):
+
+        settings.TRANSLITERATION_POLICIES = {'modem': 'segments'}
+        self.assertEqual(self.send(u'‘promo’ ' * 20).text, u'‘promo’ ' * 20)
+        self.assertEqual(self.send(u'‘promo’ ' * 20, 'modem').text, 
+                         u"'promo' " * 20)
+        # saves no SMS
+        self.assertEqual(self.send(u'‘promo’', 'modem').text, u'‘promo’')
+
+
+    def test_always_policy(self):
+
+        settings.TRANSLITERATION_DEFAULT_POLICY = 'always'
+        message = self.send(u'‘привет’')
+        self.assertEqual(message.text, u"'привет'")
+        self.assertEqual(message.encoding, UCS2)
+
+
+    def test_cache(self):
+
+        settings.TRANSLITERATION_DEFAULT_POLICY = 'gsm7'
+        for i in range(3):
+            self.send(u'‘promo’')
+        self.assertEqual((self.processor.cache.hits, 
+                          self.processor.cache.misses), (2, 1))
+        self.assertEqual(self.processor.transliterated, 3)
+
+
+    def test_the_new_text_is_in_the_body(self):
+
+        settings.TRANSLITERATION_DEFAULT_POLICY = 'gsm7'
+        body = OutgoingMessage('foo', u'‘promo’').to_dict()
+        self.processor.handle_outgoing_message(body, FakeKombuMessage())
+        self.assertEqual(body['text'], u"'promo'")
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
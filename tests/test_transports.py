@@ -5,13 +5,14 @@
 import unittest2
 import os
 import sys
+import signal
 import threading
 import time
+import datetime
 
 from kombu.connection import BrokerConnection
 from kombu.messaging import Exchange, Queue, Consumer, Producer
 
-from pragmatic_sms.utils import check_output
 from pragmatic_sms.settings.manager import declare_settings_module
 
 test_dir = os.path.dirname(os.path.abspath(__file__))
@@ -20,8 +21,11 @@ declare_settings_module('dummy_settings', test_dir)
 from pragmatic_sms.conf import settings
 from pragmatic_sms.transports.base import MessageTransportError
 from pragmatic_sms.transports.test import (CounterMessageTransport,
-                                           FileCounterMessageTransport)
-from pragmatic_sms.messages import OutgoingMessage
+                                           FileCounterMessageTransport,
+                                           BatchCounterMessageTransport)
+from pragmatic_sms.transports.pool import SenderPool
+from pragmatic_sms.transports.health import HealthTable
+from pragmatic_sms.messages import OutgoingMessage, IncomingMessage
 from pragmatic_sms.routing import SmsRouter
 from pragmatic_sms.workers import WorkerError, PSMSWorker
 
@@ -32,7 +36,7 @@ class TestRouting(unittest2.TestCase):
     def setUp(self):
         CounterMessageTransport.reset()
         FileCounterMessageTransport.reset()
-        self.router = SmsRouter()
+        self.router = SmsRouter(no_transports=True)
         self.router.connect()
         self.router.purge()
         self.transport = CounterMessageTransport('default', 'send_messages')
@@ -46,31 +50,99 @@ class TestRouting(unittest2.TestCase):
             pass
 
 
-    def count_processes(self, pattern):
-        """
-            Return the number of process running matching this regexp
-        """
-
-        out = check_output('ps aux | grep %s | grep -v grep | wc -l' % (
-                            pattern,), shell=True)
-        return int(out)
-
-
     def test_start_daemons(self):
         
         self.transport.start_daemons()
 
-        self.assertEqual(self.count_processes("default.*receive_messages"), 1)
-        self.assertEqual(self.count_processes("default.*send_messages"), 1)
+        supervisor = self.transport.supervisor
+        self.assertTrue(supervisor.is_ready("default", "receive_messages"))
+        self.assertTrue(supervisor.is_ready("default", "send_messages"))
+
+
+    def test_send_messages_by_batch(self):
+
+        transport = BatchCounterMessageTransport('default', 'send_messages')
+        for text in ('foo', 'bar', 'fail'):
+            OutgoingMessage('foo', text).send()
+
+        self.router.start(1, 1)
+        transport.start_outgoing_messages_loop(limit=1)
+        self.assertEqual(BatchCounterMessageTransport.batches, [2, 1])
+
+        # the failed message went back to the queue
+        transport = BatchCounterMessageTransport('default', 'send_messages')
+        transport.start_outgoing_messages_loop(limit=1)
+        self.assertEqual(BatchCounterMessageTransport.batches, [1])
+
+
+    def test_pending_messages_sent_on_stop(self):
+
+        transport = BatchCounterMessageTransport('default', 'send_messages')
+        transport.batch_timeout = 60 * 1000
+        for text in ('foo', 'bar', 'baz'):
+            OutgoingMessage('foo', text).send()
+
+        self.router.start(1, 1)
+        transport.start_outgoing_messages_loop(timeout=1, limit=1)
+        self.assertEqual(BatchCounterMessageTransport.batches, [2, 1])
+        self.assertEqual(transport.pending, [])
+
+
+    def test_heartbeat(self):
+
+        self.transport.start_outgoing_messages_loop(1, 1)
+        self.assertEqual(self.transport.loops, 1)
+        self.router.start(1, 1)
+        health = self.router.health.entries[('default', 'send_messages', 0)]
+        self.assertEqual(health.loops, 1)
+        self.assertEqual(health.in_flight, 0)
 
 
     def test_stop_daemons(self):
 
         self.transport.start_daemons()
+        supervisor = self.transport.supervisor
+        sender = supervisor.processes[("default", "send_messages", 0)]
         self.transport.stop_daemons()
-        time.sleep(2)
-        self.assertEqual(self.count_processes("default.*receive_messages"), 0)
-        self.assertEqual(self.count_processes("default.*send_messages"), 0)
+
+        self.assertFalse(supervisor.is_alive("default", "receive_messages"))
+        self.assertFalse(supervisor.is_alive("default", "send_messages"))
+        # the loop returned instead of the process being killed
+        self.assertEqual(sender.exitcode, 0)
+
+
+    def test_restart_crashed_process(self):
+
+        self.transport.start_sending_messages_daemon()
+        supervisor = self.transport.supervisor
+        key = ("default", "send_messages", 0)
+        crashed = supervisor.processes[key]
+        os.kill(crashed.pid, signal.SIGKILL)
+        crashed.join()
+
+        # the router doesn't wait for the new process to be ready
+        start = time.time()
+        self.router.last_health_check = 0
+        self.router.check_transports_health()
+        self.assertLess(time.time() - start, 0.5)
+        self.assertTrue(supervisor.processes[key] is not crashed)
+        self.assertEqual(self.router.health.entries[key].restarts, 1)
+
+        self.assertTrue(supervisor.events[key].wait(5))
+        self.assertEqual(supervisor.check_unready(), [])
+        self.assertEqual(supervisor.unready, {})
+
+
+    def test_start_several_senders(self):
+
+        with self.transport.supervisor.parallel():
+            self.transport.start_sending_messages_daemon(0)
+            self.transport.start_sending_messages_daemon(1)
+
+        supervisor = self.transport.supervisor
+        self.assertTrue(supervisor.is_ready("default", "send_messages", 1))
+        self.transport.stop_sending_messages_daemon(1)
+        self.assertFalse(supervisor.is_alive("default", "send_messages", 1))
 
 
     def test_manual_outgoing_message(self):
@@ -84,10 +156,239 @@ class TestRouting(unittest2.TestCase):
         self.assertEqual(CounterMessageTransport.message_sent, 1)
 
 
+    def test_expired_messages_are_not_sent(self):
+
+        # expired after the router relayed it
+        message = OutgoingMessage('foo', 'bar', 
+                                  expires_at=datetime.datetime(2000, 1, 1))
+        self.router.producers['psms'].publish(body=message.to_dict(),
+                                              routing_key='default_transport')
+
+        self.transport.start_outgoing_messages_loop(1, 1)
+        self.assertEqual(CounterMessageTransport.message_sent, 0)
+        self.assertEqual(self.transport.expired, 1)
+        self.assertEqual(self.router.get_queue_size('expired_messages'), 1)
+
+
 
     # todo : make the router purge() call transport purge
 
 
 
+class RecordingMessageTransport(CounterMessageTransport):
+    """
+        Record the batches of incoming messages instead of publishing them,
+        and pretend the incoming message queue has the sizes in 'backlogs'.
+    """
+
+    dispatch_backoff = 0.01
+
+    def __init__(self, *args, **kwargs):
+        CounterMessageTransport.__init__(self, *args, **kwargs)
+        self.batches = []
+        self.backlogs = []
+
+
+    def publish_incoming_messages(self, messages):
+        self.batches.append([message.text for message in messages])
+        return CounterMessageTransport.publish_incoming_messages(self, messages)
+
+
+    def get_incoming_backlog(self):
+        return self.backlogs.pop(0) if self.backlogs else 0
+
+
+
+class TestDispatchMessages(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.transport = RecordingMessageTransport('default', 'receive_messages')
+        self.transport.connect()
+        self.watermark = settings.INCOMING_MESSAGES_HIGH_WATERMARK
+
+
+    def tearDown(self):
+        settings.INCOMING_MESSAGES_HIGH_WATERMARK = self.watermark
+        IncomingMessage.worker.purge()
+
+
+    def to_message(self, item):
+        if item != 3:
+            return IncomingMessage('foo', str(item))
+
+
+    def test_batch_size(self):
+
+        self.transport.dispatch_batch_size = 2
+        count = self.transport.dispatch_messages(xrange(6), self.to_message)
+        self.assertEqual(count, 5)
+        self.assertEqual(self.transport.batches, [['0', '1'], ['2', '4'], ['5']])
+
+
+    def test_batch_timeout(self):
+
+        def items():
+            yield 0
+            yield 1
+            time.sleep(0.2)
+            yield None
+            yield 2
+
+        self.transport.dispatch_batch_timeout = 0.1
+        self.transport.dispatch_messages(items(), self.to_message)
+        self.assertEqual(self.transport.batches, [['0', '1'], ['2']])
+
+
+    def test_items_are_read_lazily(self):
+
+        read = []
+        def items():
+            for i in range(4):
+                read.append(i)
+                yield IncomingMessage('foo', str(i))
+
+        self.transport.dispatch_batch_size = 2
+        self.transport.publish_incoming_messages = lambda messages: \
+            self.transport.batches.append(list(read)) or len(messages)
+        self.transport.dispatch_messages(items())
+        self.assertEqual(self.transport.batches, [[0, 1], [0, 1, 2, 3]])
+
+
+    def test_backpressure(self):
+
+        settings.INCOMING_MESSAGES_HIGH_WATERMARK = 10
+        self.transport.backlogs = [50, 20, 5]
+        self.transport.dispatch_messages([IncomingMessage('foo', 'bar')])
+        self.assertEqual(self.transport.backlogs, [])
+        self.assertEqual(self.transport.batches, [['bar']])
+
+
+
+class FakeTransport(object):
+    """
+        Record which senders are started and stopped
+    """
+
+    def __init__(self):
+        self.running = set()
+
+    def start_sending_messages_daemon(self, index=0):
+        self.running.add(index)
+
+    def stop_sending_messages_daemon(self, index=0):
+        self.running.remove(index)
+
+
+class TestHealthTable(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.health = HealthTable(stall_delay=10, min_delay=1, max_delay=8)
+        self.key = ('default', 'send_messages', 0)
+        self.heartbeat = {'name': 'default', 'purpose': 'send_messages',
+                          'index': 0, 'pid': 1, 'loops': 3, 'in_flight': 1,
+                          'latency': 0.5}
+
+
+    def test_update(self):
+
+        self.health.update(self.heartbeat, now=100)
+        row = self.health.as_table()[0]
+        self.assertEqual(row['loops'], 3)
+        self.assertEqual(row['latency'], 0.5)
+        self.assertEqual(row['last_seen'], 100)
+
+
+    def test_stall(self):
+
+        self.assertFalse(self.health.is_stalled(self.key, now=100))
+        self.health.update(self.heartbeat, now=100)
+        self.assertFalse(self.health.is_stalled(self.key, now=105))
+        self.assertTrue(self.health.is_stalled(self.key, now=110))
+
+
+    def test_restart_backoff(self):
+
+        self.assertTrue(self.health.can_restart(self.key, now=100))
+        self.health.restarted(self.key, now=100)
+        self.assertFalse(self.health.can_restart(self.key, now=100.5))
+        self.assertTrue(self.health.can_restart(self.key, now=101))
+        self.health.restarted(self.key, now=101)
+        self.assertFalse(self.health.can_restart(self.key, now=102))
+        self.assertTrue(self.health.can_restart(self.key, now=103))
+        for i in range(5):
+            self.health.restarted(self.key, now=103)
+        self.assertEqual(self.health.restart_delay(self.key), 8)
+
+
+    def test_backoff_reset(self):
+
+        self.health.restarted(self.key, now=100)
+        self.health.restarted(self.key, now=101)
+        self.health.update(self.heartbeat, now=102)
+        self.assertEqual(self.health.restart_delay(self.key), 2)
+        self.health.update(self.heartbeat, now=110)
+        self.assertEqual(self.health.restart_delay(self.key), 0)
+
+
+
+class TestSenderPool(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.pool = SenderPool(self.transport, min=1, max=3, 
+                               messages_per_sender=10, idle_delay=5)
+
+
+    def test_from_settings(self):
+
+        pool = SenderPool.from_settings(self.transport)
+        self.assertEqual((pool.min, pool.max), (1, 1))
+        pool = SenderPool.from_settings(self.transport, 2)
+        self.assertEqual((pool.min, pool.max), (2, 2))
+        pool = SenderPool.from_settings(self.transport, {'min': 1, 'max': 4})
+        self.assertEqual((pool.min, pool.max), (1, 4))
+
+
+    def test_start_stop(self):
+
+        self.pool.start()
+        self.assertEqual(self.transport.running, set([0]))
+        self.pool.stop()
+        self.assertEqual(self.transport.running, set())
+
+
+    def test_grow_with_backlog(self):
+
+        self.pool.start()
+        self.assertEqual(self.pool.adjust(15, now=100), 2)
+        self.assertEqual(self.pool.adjust(1000, now=101), 3)
+        self.assertEqual(self.transport.running, set([0, 1, 2]))
+
+
+    def test_shrink_when_idle(self):
+
+        self.pool.start()
+        self.pool.adjust(30, now=100)
+        self.assertEqual(self.pool.adjust(0, now=101), 3)
+        self.assertEqual(self.pool.adjust(0, now=105), 3)
+        self.assertEqual(self.pool.adjust(0, now=106), 2)
+        self.assertEqual(self.pool.adjust(0, now=111), 1)
+        self.assertEqual(self.pool.adjust(0, now=200), 1)
+        self.assertEqual(self.transport.running, set([0]))
+
+
+    def test_backlog_resets_idle_delay(self):
+
+        self.pool.start()
+        self.pool.adjust(30, now=100)
+        self.pool.adjust(0, now=101)
+        self.pool.adjust(30, now=104)
+        self.assertEqual(self.pool.adjust(0, now=106), 3)
+
+
+
 if __name__ == '__main__':
     unittest2.main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unittest2
+import os
+import time
+import logging
+
+from pragmatic_sms.settings.manager import declare_settings_module
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+declare_settings_module('dummy_settings', test_dir)
+
+from pragmatic_sms.watchdog import (Watchdog, Histogram, uninterruptible,
+                                    RETRY_KEY)
+from pragmatic_sms.processors.base import MessageProcessor
+
+
+class SlowMessageProcessor(MessageProcessor):
+
+    timeout = 0.05
+
+    def __init__(self):
+        MessageProcessor.__init__(self)
+        self.done = 0
+        self.blocks = 0
+
+
+    def handle_incoming_message(self, body, message):
+        try:
+            if body.get('uninterruptible'):
+                with uninterruptible():
+                    # sleep() would be cut short by the signal
+                    end = time.time() + body['sleep']
+                    while time.time() < end:
+                        pass
+                    self.blocks += 1
+            else:
+                time.sleep(body['sleep'])
+        except Exception:
+            pass
+        self.done += 1
+
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+
+    def emit(self, record):
+        self.records.append(record.getMessage())
+
+
+
+class TestWatchdog(unittest2.TestCase):
+
+
+    def setUp(self):
+        self.logger = logging.getLogger('test_watchdog')
+        self.logger.propagate = False
+        self.handler = RecordingHandler()
+        self.logger.addHandler(self.handler)
+        self.watchdog = Watchdog(timeout=1, quarantine_after=2,
+                                 quarantine_delay=0.2, logger=self.logger)
+        self.processor = SlowMessageProcessor()
+        self.callback = self.watchdog.wrap(self.processor,
+                                     self.processor.handle_incoming_message)
+
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+
+    def test_histogram(self):
+
+        histogram = Histogram((0.01, 0.1, 1))
+        for value in (0.005, 0.01, 0.05, 0.5, 2):
+            histogram.add(value)
+        self.assertEqual(histogram.counts, [2, 1, 1, 1])
+        self.assertEqual(histogram.percentile(40), 0.01)
+        self.assertEqual(histogram.percentile(100), 2)
+        self.assertEqual(Histogram().percentile(50), None)
+
+
+    def test_timeout(self):
+
+        self.callback({'sleep': 0}, None)
+        self.assertEqual(self.processor.done, 1)
+
+        start = time.time()
+        self.callback({'id': 'slow', 'sleep': 2}, None)
+        self.assertTrue(time.time() - start < 1)
+        # interrupted even if the processor catches Exception
+        self.assertEqual(self.processor.done, 1)
+
+        stats = self.watchdog.stats()['SlowMessageProcessor']
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['histogram']['count'], 2)
+        self.assertIn('slow', self.handler.records[0])
+        self.assertIn('handle_incoming_message', self.handler.records[0])
+
+
+    def test_interrupted(self):
+
+        message = object()
+        self.callback({'sleep': 2}, message)
+        self.assertTrue(self.watchdog.interrupted is message)
+        self.assertEqual(self.watchdog.interrupted_by, 
+                         ['SlowMessageProcessor'])
+
+        # a requeued message only goes to the interrupted processors
+        self.callback({'sleep': 0, RETRY_KEY: ['OtherProcessor']}, None)
+        self.assertEqual(self.processor.done, 0)
+        self.callback({'sleep': 0, RETRY_KEY: ['SlowMessageProcessor']}, None)
+        self.assertEqual(self.processor.done, 1)
+
+
+    def test_uninterruptible(self):
+
+        start = time.time()
+        self.callback({'sleep': 0.2, 'uninterruptible': True}, None)
+        # the block goes to the end, then the processor is interrupted
+        self.assertTrue(time.time() - start >= 0.2)
+        self.assertEqual((self.processor.blocks, self.processor.done), (1, 0))
+        self.assertEqual(self.watchdog.stats()['SlowMessageProcessor']
+                                              ['timeouts'], 1)
+
+        # no timeout left behind for the next block
+        self.callback({'sleep': 0, 'uninterruptible': True}, None)
+        self.assertEqual((self.processor.blocks, self.processor.done), (2, 1))
+
+
+    def test_quarantine(self):
+
+        self.callback({'sleep': 2}, None)
+        self.callback({'sleep': 0}, None)
+        self.callback({'sleep': 2}, None)
+        self.callback({'sleep': 2}, None)
+        self.callback({'sleep': 0}, None)
+
+        stats = self.watchdog.stats()['SlowMessageProcessor']
+        self.assertEqual(stats['timeouts'], 3)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertTrue(stats['quarantined_until'] is not None)
+        self.assertEqual(self.processor.done, 1)
+
+        time.sleep(0.2)
+        self.callback({'sleep': 0}, None)
+        self.assertEqual(self.processor.done, 2)
+
+
+
+if __name__ == '__main__':
+    unittest2.main()
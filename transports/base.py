@@ -8,20 +8,20 @@
 
 
 import os
-import sys
+import time
 import logging
 import socket
-import subprocess
 
 from kombu.messaging import Queue, Consumer
 from kombu.exceptions import NotBoundError
 
-from daemon import runner
-
 from pragmatic_sms.routing import SmsRouter, RoutingError
-from pragmatic_sms.messages import OutgoingMessage
+from pragmatic_sms.messages import OutgoingMessage, IncomingMessage
+from pragmatic_sms.states import SUBMITTED, FAILED
 from pragmatic_sms.conf import settings
 from pragmatic_sms.workers import PSMSWorker
+from pragmatic_sms.reassembly import ReassemblyBuffer
+from pragmatic_sms.transports.supervisor import supervisor
 
 # todo : provide method stop_in/out_messsage loop
 
@@ -87,7 +87,8 @@ class MessageTransport(PSMSWorker):
 
         The SmsRouter thread will automatically run two subprocesses for
         each message transport class, one for incoming messages, the other
-        one for outgoing messages.
+        one for outgoing messages. These processes are forked from the 
+        router and don't load the settings again.
 
         It will terminate these processes as well automatically on shut down.
         
@@ -99,10 +100,20 @@ class MessageTransport(PSMSWorker):
         override on_send_message(). It will be called as a callback for each
         new message to be sent. 
 
+        If your backend can send several messages at once, override 
+        on_send_messages() instead. It will be called with lists of up to
+        'batch_size' messages, waiting at most 'batch_timeout' milliseconds
+        to fill them.
+
         If you want more control over the way to process message to be send, 
         override start_incoming_messages_loop(). It will be run as a background
         process automatically for you. 
 
+        The sending process sends heartbeats to the router, which restarts it
+        if it stops sending them or crashes. If you want the same for your
+        incoming messages loop, call self.heartbeat() in it regularly: it's
+        cheap as it only sends a message every HEARTBEAT_INTERVAL seconds.
+
         See the each method docstring for more infos.
 
         Remember your message transport class will be instanciated TWICE in 
@@ -128,9 +139,23 @@ class MessageTransport(PSMSWorker):
         For example : /tmp/pragmatic_sms/transports/default/receive_messages_stderr
     """
 
-    RUNNER_SCRIPT = os.path.join(settings.PSMS_DIR, 'transports', 'runner.py')
+    supervisor = supervisor
+
+    # several processes can send messages for the same transport, each one
+    # with its own index (see transports.pool)
+    index = 0
 
-    pidfile_timeout = 1
+    # max number of messages passed to on_send_messages() and max number of 
+    # milliseconds to wait for them
+    batch_size = 50
+    batch_timeout = 200
+
+    # max number of messages published at once by dispatch_messages(), max
+    # number of seconds to wait for them, and number of seconds to wait
+    # when the router is late
+    dispatch_batch_size = 100
+    dispatch_batch_timeout = 1
+    dispatch_backoff = 1
 
 
     def __init__(self, name, purpose='send_messages', *args, **kwargs):
@@ -150,6 +175,23 @@ class MessageTransport(PSMSWorker):
 
         self.purpose = purpose
 
+        # stats sent to the router with the heartbeats
+        self.loops = 0
+        self.in_flight = 0
+        self.last_send_latency = None
+        self.last_heartbeat = 0
+        self.expired = 0
+
+        # messages waiting to be sent by on_send_messages()
+        self.batching = (self.on_send_messages.im_func is not 
+                         MessageTransport.on_send_messages.im_func)
+        self.pending = []
+        self.pending_since = None
+
+        # parts of long incoming messages, see receive_fragment()
+        self.reassembly = ReassemblyBuffer(settings.REASSEMBLY_TIMEOUT,
+                                           settings.REASSEMBLY_MAX_FRAGMENTS)
+
         self._setup_process_fd()
 
         
@@ -170,6 +212,16 @@ class MessageTransport(PSMSWorker):
                                     transport=self.name).dispatch()
                     sms = self.get_sms_from_your_super_transport()
 
+            If your backend can give you a lot of messages at once, pass
+            them to dispatch_messages() instead so they are published by
+            batch:
+
+                self.dispatch_messages(self.read_all_sms(), 
+                                       lambda sms: IncomingMessage(
+                                                    author=sms.phone_number,
+                                                    text=sms.content,
+                                                    transport=self.name))
+
             Another way to do that would be to start here a webserver waiting
             for POST request with the message data, then create
             the IncommingMessage for each POST request.
@@ -188,12 +240,137 @@ class MessageTransport(PSMSWorker):
                  'Transport "%s" stops listening for incoming messages' % self.name)
 
 
-    def start_outgoing_messages_loop(self, *args, **kwargs):
+    def stop_incoming_messages_loop(self):
+        """
+            Override this method to make start_incoming_messages_loop() 
+            return, usually by setting a flag checked by its loop. It's
+            called from the SIGTERM handler of the transport process.
+        """
+        pass
+
+
+    def dispatch_messages(self, items, to_message=None):
+        """
+            Dispatch the incoming messages made from 'items', an iterable of
+            whatever your backend gives you, such as a generator reading 
+            SMS. 'to_message' turns an item into an IncomingMessage, or 
+            returns None to skip it. Without it, items must be IncomingMessage 
+            objects.
+
+            Items are read and turned into messages only when needed, then
+            published by batches of up to 'dispatch_batch_size' messages, or
+            whatever arrived in 'dispatch_batch_timeout' seconds. A generator
+            waiting for SMS can yield None to let a late batch be published.
+
+            If more than INCOMING_MESSAGES_HIGH_WATERMARK messages are waiting
+            in the incoming message queue, no more items are read until the
+            router catches up, so they stay in your backend meanwhile.
+
+            Return the number of dispatched messages.
+        """
+        count = 0
+        batch = []
+        started = None
+
+        for item in items:
+
+            if item is not None:
+                message = to_message(item) if to_message else item
+                if message is not None:
+                    if not batch:
+                        started = time.time()
+                    batch.append(message)
+
+            if batch and (len(batch) >= self.dispatch_batch_size or 
+                          time.time() - started >= self.dispatch_batch_timeout):
+                count += self.publish_incoming_messages(batch)
+                batch = []
+
+            self.heartbeat()
+
+        if batch:
+            count += self.publish_incoming_messages(batch)
+
+        return count
+
+
+    def receive_fragment(self, author, reference, total, sequence, text,
+                         now=None):
+        """
+            Call it for each part of a long incoming message, with the
+            reference, number of parts and number of this part from its
+            header, instead of creating an IncomingMessage for each part.
+
+            Return the list of IncomingMessage to dispatch: the whole
+            message once its last part arrived, and the incomplete ones
+            flushed to keep the memory bounded by REASSEMBLY_MAX_FRAGMENTS.
+        """
+        return [self.create_reassembled_message(reassembled) 
+                for reassembled in self.reassembly.add(author, reference, 
+                                                       total, sequence, text,
+                                                       now)]
+
+
+    def expire_fragments(self, now=None):
+        """
+            Return the list of IncomingMessage whose missing parts didn't
+            arrive in REASSEMBLY_TIMEOUT seconds, with the parts which did.
+            Call it regularly in your incoming messages loop.
+        """
+        return [self.create_reassembled_message(reassembled) 
+                for reassembled in self.reassembly.expire(now)]
+
+
+    def create_reassembled_message(self, reassembled):
+        if not reassembled.complete:
+            self.log(logging.WARNING, 'Some parts of a message from %s never '\
+                                      'arrived' % reassembled.author)
+        return IncomingMessage(author=reassembled.author, 
+                               text=reassembled.text, transport=self.name)
+
+
+    def publish_incoming_messages(self, messages):
+        """
+            Wait until the router has room for these messages then publish
+            them at once. Return the number of messages, without the 
+            duplicates dropped.
+        """
+        limit = settings.INCOMING_MESSAGES_HIGH_WATERMARK
+        if limit is not None:
+            waiting = self.get_incoming_backlog()
+            if waiting > limit:
+                self.log(logging.WARNING, '%s incoming messages waiting to be '\
+                                          'processed, slowing down' % waiting)
+            while waiting > limit:
+                self.heartbeat()
+                time.sleep(self.dispatch_backoff)
+                waiting = self.get_incoming_backlog()
+
+        if len(messages) == 1:
+            return int(IncomingMessage.worker.dispatch_incoming_message(
+                                                                messages[0]))
+        return IncomingMessage.worker.dispatch_incoming_messages(messages)
+
+
+    def get_incoming_backlog(self):
+        """
+            Return the number of messages waiting in the incoming message 
+            queue.
+        """
+        return IncomingMessage.worker.get_queue_size('incoming_messages')
+
+
+    def start_outgoing_messages_loop(self, timeout=None, *args, **kwargs):
         """
             You usually don't want to override this method, as it just 
             calls the standard worker behavior for the main loop.
+
+            If the transport sends messages by batch, the default timeout
+            is the batch timeout so incomplete batches are not delayed.
         """
-        return self.start(*args, **kwargs)
+        if timeout is None:
+            timeout = self.batch_timeout / 1000.0 if self.batching else 1
+        return self.start(timeout, *args, **kwargs)
 
 
     def get_queues(self):
@@ -202,15 +379,24 @@ class MessageTransport(PSMSWorker):
         """
         queues = PSMSWorker.get_queues(self)
         name = "%s_transport" % self.name
+        arguments = None
+        if settings.TRANSPORT_QUEUES_TTL:
+            ttl = int(settings.TRANSPORT_QUEUES_TTL * 1000)
+            arguments = {'x-message-ttl': ttl}
         queues[name] = Queue(name, exchange=self.exchanges['psms'],
-                               routing_key=name)
+                               routing_key=name, queue_arguments=arguments)
         return queues
 
 
     def get_consumers(self):
         """
-            Only one consumer for the only transport queue
+            Only one consumer for the only transport queue, and only if 
+            this transport sends messages. Otherwise the broker could give
+            messages to a process that never process them.
         """
+        if self.purpose != 'send_messages':
+            return {}
+
         name = "%s_transport" % self.name
         consumer = Consumer(self.channel, self.queues[name])
         consumer.register_callback(self.handle_outgoing_message)
@@ -223,14 +409,168 @@ class MessageTransport(PSMSWorker):
             Default callback to the OutgoingMessage queue. This callback take
             a JSON message from the queue, turn it into an OutgoingMessage
             object then pass it to on_send_message().
+
+            Expired messages are dropped before that, see 
+            drop_expired_message().
         """
-        if self.on_send_message(OutgoingMessage(**body)):
+        if OutgoingMessage.body_expired(body):
+            self.drop_expired_message(body, message)
+            return
+
+        if self.batching:
+            if not self.pending:
+                self.pending_since = time.time()
+            self.pending.append((body, message))
+            if len(self.pending) >= self.batch_size:
+                self.flush_pending_messages()
+            return
+
+        outgoing = OutgoingMessage(**body)
+        self.in_flight += 1
+        start = time.time()
+        try:
+            sent = self.on_send_message(outgoing)
+        finally:
+            self.in_flight -= 1
+            self.last_send_latency = time.time() - start
+
+        if sent:
             message.ack()
+            self.publish_message_states([outgoing])
+
+
+    def drop_expired_message(self, body, message):
+        """
+            Record this expired message as failed, publish it on the 
+            'expired_messages' queue and acknowledge it instead of sending 
+            it. 'expired' counts them and is sent with the heartbeats.
+        """
+        self.expired += 1
+        state = {'id': body.get('id'), 'state': FAILED, 'transport': self.name,
+                 'smsc_id': None, 'error': 'expired'}
+        worker = OutgoingMessage.worker
+        worker.dispatch_message_states([state])
+        worker.dispatch_expired_messages([body])
+        message.ack()
+
+
+    def flush_pending_messages(self):
+        """
+            Pass the pending messages to on_send_messages() then ack the 
+            ones that have been sent and requeue the others.
+
+            If on_send_messages() raises an exception, all the messages are
+            requeued.
+        """
+        batch, self.pending = self.pending, []
+        self.pending_since = None
 
+        if not batch:
+            return
+
+        messages = [OutgoingMessage(**body) for body, message in batch]
+        self.in_flight += len(batch)
+        start = time.time()
+        try:
+            results = self.on_send_messages(messages)
+        except:
+            for body, message in batch:
+                message.requeue()
+            raise
+        finally:
+            self.in_flight -= len(batch)
+            self.last_send_latency = time.time() - start
+
+        results = list(results or ())
+        results.extend([False] * (len(batch) - len(results)))
+
+        done = []
+        for (body, message), outgoing, sent in zip(batch, messages, results):
+            if sent:
+                message.ack()
+                done.append(outgoing)
+            else:
+                message.requeue()
+
+        self.publish_message_states(done)
+
+
+    def publish_message_states(self, messages):
+        """
+            Publish the state of these messages once the backend is done
+            with them, all at once: failed if the backend set their 'error'
+            attribute, submitted otherwise.
+        """
+        if messages:
+            states = [message.get_state(FAILED if message.error else SUBMITTED)
+                      for message in messages]
+            OutgoingMessage.worker.dispatch_message_states(states)
+
+
+    def publish_delivery_receipt(self, smsc_id, state, error=None):
+        """
+            Publish the final state of the message the backend knows with 
+            this id, usually from a delivery receipt: DELIVERED or FAILED.
+        """
+        receipt = {'smsc_id': smsc_id, 'transport': self.name, 
+                   'state': state, 'error': error}
+        OutgoingMessage.worker.dispatch_message_states([receipt])
+
+
+    def on_main_loop_iteration(self):
+        """
+            Count the loops, send the pending messages if they waited 
+            long enough and send a heartbeat if it's time to.
+        """
+        self.loops += 1
+
+        if self.pending:
+            waited = (time.time() - self.pending_since) * 1000
+            if waited >= self.batch_timeout:
+                self.flush_pending_messages()
+
+        self.heartbeat()
+
+
+    def on_main_loop_stopped(self):
+        """
+            Send the pending messages before the connection is released,
+            instead of leaving them unacknowledged.
+        """
+        self.flush_pending_messages()
+
+
+    def stop(self):
+        """
+            Make the loop of the transport return, whatever its purpose.
+        """
+        PSMSWorker.stop(self)
+        self.stop_incoming_messages_loop()
+
+
+    def heartbeat(self, force=False):
+        """
+            Tell the router this process is alive, with the number of loops,
+            the number of messages being sent, the time it took to
+            send the last one, the number of parts of incoming messages
+            held and the number of expired messages dropped.
+
+            Heartbeats are sent at most every HEARTBEAT_INTERVAL seconds 
+            unless 'force' is True.
+        """
+        now = time.time()
+        if not force and now - self.last_heartbeat < settings.HEARTBEAT_INTERVAL:
+            return
+
+        self.last_heartbeat = now
+        heartbeat = {'name': self.name, 'purpose': self.purpose, 
+                     'index': self.index, 'pid': os.getpid(),
+                     'loops': self.loops, 'in_flight': self.in_flight,
+                     'latency': self.last_send_latency,
+                     'fragments': self.reassembly.held,
+                     'expired': self.expired}
+        self.producers['psms'].publish(body=heartbeat, routing_key="heartbeats")
 
-    # todo: provide a way to tell a message has been sent
-    # todo: provide a way to tell a message has not been sent with errors
-    # todo: provide a way to tell a message has been received
 
     def on_send_message(self, message):
         """
@@ -246,27 +586,68 @@ class MessageTransport(PSMSWorker):
 
             Return True is the message has been sent. If you don't, the message
             will be kept in the queue of messages to be sent.
+
+            If your backend gives an id to the message, set message.smsc_id
+            to it so delivery receipts can be matched with the message. If 
+            your backend refused the message for good, set message.error and
+            return True: the message will be marked as failed.
         """
         pass
 
 
+    def on_send_messages(self, messages):
+        """
+            Override this method instead of on_send_message() if your backend
+            can send several messages at once, like Kannel sendsms with 
+            several recipients or SMPP submit_multi.
+
+            'messages' is a list of OutgoingMessage objects. Return a list
+            of booleans in the same order: True if the message has been sent,
+            False if it must be put back in the queue of messages to be sent.
+
+            The default implementation calls on_send_message() for each 
+            message, and is never used unless you call it yourself.
+        """
+        return [self.on_send_message(message) for message in messages]
+
+
+    @property
+    def process_name(self):
+        """
+            Name used for the std files of the process running
+            this transport: the purpose, suffixed by the index for all
+            senders but the first one.
+        """
+        if self.index:
+            return '%s_%s' % (self.purpose, self.index)
+        return self.purpose
+
+
+    def set_index(self, index):
+        """
+            Set the index of this process among the senders of the transport
+            and update the file descriptors paths accordingly.
+        """
+        self.index = index
+        self._setup_process_fd()
+
+
     def _setup_process_fd(self):
         """
-            Implementation details for daemonizeation.
+            Implementation details for the transport processes.
 
-            File descriptors and pid files will be different, according to the
-            self.purpose variable, so setting up them accordingly.
+            File descriptors will be different, according to the
+            self.purpose and self.index variables, so setting up them 
+            accordingly.
         """
-        self.stdout_path = os.path.join(self.process_dir, '%s_stdout' % self.purpose)
-        self.stdin_path = os.path.join(self.process_dir, '%s_stdin' % self.purpose)
-        self.stderr_path = os.path.join(self.process_dir, '%s_stderr' % self.purpose)
-        self.pidfile_path =  os.path.join(self.process_dir, '%s.pid' % self.purpose)
+        name = self.process_name
+        self.stdout_path = os.path.join(self.process_dir, '%s_stdout' % name)
+        self.stderr_path = os.path.join(self.process_dir, '%s_stderr' % name)
 
         open(self.stdout_path, 'a').close()
-        open(self.stdin_path , 'a').close()
 
 
-    def run(self):
+    def run_loop(self):
         """
             Start running the backend according to what you want to do with it.
             This is choosen by setting the self.purpose attribute.
@@ -277,8 +658,7 @@ class MessageTransport(PSMSWorker):
             "receive_message" will start listing for message to receive by 
             running start_incoming_messages_loop() 
 
-            This is an legacy of the way the Python daemon lib
-            is implemented, requiring this method to exists.
+            This is what the transport processes run once they are ready.
         """
 
         if self.purpose == "send_messages":
@@ -287,20 +667,15 @@ class MessageTransport(PSMSWorker):
             self.start_incoming_messages_loop()
 
 
-    def manage_message_transport(self, action, purpose):
+    def manage_message_transport(self, action, purpose, index=0):
         """
-            Call the transport runner with the current transport as
-            name argument, the current settings module as settings argument,
-            and the action and purpose from this method arguments.
+            Ask the transport supervisor to start, stop or restart the 
+            process running the current transport for this purpose and 
+            sender index.
         """
-
-        subprocess.call([sys.executable,
-                         self.RUNNER_SCRIPT,
-                         action,
-                         self.name,
-                         purpose,
-                         '-p %s' % os.environ['PYTHON_PATH'],
-                         '-s %s' % os.environ['PSMS_SETTINGS_MODULE']])            
+        assert action in ('start', 'stop', 'restart')
+        method = getattr(self.supervisor, '%s_process' % action)
+        method(self.name, purpose, index)
 
 
     def start_receiving_messages_daemon(self):
@@ -311,20 +686,21 @@ class MessageTransport(PSMSWorker):
         self.manage_message_transport('start', 'receive_messages')
 
 
-    def start_sending_messages_daemon(self):
+    def start_sending_messages_daemon(self, index=0):
         """
             Call manage_message_transport() with action as start, and 
-            purpose as send_messages
+            purpose as send_messages, for the sender with this index.
         """
-        self.manage_message_transport('start', 'send_messages')
+        self.manage_message_transport('start', 'send_messages', index)
 
 
     def start_daemons(self):
         """
             Start all daemons for this transport
         """
-        self.start_receiving_messages_daemon()
-        self.start_sending_messages_daemon()
+        with self.supervisor.parallel():
+            self.start_receiving_messages_daemon()
+            self.start_sending_messages_daemon()
 
 
     def stop_receiving_messages_daemon(self):
@@ -335,20 +711,21 @@ class MessageTransport(PSMSWorker):
         self.manage_message_transport('stop', 'receive_messages')
 
 
-    def stop_sending_messages_daemon(self):
+    def stop_sending_messages_daemon(self, index=0):
         """
             Call manage_message_transport() with action as stop, and 
-            purpose as send_messages
+            purpose as send_messages, for the sender with this index.
         """
-        self.manage_message_transport('stop', 'send_messages')
+        self.manage_message_transport('stop', 'send_messages', index)
 
 
     def stop_daemons(self):
         """
             Stop all daemons for this transport
         """
-        self.stop_receiving_messages_daemon()
-        self.stop_sending_messages_daemon()
+        with self.supervisor.parallel():
+            self.stop_receiving_messages_daemon()
+            self.stop_sending_messages_daemon()
 
 
     def restart_receiving_messages_daemon(self):
@@ -359,17 +736,18 @@ class MessageTransport(PSMSWorker):
         self.manage_message_transport('restart', 'receive_messages')
 
 
-    def restart_sending_messages_daemon(self):
+    def restart_sending_messages_daemon(self, index=0):
         """
             Call manage_message_transport() with action as restart, and 
-            purpose as send_messages
+            purpose as send_messages, for the sender with this index.
         """
-        self.manage_message_transport('restart', 'send_messages')
+        self.manage_message_transport('restart', 'send_messages', index)
 
 
     def restart_daemons(self):
         """
             Restart all daemons for this transport
         """
-        self.restart_receiving_messages_daemon()
-        self.restart_sending_messages_daemon()        
+        with self.supervisor.parallel():
+            self.restart_receiving_messages_daemon()
+            self.restart_sending_messages_daemon()        
@@ -9,7 +9,6 @@
 
 import os
 import logging
-import threading
 
 from base import MessageTransport
 from pragmatic_sms.messages import IncomingMessage
@@ -28,29 +27,25 @@ class CmdMessageTransport(MessageTransport):
     # or not
 
 
-    react = False
-
-
-    def fake_sms_reception(self, author, text):
+    def fake_sms_reception(self, author, text, timeout=5):
         """
-            Simulate the reception of a message and wait during 5 seconds
-            for the system to respond
+            Simulate the reception of a message and wait during 'timeout' 
+            seconds for the system to respond. Return the response, or None.
         """
-        self.react = True
         message = IncomingMessage(author=author, text=text, transport=self.name)
         print "%s >>> %s" % (message.author, message.text)
-        message.dispatch()
-        self.start_outgoing_messages_loop(1, 5)
+        response = message.dispatch(wait_for_response=timeout).result()
+        if response is None:
+            print "No response after %s seconds" % timeout
+        else:
+            print "%s <<< %s" % (response.recipient, response.text)
+        return response
 
 
     def on_send_message(self, message):
         """
-            Print the outgoing message and stop the message loop but only
-            if react is True, which would mean we are explitly told this
-            instance should react to the messages.
-            The router won't set self.react, but fake_sms_reception will.
+            Print the outgoing message. Responses to fake_sms_reception()
+            are printed by fake_sms_reception() itself.
         """
-        if self.react:
-            print "%s <<< " % (message.author, message.text)
-            self.run = False
-            return True
\ No newline at end of file
+        print "%s <<< %s" % (message.recipient, message.text)
+        return True
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Keep track of the health of the transports processes from the
+    heartbeats they send to the router.
+"""
+
+import time
+
+
+class TransportHealth(object):
+    """
+        Last known state of one transport process, identified by a
+        (transport name, purpose, index) key.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.pid = None
+        self.loops = 0
+        self.in_flight = 0
+        self.latency = None
+        self.fragments = 0
+        self.expired = 0
+        self.last_seen = None
+        self.restarts = 0
+        self.failures = 0
+        self.last_restart = None
+
+
+    def update(self, heartbeat, now):
+        self.pid = heartbeat.get('pid')
+        self.loops = heartbeat.get('loops', 0)
+        self.in_flight = heartbeat.get('in_flight', 0)
+        self.latency = heartbeat.get('latency')
+        self.fragments = heartbeat.get('fragments', 0)
+        self.expired = heartbeat.get('expired', 0)
+        self.last_seen = now
+
+
+    def to_dict(self):
+        name, purpose, index = self.key
+        return {'name': name, 'purpose': purpose, 'index': index,
+                'pid': self.pid, 'loops': self.loops,
+                'in_flight': self.in_flight, 'latency': self.latency,
+                'fragments': self.fragments, 'expired': self.expired,
+                'last_seen': self.last_seen, 'restarts': self.restarts}
+
+
+class HealthTable(object):
+    """
+        Table of the transports processes health, fed by the heartbeats.
+
+        A process is stalled if it has sent heartbeats but none for
+        'stall_delay' seconds. Processes that never send heartbeats, like
+        receiving loops that don't call MessageTransport.heartbeat(), are
+        never considered stalled.
+
+        Restarts are allowed with an exponential backoff, from 'min_delay' to
+        'max_delay' seconds, so a transport crashing at start up doesn't
+        make the router fork in a loop. The backoff is reset once the
+        process has been running for 'max_delay' seconds.
+    """
+
+    def __init__(self, stall_delay=30, min_delay=1, max_delay=300):
+        self.stall_delay = stall_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.entries = {}
+
+
+    def get(self, key):
+        """
+            Return the health entry for this key, creating it if needed.
+        """
+        try:
+            return self.entries[key]
+        except KeyError:
+            entry = self.entries[key] = TransportHealth(key)
+            return entry
+
+
+    def update(self, heartbeat, now=None):
+        """
+            Record a heartbeat sent by a transport process.
+        """
+        now = now or time.time()
+        key = (heartbeat['name'], heartbeat['purpose'], heartbeat['index'])
+        entry = self.get(key)
+        entry.update(heartbeat, now)
+
+        if entry.failures and now - entry.last_restart >= self.max_delay:
+            entry.failures = 0
+
+        return entry
+
+
+    def forget(self, key):
+        """
+            Remove the entry of a process that has been stopped on purpose.
+        """
+        self.entries.pop(key, None)
+
+
+    def is_stalled(self, key, now=None):
+        """
+            Return True if the process has sent heartbeats before but not
+            for 'stall_delay' seconds.
+        """
+        now = now or time.time()
+        entry = self.entries.get(key)
+        if entry is None or entry.last_seen is None:
+            return False
+        return now - entry.last_seen >= self.stall_delay
+
+
+    def restart_delay(self, key):
+        """
+            Seconds to wait after the last restart before restarting
+            this process again.
+        """
+        failures = self.get(key).failures
+        if not failures:
+            return 0
+        return min(self.min_delay * 2 ** (failures - 1), self.max_delay)
+
+
+    def can_restart(self, key, now=None):
+        """
+            Return True if the backoff delay for this process is over.
+        """
+        now = now or time.time()
+        entry = self.get(key)
+        if entry.last_restart is None:
+            return True
+        return now - entry.last_restart >= self.restart_delay(key)
+
+
+    def restarted(self, key, now=None):
+        """
+            Record a restart of this process. Heartbeats sent by the
+            previous process are forgotten.
+        """
+        now = now or time.time()
+        entry = self.get(key)
+        entry.restarts += 1
+        entry.failures += 1
+        entry.last_restart = now
+        entry.last_seen = None
+
+
+    def as_table(self):
+        """
+            Return the health of all the processes as a list of dicts, sorted
+            by key.
+        """
+        return [self.entries[key].to_dict() for key in sorted(self.entries)]
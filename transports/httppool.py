@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    A small pool of HTTP/1.1 keep-alive connections, used by the transports
+    talking to an HTTP gateway to send many requests in parallel instead
+    of one blocking request per message.
+"""
+
+import Queue
+import socket
+import httplib
+import urlparse
+import threading
+
+
+class HTTPPoolError(Exception):
+    pass
+
+
+class HTTPRequest(object):
+    """
+        A request submitted to the pool. Call wait() to get the response.
+
+        Once done, 'status' and 'response' are set, or 'error' is set if
+        the request failed before getting a response.
+    """
+
+    def __init__(self, method, url, body=None, headers=None):
+        self.method = method
+        self.url = url
+        self.body = body
+        self.headers = headers or {}
+        self.status = None
+        self.response = None
+        self.error = None
+        self.done = threading.Event()
+
+        url = urlparse.urlsplit(url)
+        self.host = (url.scheme, url.hostname, url.port)
+        self.path = url.path or '/'
+        if url.query:
+            self.path += '?' + url.query
+
+
+    @property
+    def ok(self):
+        return self.error is None and 200 <= self.status < 300
+
+
+    def wait(self, timeout=None):
+        """
+            Wait for the request to be done and return it.
+        """
+        self.done.wait(timeout)
+        if not self.done.is_set():
+            raise HTTPPoolError('No response for %s after %s seconds' % (
+                                self.url, timeout))
+        return self
+
+
+class HTTPConnectionPool(object):
+    """
+        Send HTTP requests with 'max_in_flight' threads, each one keeping
+        its connections alive between requests, and no more than 'per_host'
+        requests at once to the same host.
+
+            pool = HTTPConnectionPool(max_in_flight=10)
+            requests = [pool.request('GET', url) for url in urls]
+            for request in requests:
+                request.wait()
+
+        A request failing on a connection that has been closed by the server
+        while idle is retried once on a new connection. Timeouts are not
+        retried.
+    """
+
+    def __init__(self, max_in_flight=10, per_host=4, timeout=10):
+        self.max_in_flight = max_in_flight
+        self.per_host = per_host
+        self.timeout = timeout
+
+        self.requests = Queue.Queue()
+        self.host_slots = {}
+        self.lock = threading.Lock()
+        self.threads = []
+
+        # stats
+        self.connections_opened = 0
+        self.requests_sent = 0
+
+
+    def start(self):
+        """
+            Start the threads sending the requests. Called automatically by
+            request().
+        """
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.max_in_flight):
+                thread = threading.Thread(target=self.send_requests)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+
+    def stop(self):
+        """
+            Stop the threads once they are done with the current requests.
+        """
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for thread in threads:
+            self.requests.put(None)
+        for thread in threads:
+            thread.join(self.timeout)
+
+
+    def request(self, method, url, body=None, headers=None):
+        """
+            Submit a request and return an HTTPRequest object right away.
+        """
+        self.start()
+        request = HTTPRequest(method, url, body, headers)
+        self.requests.put(request)
+        return request
+
+
+    def get_host_slot(self, host):
+        with self.lock:
+            try:
+                return self.host_slots[host]
+            except KeyError:
+                slot = threading.BoundedSemaphore(self.per_host)
+                return self.host_slots.setdefault(host, slot)
+
+
+    def connect(self, host):
+        scheme, hostname, port = host
+        if scheme == 'https':
+            klass = httplib.HTTPSConnection
+        else:
+            klass = httplib.HTTPConnection
+        with self.lock:
+            self.connections_opened += 1
+        return klass(hostname, port, timeout=self.timeout)
+
+
+    def send_requests(self):
+        """
+            Thread loop: take requests from the queue and send them with
+            the connections of this thread.
+        """
+        connections = {}
+
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+
+            slot = self.get_host_slot(request.host)
+            slot.acquire()
+            try:
+                self.send_request(request, connections)
+            finally:
+                slot.release()
+                request.done.set()
+
+        for connection in connections.itervalues():
+            connection.close()
+
+
+    def send_request(self, request, connections):
+        """
+            Send the request on the connection to its host, opening one
+            if needed.
+        """
+        for attempt in (1, 2):
+
+            reused = request.host in connections
+            if not reused:
+                connections[request.host] = self.connect(request.host)
+            connection = connections[request.host]
+
+            try:
+                connection.request(request.method, request.path,
+                                   request.body, request.headers)
+                response = connection.getresponse()
+                request.response = response.read()
+                request.status = response.status
+                with self.lock:
+                    self.requests_sent += 1
+                if response.will_close:
+                    connections.pop(request.host).close()
+                return
+
+            except (httplib.HTTPException, socket.error), e:
+                connections.pop(request.host).close()
+                # the server may have closed an idle connection: retry once,
+                # but not on timeouts as the gateway may have got the request
+                if not reused or attempt == 2 or isinstance(e, socket.timeout):
+                    request.error = e
+                    return
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Message transport for Kannel, or any HTTP SMS gateway with a compatible
+    sendsms API.
+"""
+
+import cgi
+import urllib
+import logging
+import urlparse
+import BaseHTTPServer
+
+from base import MessageTransport
+from httppool import HTTPConnectionPool
+from pragmatic_sms.messages import IncomingMessage
+from pragmatic_sms.encoding import analyze, UCS2
+
+
+# statuses of the sendsms requests refused because of their messages
+INVALID_MESSAGE_STATUSES = (400,)
+
+
+class KannelRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+        Turn the requests Kannel sends for each SMS it receives into
+        IncomingMessage objects.
+
+        The SMS data is taken from the query string for GET, and from
+        the form data for POST.
+    """
+
+    def do_GET(self):
+        query = urlparse.urlsplit(self.path).query
+        self.receive(cgi.parse_qs(query))
+
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        self.receive(cgi.parse_qs(self.rfile.read(length)))
+
+
+    def receive(self, params):
+        try:
+            author = params['from'][0]
+            text = params.get('text', [''])[0]
+        except (KeyError, IndexError):
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        charset = params.get('charset', ['utf-8'])[0]
+        text = text.decode(charset, 'replace')
+
+        self.server.transport.receive_message(author, text)
+        self.send_response(200)
+        self.end_headers()
+
+
+    def log_message(self, format, *args):
+        """
+            Don't print each request on stderr.
+        """
+        pass
+
+
+
+class KannelMessageTransport(MessageTransport):
+    """
+        Send messages with the Kannel sendsms HTTP API, and receive messages
+        with a small HTTP server Kannel calls for each incoming SMS.
+
+        Messages are sent by batches, in parallel, with up to 'max_in_flight'
+        requests at once on keep-alive connections. Messages of the same
+        batch sharing the same text are sent with only one request, up to
+        'max_recipients' recipients at once.
+
+        In your settings file:
+
+            MESSAGE_TRANSPORTS = {
+                'default': {
+                    'backend': 'pragmatic_sms.transports.kannel.KannelMessageTransport',
+                    'options': {
+                        'sendsms_url': 'http://localhost:13013/cgi-bin/sendsms',
+                        'username': 'psms',
+                        'password': 'secret',
+                        'listen_port': 13080
+                    }
+                }
+            }
+
+        And in your Kannel configuration:
+
+            group = sms-service
+            keyword = default
+            get-url = "http://localhost:13080/?from=%p&text=%a"
+            max-messages = 0
+
+        Requests answered with a 400 status are refused for the messages
+        themselves, like an invalid recipient: the message is logged and
+        dropped. Other errors put the message back in the queue, the ones
+        lower than 500, like 403 for a wrong password, being logged as
+        errors as they won't go away without fixing the configuration.
+    """
+
+    def __init__(self, name, purpose='send_messages',
+                 sendsms_url='http://localhost:13013/cgi-bin/sendsms',
+                 username='', password='', sender=None, smsc=None,
+                 max_in_flight=10, per_host=4, timeout=10,
+                 max_recipients=50, batch_size=50,
+                 listen_host='', listen_port=13080):
+
+        MessageTransport.__init__(self, name, purpose)
+
+        self.sendsms_url = sendsms_url
+        self.username = username
+        self.password = password
+        self.sender = sender
+        self.smsc = smsc
+        self.max_recipients = max_recipients
+        self.batch_size = batch_size
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+
+        self.http = HTTPConnectionPool(max_in_flight, per_host, timeout)
+        self.server = None
+        self.receiving = False
+
+
+    def get_sendsms_url(self, recipients, text):
+        """
+            Return the sendsms URL to send this text to these recipients.
+
+            Kannel converts the text to the GSM 7 bit alphabet by default, 
+            which has accented latin letters like 'é' too, so UCS-2 is only
+            asked for texts it can't hold.
+        """
+        params = {'username': self.username, 'password': self.password,
+                  'to': ' '.join(recipients), 'charset': 'UTF-8',
+                  'text': text.encode('utf-8')}
+        if analyze(text)[0] == UCS2:
+            params['coding'] = 2
+        if self.sender:
+            params['from'] = self.sender
+        if self.smsc:
+            params['smsc'] = self.smsc
+        return '%s?%s' % (self.sendsms_url, urllib.urlencode(params))
+
+
+    def on_send_message(self, message):
+        return self.on_send_messages([message])[0]
+
+
+    def on_send_messages(self, messages):
+        """
+            Send one request for each group of messages with the same text,
+            all at once, then wait for all the responses.
+        """
+        groups = {}
+        for i, message in enumerate(messages):
+            groups.setdefault(message.text, []).append(i)
+
+        requests = []
+        for text, indexes in groups.iteritems():
+            for start in range(0, len(indexes), self.max_recipients):
+                chunk = indexes[start:start + self.max_recipients]
+                recipients = [messages[i].recipient for i in chunk]
+                url = self.get_sendsms_url(recipients, text)
+                requests.append((chunk, self.http.request('GET', url)))
+
+        results = [False] * len(messages)
+        for indexes, request in requests:
+            request.wait()
+            ids = ', '.join(messages[i].id for i in indexes)
+            if request.ok:
+                sent = True
+            elif request.error is None and \
+                 request.status in INVALID_MESSAGE_STATUSES:
+                sent = True
+                self.log(logging.ERROR, 'Kannel refused messages %s: %s %s' % (
+                         ids, request.status, request.response))
+                for i in indexes:
+                    messages[i].error = 'Kannel status %s' % request.status
+            else:
+                sent = False
+                if request.error is None and request.status < 500:
+                    self.log(logging.ERROR, 'Kannel refused the request for '\
+                             'messages %s, check the transport options: '\
+                             '%s %s' % (ids, request.status, request.response))
+            for i in indexes:
+                results[i] = sent
+
+        return results
+
+
+    def receive_message(self, author, text):
+        """
+            Called for each SMS Kannel sends to the HTTP server.
+        """
+        IncomingMessage(author=author, text=text, transport=self.name).dispatch()
+
+
+    def get_server(self):
+        """
+            Return the HTTP server Kannel sends the incoming SMS to.
+        """
+        server = BaseHTTPServer.HTTPServer((self.listen_host, self.listen_port),
+                                           KannelRequestHandler)
+        server.transport = self
+        server.timeout = 1
+        return server
+
+
+    def start_incoming_messages_loop(self):
+        """
+            Serve the requests from Kannel until stop_incoming_messages_loop()
+            is called.
+        """
+        self.server = self.get_server()
+        self.receiving = True
+        self.log(logging.INFO, 'Transport "%s" listens for Kannel on %s:%s' % (
+                 self.name, self.listen_host, self.listen_port))
+        try:
+            while self.receiving:
+                self.server.handle_request()
+                self.heartbeat()
+        finally:
+            self.server.server_close()
+
+
+    def stop_incoming_messages_loop(self):
+        self.receiving = False
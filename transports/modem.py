@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    GSM modem message transport, talking AT commands in PDU mode on
+    a serial port.
+"""
+
+import os
+import time
+import errno
+import fcntl
+import select
+import logging
+import termios
+
+from contextlib import contextmanager
+
+from base import MessageTransport
+from pdu import encode_submit, decode_deliver, PDUError
+from pragmatic_sms.messages import IncomingMessage
+
+
+# +CMS ERROR codes worth trying again later: no network service, network
+# timeout and "modem busy"
+TEMPORARY_ERRORS = (331, 332, 515)
+
+
+class ModemError(Exception):
+
+    def __init__(self, message, code=None):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+    @property
+    def temporary(self):
+        return self.code in TEMPORARY_ERRORS
+
+
+
+class ModemTimeout(ModemError):
+    pass
+
+
+
+class SerialPort(object):
+    """
+        A serial port in raw mode, read without blocking.
+
+        The sending and the receiving processes of a transport open the
+        same port: each sequence of commands must be run with lock()
+        so they don't mix their commands and responses.
+    """
+
+    def __init__(self, device, baudrate=115200):
+        self.device = device
+        self.baudrate = baudrate
+        self.fd = None
+        self.buffer = ''
+
+
+    def open(self):
+        self.fd = os.open(self.device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        speed = getattr(termios, 'B%s' % self.baudrate)
+        attributes = termios.tcgetattr(self.fd)
+        attributes[0] = 0 # no input processing
+        attributes[1] = 0 # no output processing
+        attributes[2] = termios.CS8 | termios.CREAD | termios.CLOCAL
+        attributes[3] = 0 # no echo, no line editing
+        attributes[4] = attributes[5] = speed
+        termios.tcsetattr(self.fd, termios.TCSANOW, attributes)
+
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.buffer = ''
+
+
+    @contextmanager
+    def lock(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+    def flush_input(self):
+        """
+            Forget whatever the modem said before, such as unsolicited
+            result codes or the end of a response we gave up on.
+        """
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+        self.buffer = ''
+
+
+    def write(self, data):
+        while data:
+            try:
+                data = data[os.write(self.fd, data):]
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                select.select([], [self.fd], [], 1)
+
+
+    def fill(self, deadline):
+        """
+            Read what is available on the port to the buffer, waiting
+            until 'deadline' for something to come.
+        """
+        remaining = deadline - time.time()
+        if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+            raise ModemTimeout('No response from the modem')
+        try:
+            self.buffer += os.read(self.fd, 4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+
+    def read_line(self, deadline):
+        """
+            Return the next non empty line sent by the modem.
+        """
+        while True:
+            while '\n' not in self.buffer:
+                self.fill(deadline)
+            line, self.buffer = self.buffer.split('\n', 1)
+            line = line.strip()
+            if line:
+                return line
+
+
+    def read_prompt(self, deadline):
+        """
+            Wait for the '> ' prompt of AT+CMGS, which doesn't end with
+            a new line. Return False if the modem answered with a line,
+            such as an error, instead.
+        """
+        while True:
+            data = self.buffer.lstrip()
+            if data.startswith('>'):
+                self.buffer = data[1:].lstrip(' ')
+                return True
+            if '\n' in data:
+                return False
+            self.fill(deadline)
+
+
+
+class Modem(object):
+    """
+        The AT commands needed to send and receive SMS in PDU mode.
+
+        'commands' counts the commands sent to the modem, each one
+        being a round trip on a slow serial link.
+    """
+
+    def __init__(self, device, baudrate=115200, pin=None, timeout=30):
+        self.port = SerialPort(device, baudrate)
+        self.pin = pin
+        self.timeout = timeout
+        self.commands = 0
+        self.ready = False
+
+
+    def setup(self):
+        """
+            Open the port and put the modem in PDU mode, without echo.
+        """
+        self.port.open()
+        with self.port.lock():
+            self.command('ATE0')
+            if self.pin and '+CPIN: READY' not in self.command('AT+CPIN?'):
+                self.command('AT+CPIN=%s' % self.pin)
+            self.command('AT+CMGF=0')
+        self.ready = True
+
+
+    def close(self):
+        self.port.close()
+        self.ready = False
+
+
+    def read_response(self, deadline):
+        """
+            Return the lines sent by the modem until OK, or raise ModemError
+            if the command failed.
+        """
+        lines = []
+        while True:
+            line = self.port.read_line(deadline)
+            if line == 'OK':
+                return lines
+            if line == 'ERROR':
+                raise ModemError(line)
+            if line.startswith('+CMS ERROR:') or line.startswith('+CME ERROR:'):
+                try:
+                    code = int(line.split(':', 1)[1])
+                except ValueError:
+                    code = None
+                raise ModemError(line, code)
+            lines.append(line)
+
+
+    def command(self, command, timeout=None):
+        self.commands += 1
+        self.port.flush_input()
+        self.port.write(command + '\r')
+        return self.read_response(time.time() + (timeout or self.timeout))
+
+
+    def send_pdu(self, length, pdu):
+        """
+            Send one SMS-SUBMIT PDU and return the message reference given
+            by the network.
+        """
+        deadline = time.time() + self.timeout
+        self.commands += 1
+        self.port.flush_input()
+        self.port.write('AT+CMGS=%s\r' % length)
+        if not self.port.read_prompt(deadline):
+            self.read_response(deadline)
+            raise ModemError('No prompt from the modem')
+        self.port.write(pdu + '\x1a')
+        for line in self.read_response(deadline):
+            if line.startswith('+CMGS:'):
+                return int(line.split(':', 1)[1])
+
+
+    def list_messages(self):
+        """
+            Return (index, pdu) for all the messages stored in the modem
+            with one AT+CMGL. Unread messages are marked as read.
+        """
+        lines = self.command('AT+CMGL=4')
+        messages = []
+        for header, pdu in zip(lines, lines[1:]):
+            if header.startswith('+CMGL:'):
+                index = int(header.split(':', 1)[1].split(',')[0])
+                messages.append((index, pdu))
+        return messages
+
+
+    def delete_read_messages(self):
+        """
+            Delete all the read messages with one command. Messages received
+            since the last AT+CMGL are unread and are kept.
+        """
+        self.command('AT+CMGD=1,1')
+
+
+
+class ModemMessageTransport(MessageTransport):
+    """
+        Send and receive messages with a GSM modem plugged to a serial
+        port, using AT commands in PDU mode.
+
+        In your settings file:
+
+            MESSAGE_TRANSPORTS = {
+                'default': {
+                    'backend': 'pragmatic_sms.transports.modem.ModemMessageTransport',
+                    'options': {
+                        'device': '/dev/ttyUSB0',
+                        'baudrate': 115200,
+                        'pin': '1234'
+                    }
+                }
+            }
+
+        The receiving process polls the modem every 'poll_interval' seconds,
+        lists all stored messages with one command and deletes them with
+        another one once dispatched. Parts of concatenated messages are
+        kept until the whole message arrived, or for 'fragments_timeout'
+        seconds (REASSEMBLY_TIMEOUT by default) after which what arrived
+        is dispatched anyway.
+
+        The sending process sends each batch of messages back to back,
+        keeping the radio link open between them with AT+CMMS.
+    """
+
+    def __init__(self, name, purpose='send_messages', device='/dev/ttyUSB0',
+                 baudrate=115200, pin=None, timeout=30, poll_interval=5,
+                 fragments_timeout=None, batch_size=10):
+
+        MessageTransport.__init__(self, name, purpose)
+
+        self.modem = Modem(device, baudrate, pin, timeout)
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.receiving = False
+        if fragments_timeout is not None:
+            self.reassembly.timeout = fragments_timeout
+
+
+    def ensure_ready(self):
+        if not self.modem.ready:
+            self.modem.close()
+            self.modem.setup()
+
+
+    def on_send_message(self, message):
+        return self.on_send_messages([message])[0]
+
+
+    def on_send_messages(self, messages):
+        """
+            Send the PDUs of each message one after the other. Messages are
+            put back in the queue if the modem doesn't answer or the network
+            is not available, and dropped if they are refused.
+        """
+        try:
+            self.ensure_ready()
+        except (ModemError, OSError), e:
+            self.log(logging.ERROR, 'Unable to setup the modem: %s' % e)
+            self.modem.close()
+            return [False] * len(messages)
+
+        sent = []
+        with self.modem.port.lock():
+
+            if len(messages) > 1:
+                # not all modems support it, it's only an optimization
+                try:
+                    self.modem.command('AT+CMMS=1')
+                except ModemError:
+                    pass
+
+            for message in messages:
+                try:
+                    for length, pdu in encode_submit(message.recipient,
+                                                     message.text):
+                        reference = self.modem.send_pdu(length, pdu)
+                    message.smsc_id = reference
+                    sent.append(True)
+                except PDUError, e:
+                    message.error = str(e)
+                    self.log(logging.ERROR, 'Unable to encode message %s: %s'
+                                            % (message.id, e))
+                    sent.append(True)
+                except (ModemTimeout, OSError), e:
+                    # the modem is stuck or gone, set it up again next time
+                    self.log(logging.ERROR, 'Modem not responding: %s' % e)
+                    self.modem.ready = False
+                    break
+                except ModemError, e:
+                    if e.temporary:
+                        sent.append(False)
+                    else:
+                        message.error = str(e)
+                        self.log(logging.ERROR, 'Modem refused message %s: %s'
+                                                % (message.id, e))
+                        sent.append(True)
+
+        return sent + [False] * (len(messages) - len(sent))
+
+
+    def receive_part(self, pdu, now=None):
+        """
+            Return the list of IncomingMessage this PDU completes: the
+            message itself if it's a whole message, the longer message it
+            is a part of once all the parts arrived, or nothing.
+        """
+        try:
+            part = decode_deliver(pdu)
+        except PDUError, e:
+            self.log(logging.ERROR, str(e))
+            return []
+
+        if not part.is_concatenated:
+            return [IncomingMessage(author=part.number, text=part.text,
+                                    transport=self.name)]
+
+        return self.receive_fragment(part.number, part.reference, part.total,
+                                     part.sequence, part.text, now)
+
+
+    def read_messages(self, pdus):
+        for pdu in pdus:
+            for message in self.receive_part(pdu):
+                yield message
+
+
+    def receive_messages(self):
+        """
+            Dispatch all the messages stored in the modem by batch, then
+            delete them.
+        """
+        with self.modem.port.lock():
+            listed = self.modem.list_messages()
+            self.dispatch_messages(self.read_messages(pdu for index, pdu 
+                                                     in listed))
+            if listed:
+                self.modem.delete_read_messages()
+        self.dispatch_messages(self.expire_fragments())
+
+
+    def start_incoming_messages_loop(self):
+        """
+            Poll the modem for new messages until
+            stop_incoming_messages_loop() is called.
+        """
+        self.receiving = True
+        while self.receiving:
+            try:
+                self.ensure_ready()
+                self.receive_messages()
+            except (ModemError, OSError), e:
+                self.log(logging.ERROR, 'Unable to read messages from the '\
+                                        'modem: %s' % e)
+                self.modem.ready = False
+            self.heartbeat()
+            time.sleep(self.poll_interval)
+        self.modem.close()
+
+
+    def stop_incoming_messages_loop(self):
+        self.receiving = False
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Encode and decode SMS in PDU mode (3GPP TS 23.040), as used by GSM
+    modems with AT+CMGF=0.
+
+    Only SMS-SUBMIT and SMS-DELIVER are supported, with the GSM 7 bits
+    and UCS-2 alphabets, and the concatenation header for long messages.
+"""
+
+import random
+import datetime
+
+from pragmatic_sms.encoding import (encode_gsm7, decode_gsm7, pack_septets,
+                                    unpack_septets, ESCAPE)
+
+
+class PDUError(Exception):
+    pass
+
+
+# first octet flags
+SMS_DELIVER = 0x00
+SMS_SUBMIT = 0x01
+UDHI = 0x40
+
+# data coding schemes
+DCS_GSM7 = 0x00
+DCS_8BIT = 0x04
+DCS_UCS2 = 0x08
+
+# max size of the user data of one SMS
+MAX_SEPTETS = 160
+MAX_OCTETS = 140
+
+# concatenation information element, 8 bits reference, as a 6 octets header
+CONCAT_HEADER_SIZE = 6
+
+
+class SMSPart(object):
+    """
+        A decoded SMS-DELIVER or SMS-SUBMIT.
+
+        'reference', 'total' and 'sequence' are set for the parts of
+        a concatenated message, and None otherwise.
+    """
+
+    def __init__(self, number, text, date=None, reference=None, total=None,
+                 sequence=None):
+        self.number = number
+        self.text = text
+        self.date = date
+        self.reference = reference
+        self.total = total
+        self.sequence = sequence
+
+
+    @property
+    def is_concatenated(self):
+        return bool(self.total and self.total > 1)
+
+
+    def __repr__(self):
+        return '<SMSPart %s %s/%s from %s>' % (self.reference, self.sequence,
+                                               self.total, self.number)
+
+
+def encode_number(number):
+    """
+        Return the address field for a phone number: length in digits,
+        type of number and semi-octets.
+    """
+    if number.startswith('+'):
+        number, kind = number[1:], 0x91
+    else:
+        kind = 0x81
+    digits = number + 'F' * (len(number) % 2)
+    swapped = ''.join(digits[i + 1] + digits[i]
+                      for i in range(0, len(digits), 2))
+    return '%02X%02X%s' % (len(number), kind, swapped)
+
+
+def decode_number(data, offset):
+    """
+        Return the phone number of the address field at 'offset' in the
+        hex string, and the offset right after it.
+    """
+    length = int(data[offset:offset + 2], 16)
+    kind = int(data[offset + 2:offset + 4], 16)
+    size = length + length % 2
+    digits = data[offset + 4:offset + 4 + size]
+    offset += 4 + size
+
+    # alphanumeric sender, in GSM 7 bits
+    if kind & 0x70 == 0x50:
+        septets = unpack_septets(digits.decode('hex'), length * 4 // 7)
+        return decode_gsm7(septets), offset
+
+    number = ''.join(digits[i + 1] + digits[i]
+                     for i in range(0, len(digits), 2)).rstrip('F')
+    if kind & 0x70 == 0x10:
+        number = '+' + number
+    return number, offset
+
+
+def decode_date(data):
+    """
+        Turn the 7 semi-octets of a service centre time stamp into
+        a datetime, ignoring the time zone.
+    """
+    values = [int(data[i + 1] + data[i]) for i in range(0, 12, 2)]
+    year, month, day, hour, minute, second = values
+    try:
+        return datetime.datetime(2000 + year, month, day, hour, minute, second)
+    except ValueError:
+        return None
+
+
+def split_text(text):
+    """
+        Return the data coding scheme for this text, and the list of
+        user data for each SMS needed to send it, as septets lists for
+        GSM 7 bits or UCS-2 byte strings.
+    """
+    try:
+        septets = encode_gsm7(text)
+    except ValueError:
+        data = text.encode('utf-16-be')
+        if len(data) <= MAX_OCTETS:
+            return DCS_UCS2, [data]
+        size = MAX_OCTETS - CONCAT_HEADER_SIZE
+        return DCS_UCS2, [data[i:i + size] for i in range(0, len(data), size)]
+
+    if len(septets) <= MAX_SEPTETS:
+        return DCS_GSM7, [septets]
+
+    # 153 septets per part, without splitting an escape sequence
+    size = MAX_SEPTETS - 7
+    parts = []
+    while septets:
+        part = septets[:size]
+        if part[-1] == ESCAPE and len(septets) > size:
+            part = part[:-1]
+        parts.append(part)
+        septets = septets[len(part):]
+    return DCS_GSM7, parts
+
+
+def encode_user_data(dcs, data, header=''):
+    """
+        Return the user data length and the hex user data, with the user
+        data header if any.
+    """
+    if dcs == DCS_GSM7:
+        padding = (7 - len(header) * 8 % 7) % 7
+        header_septets = (len(header) * 8 + padding) // 7
+        # the text starts on a septet boundary, right after the header
+        packed = header + pack_septets(data, padding)
+        return header_septets + len(data), packed.encode('hex').upper()
+    return len(header) + len(data), (header + data).encode('hex').upper()
+
+
+def encode_submit(number, text, reference=None):
+    """
+        Return the list of (length, hex PDU) to send this text to this
+        number with AT+CMGS=<length>. There are several PDUs if the text
+        doesn't fit in one SMS.
+    """
+    dcs, parts = split_text(text)
+
+    if len(parts) > 255:
+        raise PDUError('Text too long to be sent as SMS')
+
+    if reference is None:
+        reference = random.randint(0, 255)
+
+    pdus = []
+    for sequence, data in enumerate(parts):
+        first_octet = SMS_SUBMIT
+        header = ''
+        if len(parts) > 1:
+            first_octet |= UDHI
+            header = '\x05\x00\x03%s%s%s' % (chr(reference), chr(len(parts)),
+                                            chr(sequence + 1))
+        length, user_data = encode_user_data(dcs, data, header)
+        tpdu = '%02X00%s00%02X%02X%s' % (first_octet, encode_number(number),
+                                         dcs, length, user_data)
+        # '00': use the SMSC stored in the SIM card
+        pdus.append((len(tpdu) // 2, '00' + tpdu))
+    return pdus
+
+
+def decode_user_data_header(data):
+    """
+        Return the size of the user data header at the beginning of this
+        byte string, and the reference, number of parts and number of this
+        part it gives if it's a part of a concatenated message, or None.
+    """
+    reference = total = sequence = None
+    header_size = ord(data[0]) + 1
+    offset = 1
+    while offset < header_size:
+        tag, size = ord(data[offset]), ord(data[offset + 1])
+        value = data[offset + 2:offset + 2 + size]
+        if tag == 0x00:
+            reference, total, sequence = [ord(c) for c in value]
+        elif tag == 0x08:
+            reference = ord(value[0]) << 8 | ord(value[1])
+            total, sequence = ord(value[2]), ord(value[3])
+        offset += 2 + size
+    return header_size, reference, total, sequence
+
+
+def decode_user_data(first_octet, dcs, length, data):
+    """
+        Return the text and the concatenation informations of this hex
+        user data.
+    """
+    data = data.decode('hex')
+    reference = total = sequence = None
+    header_size = 0
+
+    if first_octet & UDHI:
+        header_size, reference, total, sequence = decode_user_data_header(data)
+
+    if dcs & 0xC0 == 0 and dcs & 0x0C == DCS_UCS2:
+        text = data[header_size:].decode('utf-16-be', 'replace')
+    elif dcs & 0xC0 == 0 and dcs & 0x0C == DCS_8BIT:
+        text = data[header_size:].decode('latin-1')
+    else:
+        padding = (7 - header_size * 8 % 7) % 7
+        header_septets = (header_size * 8 + padding) // 7
+        septets = unpack_septets(data[header_size:], length - header_septets,
+                                 padding)
+        text = decode_gsm7(septets)
+
+    return text, reference, total, sequence
+
+
+def decode_deliver(pdu):
+    """
+        Decode a hex SMS-DELIVER PDU, as listed by AT+CMGL, into
+        an SMSPart.
+    """
+    try:
+        sca_length = int(pdu[:2], 16)
+        offset = 2 + sca_length * 2
+        first_octet = int(pdu[offset:offset + 2], 16)
+        number, offset = decode_number(pdu, offset + 2)
+        dcs = int(pdu[offset + 2:offset + 4], 16)
+        date = decode_date(pdu[offset + 4:offset + 18])
+        length = int(pdu[offset + 18:offset + 20], 16)
+        text, reference, total, sequence = decode_user_data(first_octet, dcs,
+                                                 length, pdu[offset + 20:])
+    except (ValueError, IndexError, TypeError), e:
+        raise PDUError('Unable to decode PDU %s: %s' % (pdu, e))
+
+    return SMSPart(number, text, date, reference, total, sequence)
+
+
+def decode_submit(pdu):
+    """
+        Decode a hex SMS-SUBMIT PDU, as sent with AT+CMGS, into an SMSPart.
+    """
+    try:
+        sca_length = int(pdu[:2], 16)
+        offset = 2 + sca_length * 2
+        first_octet = int(pdu[offset:offset + 2], 16)
+        number, offset = decode_number(pdu, offset + 4)
+        dcs = int(pdu[offset + 2:offset + 4], 16)
+        offset += 4
+        # validity period, if any
+        offset += {0x10: 2, 0x08: 14, 0x18: 14}.get(first_octet & 0x18, 0)
+        length = int(pdu[offset:offset + 2], 16)
+        text, reference, total, sequence = decode_user_data(first_octet, dcs,
+                                                 length, pdu[offset + 2:])
+    except (ValueError, IndexError, TypeError), e:
+        raise PDUError('Unable to decode PDU %s: %s' % (pdu, e))
+
+    return SMSPart(number, text, None, reference, total, sequence)
+
+
+def encode_deliver(number, text, date=None):
+    """
+        Return the list of hex SMS-DELIVER PDUs a modem would store if it
+        received this text from this number. Mostly useful for testing.
+    """
+    date = date or datetime.datetime.now()
+    stamp = date.strftime('%y%m%d%H%M%S')
+    stamp = ''.join(stamp[i + 1] + stamp[i] for i in range(0, 12, 2)) + '00'
+
+    dcs, parts = split_text(text)
+    reference = random.randint(0, 255)
+
+    pdus = []
+    for sequence, data in enumerate(parts):
+        first_octet = SMS_DELIVER
+        header = ''
+        if len(parts) > 1:
+            first_octet |= UDHI
+            header = '\x05\x00\x03%s%s%s' % (chr(reference), chr(len(parts)),
+                                            chr(sequence + 1))
+        length, user_data = encode_user_data(dcs, data, header)
+        pdus.append('00%02X%s00%02X%s%02X%s' % (first_octet,
+                                                encode_number(number), dcs,
+                                                stamp, length, user_data))
+    return pdus
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Pool of processes sending messages for one transport.
+
+    All the senders of a pool consume the same "<name>_transport" queue,
+    so they compete for messages and the broker spreads the load between
+    them. The router calls adjust() regularly with the queue backlog
+    and the pool grows or shrinks accordingly.
+"""
+
+import time
+
+
+class SenderPool(object):
+    """
+        Keep between 'min' and 'max' sending processes running for
+        a transport.
+
+        Configure it in the settings file, next to the transport backend:
+
+            MESSAGE_TRANSPORTS = {
+                'default': {
+                    'backend': 'yourapp.your_message_transport.YourMessageTransport',
+                    'options': {},
+                    'senders': {'min': 1, 'max': 4}
+                }
+            }
+
+        'senders' can be an integer as well if you want a fixed number of
+        processes. Without 'senders', only one process sends messages, which
+        is the historical behavior.
+
+        The pool starts one more sender each time the backlog goes over
+        'messages_per_sender' messages per running sender, and stops one
+        sender each time the backlog has been low enough for 'idle_delay'
+        seconds.
+    """
+
+    def __init__(self, transport, min=1, max=None, messages_per_sender=100,
+                 idle_delay=30, check_interval=1):
+
+        if max is None:
+            max = min
+
+        assert 1 <= min <= max, "Senders must verify 1 <= min <= max"
+
+        self.transport = transport
+        self.min = min
+        self.max = max
+        self.messages_per_sender = messages_per_sender
+        self.idle_delay = idle_delay
+        self.check_interval = check_interval
+
+        self.senders = 0
+        self.last_check = 0
+        self.idle_since = None
+
+
+    @classmethod
+    def from_settings(cls, transport, conf=None):
+        """
+            Create a pool from the 'senders' entry of the transport settings,
+            which is None, an integer or a dict of keyword arguments.
+        """
+        if conf is None:
+            return cls(transport)
+        if isinstance(conf, (int, long)):
+            return cls(transport, conf, conf)
+        return cls(transport, **conf)
+
+
+    def wanted_senders(self, backlog):
+        """
+            Number of senders we need to process this backlog, bounded by
+            the min and max of the pool.
+        """
+        # ceil division
+        wanted = -(-backlog // self.messages_per_sender)
+        return min(max(wanted, self.min), self.max)
+
+
+    def is_due(self, now=None):
+        """
+            Return True if check_interval seconds passed since the last call
+            to adjust(). This let the router avoid querying the broker for the
+            queue size at every message.
+        """
+        now = now or time.time()
+        return now - self.last_check >= self.check_interval
+
+
+    def start(self):
+        """
+            Start the minimum number of senders.
+        """
+        self.scale_to(self.min)
+
+
+    def stop(self):
+        """
+            Stop all the senders.
+        """
+        self.scale_to(0)
+        self.idle_since = None
+
+
+    def scale_to(self, count):
+        """
+            Start or stop senders until exactly 'count' of them are running.
+
+            Sender indexes are contiguous so the sender with the highest index
+            is always the one to stop first.
+        """
+        while self.senders < count:
+            self.transport.start_sending_messages_daemon(self.senders)
+            self.senders += 1
+
+        while self.senders > count:
+            self.senders -= 1
+            self.transport.stop_sending_messages_daemon(self.senders)
+
+
+    def adjust(self, backlog, now=None):
+        """
+            Grow the pool right away if the backlog requires it, shrink it
+            one sender at a time once it has been idle long enough.
+
+            Return the number of running senders.
+        """
+        now = now or time.time()
+        self.last_check = now
+
+        wanted = self.wanted_senders(backlog)
+
+        if wanted > self.senders:
+            self.idle_since = None
+            self.scale_to(wanted)
+
+        elif wanted < self.senders:
+            if self.idle_since is None:
+                self.idle_since = now
+            elif now - self.idle_since >= self.idle_delay:
+                self.scale_to(self.senders - 1)
+                self.idle_since = now
+
+        else:
+            self.idle_since = None
+
+        return self.senders
@@ -0,0 +1,720 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    SMPP 3.4 message transport.
+
+    Only the subset of the protocol needed to send and receive SMS is
+    implemented: binding, submit_sm, deliver_sm, enquire_link and unbind.
+"""
+
+import re
+import time
+import collections
+import socket
+import struct
+import logging
+import threading
+
+from base import MessageTransport
+from pdu import decode_user_data_header
+from pragmatic_sms.messages import IncomingMessage
+from pragmatic_sms.states import DELIVERED, FAILED
+
+
+BIND_RECEIVER = 0x00000001
+BIND_TRANSMITTER = 0x00000002
+SUBMIT_SM = 0x00000004
+DELIVER_SM = 0x00000005
+UNBIND = 0x00000006
+BIND_TRANSCEIVER = 0x00000009
+ENQUIRE_LINK = 0x00000015
+GENERIC_NACK = 0x80000000
+RESPONSE = 0x80000000
+
+ESME_ROK = 0x00000000
+ESME_RMSGQFUL = 0x00000014
+ESME_RTHROTTLED = 0x00000058
+
+# errors worth trying again later, the others are permanent
+TEMPORARY_ERRORS = (ESME_RMSGQFUL, ESME_RTHROTTLED)
+
+# the SMSC default alphabet is not reliable, so ASCII is sent as IA5
+# and anything else as UCS-2
+DATA_CODING_IA5 = 0x01
+DATA_CODING_UCS2 = 0x08
+
+MESSAGE_PAYLOAD_TAG = 0x0424
+
+# optional parameters of the parts of a concatenated message
+SAR_MSG_REF_NUM_TAG = 0x020C
+SAR_TOTAL_SEGMENTS_TAG = 0x020E
+SAR_SEGMENT_SEQNUM_TAG = 0x020F
+SAR_TAGS = (SAR_MSG_REF_NUM_TAG, SAR_TOTAL_SEGMENTS_TAG, 
+            SAR_SEGMENT_SEQNUM_TAG)
+
+# esm_class flags
+ESM_DELIVERY_RECEIPT = 0x04
+ESM_UDHI = 0x40
+
+# delivery receipts text, as suggested by the SMPP 3.4 specification
+RECEIPT = re.compile(r'id:(?P<id>\S+).*?stat:(?P<stat>\w+)', re.DOTALL)
+RECEIPT_STATES = {'DELIVRD': DELIVERED, 'EXPIRED': FAILED, 'DELETED': FAILED,
+                  'UNDELIV': FAILED, 'REJECTD': FAILED, 'UNKNOWN': FAILED}
+
+HEADER = struct.Struct('>IIII')
+
+
+class SMPPError(Exception):
+    pass
+
+
+class PDU(object):
+    """
+        An SMPP protocol data unit: a header and a raw body.
+    """
+
+    def __init__(self, command_id, sequence, body='', status=ESME_ROK):
+        self.command_id = command_id
+        self.sequence = sequence
+        self.body = body
+        self.status = status
+
+
+    def pack(self):
+        return HEADER.pack(HEADER.size + len(self.body), self.command_id,
+                           self.status, self.sequence) + self.body
+
+
+    @classmethod
+    def unpack(cls, data):
+        length, command_id, status, sequence = HEADER.unpack(data[:HEADER.size])
+        return cls(command_id, sequence, data[HEADER.size:length], status)
+
+
+    def __repr__(self):
+        return '<PDU 0x%08x #%s status 0x%x>' % (self.command_id,
+                                                 self.sequence, self.status)
+
+
+def read_cstring(body, offset):
+    """
+        Return the null terminated string starting at offset and the
+        offset right after it.
+    """
+    end = body.index('\0', offset)
+    return body[offset:end], end + 1
+
+
+def pack_bind(system_id, password, system_type=''):
+    return '%s\0%s\0%s\0%s\0' % (system_id, password, system_type,
+                                 struct.pack('>BBB', 0x34, 0, 0))
+
+
+def encode_address(address):
+    """
+        Return the address as an ASCII byte string: numbers are unicode 
+        once the message went through the broker, and would turn the whole
+        PDU body into unicode. Raise SMPPError if it's not ASCII, like an
+        alphanumeric sender with accents.
+    """
+    try:
+        if isinstance(address, unicode):
+            return address.encode('ascii')
+        address.decode('ascii')
+        return address
+    except UnicodeError:
+        raise SMPPError('Address %r is not ASCII' % address)
+
+
+def pack_short_message(source, destination, text, registered_delivery=0):
+    """
+        Body of a submit_sm or deliver_sm PDU. Texts longer than what
+        the short_message field can hold go in the message_payload
+        optional parameter.
+
+        Raise SMPPError if an address is not ASCII.
+    """
+    try:
+        data = text.encode('ascii')
+        coding = DATA_CODING_IA5
+    except UnicodeError:
+        data = text.encode('utf-16-be')
+        coding = DATA_CODING_UCS2
+
+    source, destination = encode_address(source), encode_address(destination)
+
+    body = ['\0',  # service_type
+            struct.pack('>BB', 1, 1), source, '\0',
+            struct.pack('>BB', 1, 1), destination, '\0',
+            struct.pack('>BBB', 0, 0, 0),  # esm_class, protocol_id, priority
+            '\0\0',  # schedule_delivery_time, validity_period
+            struct.pack('>BBBB', registered_delivery, 0, coding, 0)]
+
+    if len(data) <= 254:
+        body.extend((chr(len(data)), data))
+    else:
+        body.extend(('\0', struct.pack('>HH', MESSAGE_PAYLOAD_TAG, len(data)),
+                     data))
+    return ''.join(body)
+
+
+def unpack_short_message(body):
+    """
+        Return the source address, destination address, esm_class, text
+        of a deliver_sm or submit_sm PDU body, and the reference, number of 
+        parts and number of this part if it's a part of a concatenated 
+        message, given by a user data header or the sar_* optional 
+        parameters, or None.
+    """
+    service_type, offset = read_cstring(body, 0)
+    source, offset = read_cstring(body, offset + 2)
+    destination, offset = read_cstring(body, offset + 2)
+    esm_class = ord(body[offset])
+    schedule, offset = read_cstring(body, offset + 3)
+    validity, offset = read_cstring(body, offset)
+    coding = ord(body[offset + 2])
+    length = ord(body[offset + 4])
+    offset += 5
+    data = body[offset:offset + length]
+    offset += length
+
+    # optional parameters
+    sar = {}
+    while offset + 4 <= len(body):
+        tag, size = struct.unpack('>HH', body[offset:offset + 4])
+        value = body[offset + 4:offset + 4 + size]
+        if tag == MESSAGE_PAYLOAD_TAG:
+            data = value
+        elif tag in SAR_TAGS:
+            sar[tag] = int(value.encode('hex') or '0', 16)
+        offset += 4 + size
+
+    concat = None
+    if esm_class & ESM_UDHI and data:
+        header_size, reference, total, sequence = decode_user_data_header(data)
+        data = data[header_size:]
+        if reference is not None:
+            concat = (reference, total, sequence)
+    elif len(sar) == len(SAR_TAGS):
+        concat = tuple(sar[tag] for tag in SAR_TAGS)
+
+    if coding == DATA_CODING_UCS2:
+        text = data.decode('utf-16-be', 'replace')
+    else:
+        text = data.decode('latin-1')
+
+    return source, destination, esm_class, text, concat
+
+
+class SubmitResult(object):
+    """
+        Result of a submit_sm, set when the submit_sm_resp arrives or
+        the connection is lost.
+    """
+
+    def __init__(self, sequence=None):
+        self.sequence = sequence
+        self.status = None
+        self.message_id = None
+        self.error = None
+        self.done = threading.Event()
+
+
+    @property
+    def ok(self):
+        return self.error is None and self.status == ESME_ROK
+
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        if not self.done.is_set():
+            self.error = SMPPError('No submit_sm_resp in time')
+        return self
+
+
+class SMPPClient(object):
+    """
+        An SMPP connection to an SMSC keeping up to 'window' submit_sm
+        waiting for their response at once.
+
+        submit() returns right away as long as the window is not full, so
+        messages are pipelined instead of waiting for each response before
+        sending the next message.
+
+        Responses are read by a background thread started by start_reader().
+        If the client receives messages, don't start it: call
+        process_pdus() in your loop instead, so 'on_deliver' is called in
+        your thread.
+
+        The results given up with abandon() are still completed if their
+        response arrives later, or failed if the connection is lost, and
+        appended to 'late'. 'pending' and 'abandoned' are only changed
+        with 'results_lock' held, as the reader thread and the sending one
+        both move results out of them.
+
+        An enquire_link is sent when nothing has been received from the
+        SMSC for 'enquire_link_interval' seconds.
+    """
+
+    # max number of seconds process_pdus() waits for a PDU
+    poll_interval = 1
+
+    def __init__(self, host, port, system_id, password, system_type='',
+                 window=10, enquire_link_interval=30, timeout=10,
+                 on_deliver=None):
+        self.host = host
+        self.port = port
+        self.system_id = system_id
+        self.password = password
+        self.system_type = system_type
+        self.window = window
+        self.enquire_link_interval = enquire_link_interval
+        self.timeout = timeout
+        self.on_deliver = on_deliver
+
+        self.socket = None
+        self.buffer = ''
+        self.sequence = 0
+        self.pending = {}
+        self.abandoned = {}
+        self.late = collections.deque()
+        self.slots = threading.BoundedSemaphore(window)
+        # for the sequence and the socket
+        self.lock = threading.Lock()
+        self.results_lock = threading.Lock()
+        self.reader = None
+        self.bound = False
+        self.last_activity = 0
+
+
+    def next_sequence(self):
+        with self.lock:
+            self.sequence = self.sequence % 0x7FFFFFFF + 1
+            return self.sequence
+
+
+    def send_pdu(self, pdu):
+        with self.lock:
+            self.socket.sendall(pdu.pack())
+
+
+    def read_pdu(self):
+        """
+            Return the next PDU from the socket, or None if none arrived
+            before the socket timeout.
+        """
+        while True:
+            if len(self.buffer) >= 4:
+                length = struct.unpack('>I', self.buffer[:4])[0]
+                if len(self.buffer) >= length:
+                    data, self.buffer = self.buffer[:length], self.buffer[length:]
+                    return PDU.unpack(data)
+            try:
+                data = self.socket.recv(4096)
+            except socket.timeout:
+                return None
+            if not data:
+                raise SMPPError('Connection closed by the SMSC')
+            self.buffer += data
+            self.last_activity = time.time()
+
+
+    def bind(self, command_id=BIND_TRANSCEIVER):
+        """
+            Connect to the SMSC and bind as transmitter, receiver or
+            transceiver.
+        """
+        self.socket = socket.create_connection((self.host, self.port),
+                                               self.timeout)
+        self.buffer = ''
+
+        body = pack_bind(self.system_id, self.password, self.system_type)
+        self.send_pdu(PDU(command_id, self.next_sequence(), body))
+
+        response = self.read_pdu()
+        self.socket.settimeout(self.poll_interval)
+        if response is None or response.command_id != command_id | RESPONSE:
+            raise SMPPError('No bind response from the SMSC')
+        if response.status != ESME_ROK:
+            raise SMPPError('Bind refused with status 0x%x' % response.status)
+        self.bound = True
+
+
+    def start_reader(self):
+        self.reader = threading.Thread(target=self.read_forever)
+        self.reader.daemon = True
+        self.reader.start()
+
+
+    def read_forever(self):
+        try:
+            while self.bound:
+                self.process_pdus()
+        except (SMPPError, socket.error), e:
+            self.connection_lost(e)
+
+
+    def process_pdus(self):
+        """
+            Handle the next PDU coming from the SMSC, waiting for it at most 
+            'poll_interval' seconds. Send an enquire_link if the connection
+            has been idle for too long.
+        """
+        pdu = self.read_pdu()
+        if pdu is not None:
+            self.handle_pdu(pdu)
+        elif self.bound:
+            if time.time() - self.last_activity >= self.enquire_link_interval:
+                self.last_activity = time.time()
+                self.send_pdu(PDU(ENQUIRE_LINK, self.next_sequence()))
+
+
+    def handle_pdu(self, pdu):
+
+        if pdu.command_id in (SUBMIT_SM | RESPONSE, GENERIC_NACK):
+            with self.results_lock:
+                result = self.pending.pop(pdu.sequence, None)
+                late = result is None
+                if late:
+                    result = self.abandoned.pop(pdu.sequence, None)
+                    if result is None:
+                        return
+                    result.error = None
+                result.status = pdu.status
+                if pdu.status == ESME_ROK and pdu.body and \
+                   pdu.command_id == SUBMIT_SM | RESPONSE:
+                    result.message_id = read_cstring(pdu.body, 0)[0]
+                result.done.set()
+                # complete before being seen in 'late'
+                if late:
+                    self.late.append(result)
+                else:
+                    self.slots.release()
+
+        elif pdu.command_id == DELIVER_SM:
+            if self.on_deliver:
+                self.on_deliver(*unpack_short_message(pdu.body))
+            self.send_pdu(PDU(DELIVER_SM | RESPONSE, pdu.sequence, '\0'))
+
+        elif pdu.command_id == ENQUIRE_LINK:
+            self.send_pdu(PDU(ENQUIRE_LINK | RESPONSE, pdu.sequence))
+
+        elif pdu.command_id == UNBIND:
+            self.send_pdu(PDU(UNBIND | RESPONSE, pdu.sequence))
+            self.connection_lost(SMPPError('Unbound by the SMSC'))
+
+
+    def submit(self, source, destination, text, registered_delivery=0):
+        """
+            Send a submit_sm and return a SubmitResult. Block if the window
+            is full, until a response arrives or a result is abandoned.
+            Raise SMPPError if an address is not ASCII.
+        """
+        body = pack_short_message(source, destination, text,
+                                  registered_delivery)
+
+        if not self.bound:
+            result = SubmitResult()
+            result.error = SMPPError('Not bound to the SMSC')
+            result.done.set()
+            return result
+
+        self.slots.acquire()
+        sequence = self.next_sequence()
+        with self.results_lock:
+            result = self.pending[sequence] = SubmitResult(sequence)
+        try:
+            self.send_pdu(PDU(SUBMIT_SM, sequence, body))
+        except socket.error, e:
+            self.connection_lost(e)
+        return result
+
+
+    def abandon(self, result):
+        """
+            Stop waiting for the response of this submit_sm and free its
+            place in the window. Return False if the response arrived in
+            the meantime.
+        """
+        with self.results_lock:
+            if self.pending.pop(result.sequence, None) is result:
+                self.abandoned[result.sequence] = result
+                self.slots.release()
+                return True
+            return False
+
+
+    def connection_lost(self, error):
+        """
+            Fail all the submit_sm waiting for a response.
+        """
+        self.bound = False
+        with self.results_lock:
+            pending, self.pending = self.pending, {}
+            for result in pending.itervalues():
+                result.error = error
+                result.done.set()
+                self.slots.release()
+            abandoned, self.abandoned = self.abandoned, {}
+            for result in abandoned.itervalues():
+                result.error = error
+                self.late.append(result)
+        if self.socket:
+            self.socket.close()
+
+
+    def unbind(self):
+        if self.bound:
+            self.bound = False
+            try:
+                self.send_pdu(PDU(UNBIND, self.next_sequence()))
+            except socket.error:
+                pass
+        if self.reader:
+            self.reader.join(self.timeout)
+        self.connection_lost(SMPPError('Unbound'))
+
+
+
+class SMPPMessageTransport(MessageTransport):
+    """
+        Send and receive messages with an SMPP 3.4 SMSC.
+
+        The sending process binds as a transmitter and sends each batch of
+        messages by groups of 'window' submit_sm, waiting for the responses
+        of a group before sending the next one. The whole batch has
+        'timeout' seconds: the messages left when they are up are put back
+        in the queue without being sent.
+        The receiving process binds as a receiver and turns each deliver_sm
+        into an IncomingMessage.
+
+        In your settings file:
+
+            MESSAGE_TRANSPORTS = {
+                'default': {
+                    'backend': 'pragmatic_sms.transports.smpp.SMPPMessageTransport',
+                    'options': {
+                        'host': 'smsc.example.com',
+                        'port': 2775,
+                        'system_id': 'psms',
+                        'password': 'secret',
+                        'source_addr': '1234',
+                        'window': 10
+                    }
+                }
+            }
+
+        Messages refused because the SMSC is throttling or its queue is full
+        are put back in the queue, other errors are logged and the message
+        is dropped.
+
+        A submit_sm still without response when the 'timeout' of the batch
+        is up may have been sent anyway, so the message is not put back in the queue,
+        which could send it twice, and no state is published for it yet. 
+        If the response arrives later, the message is marked as submitted
+        or failed then, see reconcile_submits(). If it never does, a
+        warning is logged and the message stays relayed.
+
+        Unless 'delivery_receipts' is False, the SMSC is asked for delivery
+        receipts, which are published as the final state of the messages.
+    """
+
+    def __init__(self, name, purpose='send_messages', host='localhost',
+                 port=2775, system_id='', password='', system_type='',
+                 source_addr='', window=10, enquire_link_interval=30,
+                 timeout=10, batch_size=100, delivery_receipts=True):
+
+        MessageTransport.__init__(self, name, purpose)
+
+        self.source_addr = source_addr
+        self.timeout = timeout
+        # messages whose submit_sm_resp didn't arrive in time, by sequence
+        self.unconfirmed = {}
+        self.batch_size = batch_size
+        self.registered_delivery = 1 if delivery_receipts else 0
+        self.receiving = False
+
+        self.client = SMPPClient(host, port, system_id, password, system_type,
+                                 window, enquire_link_interval, timeout,
+                                 on_deliver=self.receive_message)
+
+
+    def ensure_bound(self, command_id):
+        if not self.client.bound:
+            self.client.bind(command_id)
+            if command_id == BIND_TRANSMITTER:
+                self.client.start_reader()
+
+
+    def on_send_message(self, message):
+        return self.on_send_messages([message])[0]
+
+
+    def on_send_messages(self, messages):
+        """
+            Pipeline a submit_sm for each message of a group of 'window'
+            messages then wait for all the responses, group after group
+            until the 'timeout' of the batch is up.
+        """
+        try:
+            self.ensure_bound(BIND_TRANSMITTER)
+        except (SMPPError, socket.error), e:
+            self.log(logging.ERROR, 'Unable to bind to the SMSC: %s' % e)
+            return [False] * len(messages)
+
+        deadline = time.time() + self.timeout
+        window = self.client.window
+        sent = []
+        for start in xrange(0, len(messages), window):
+            if time.time() >= deadline:
+                self.log(logging.WARNING, 'No time left to send %s messages, '\
+                                          'they are put back in the queue' % (
+                                                  len(messages) - start))
+                break
+            group = messages[start:start + window]
+            results = [self.submit(message) for message in group]
+            for message, result in zip(group, results):
+                sent.append(self.check_submit(message, result, deadline))
+
+        sent.extend([False] * (len(messages) - len(sent)))
+        return sent
+
+
+    def submit(self, message):
+        """
+            Send the submit_sm of this message, or return None if it can't
+            be sent.
+        """
+        try:
+            return self.client.submit(self.source_addr, message.recipient, 
+                                      message.text, self.registered_delivery)
+        except SMPPError, e:
+            message.error = str(e)
+            self.log(logging.ERROR, 'Unable to send message %s: %s' % (
+                                                          message.id, e))
+            return None
+
+
+    def check_submit(self, message, result, deadline):
+        """
+            Wait for the response of the submit_sm of this message until
+            the deadline, and return True unless the message must be put 
+            back in the queue.
+        """
+        if result is None:
+            return True
+        result.wait(max(deadline - time.time(), 0))
+        if not result.done.is_set():
+            if self.client.abandon(result):
+                self.unconfirmed[result.sequence] = message
+                self.log(logging.WARNING, 'No response from the SMSC '\
+                                          'for message %s yet' % message.id)
+                return True
+            # the response arrived in the meantime
+            result.done.wait()
+            if result.status is not None:
+                result.error = None
+        if result.ok:
+            message.smsc_id = result.message_id
+            return True
+        if result.error or result.status in TEMPORARY_ERRORS:
+            return False
+        message.error = 'SMSC status 0x%x' % result.status
+        self.log(logging.ERROR, 'SMSC refused message %s with status '\
+                                '0x%x' % (message.id, result.status))
+        return True
+
+
+    def publish_message_states(self, messages):
+        """
+            Don't publish the state of the messages the SMSC didn't answer
+            for yet.
+        """
+        waiting = set(message.id for message in self.unconfirmed.itervalues())
+        MessageTransport.publish_message_states(self, [message 
+                                    for message in messages 
+                                    if message.id not in waiting])
+
+
+    def reconcile_submits(self):
+        """
+            Publish the state of the unconfirmed messages whose response 
+            finally arrived. The ones which will never get a response, 
+            because the connection was lost, are forgotten.
+        """
+        while self.client.late:
+            result = self.client.late.popleft()
+            message = self.unconfirmed.pop(result.sequence, None)
+            if message is None:
+                continue
+            if result.ok:
+                message.smsc_id = result.message_id
+            elif result.error:
+                self.log(logging.WARNING, 'Never got a response from the '\
+                                          'SMSC for message %s, it may or '\
+                                          'may not be sent' % message.id)
+                continue
+            else:
+                message.error = 'SMSC status 0x%x' % result.status
+            self.publish_message_states([message])
+
+
+    def on_main_loop_iteration(self):
+        self.reconcile_submits()
+        MessageTransport.on_main_loop_iteration(self)
+
+
+    def receive_message(self, source, destination, esm_class, text, 
+                        concat=None):
+        """
+            Called for each deliver_sm received from the SMSC. Delivery 
+            receipts are not messages: the state they carry is published
+            instead. Parts of long messages are dispatched once all of them
+            arrived.
+        """
+        if esm_class & ESM_DELIVERY_RECEIPT:
+            self.receive_delivery_receipt(text)
+            return
+        if concat is not None:
+            for message in self.receive_fragment(source, *(concat + (text,))):
+                message.dispatch()
+            return
+        IncomingMessage(author=source, text=text, transport=self.name).dispatch()
+
+
+    def receive_delivery_receipt(self, text):
+        match = RECEIPT.search(text)
+        if match is None:
+            self.log(logging.WARNING, 'Unknown delivery receipt: %s' % text)
+            return
+        state = RECEIPT_STATES.get(match.group('stat'))
+        if state is not None:
+            error = match.group('stat') if state == FAILED else None
+            self.publish_delivery_receipt(match.group('id'), state, error)
+
+
+    def start_incoming_messages_loop(self):
+        """
+            Bind as a receiver and dispatch the messages from the SMSC
+            until stop_incoming_messages_loop() is called. Bind again if
+            the connection is lost.
+        """
+        self.receiving = True
+        while self.receiving:
+            try:
+                self.ensure_bound(BIND_RECEIVER)
+                self.client.process_pdus()
+                for message in self.expire_fragments():
+                    message.dispatch()
+            except (SMPPError, socket.error), e:
+                self.log(logging.ERROR, 'Connection to the SMSC lost: %s' % e)
+                self.client.connection_lost(e)
+                time.sleep(self.client.poll_interval)
+            self.heartbeat()
+        self.client.unbind()
+
+
+    def stop_incoming_messages_loop(self):
+        self.receiving = False
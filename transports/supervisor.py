@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Run message transports as child processes of the router.
+
+    Transports processes are forked from the already loaded router, so they
+    don't import the code or read the settings again, and each process tells
+    the supervisor when it is connected to the message broker and ready
+    to work. They are stopped with SIGTERM, which makes their loop return
+    so they finish what they were doing, and killed if they don't exit in
+    time.
+"""
+
+import os
+import sys
+import time
+import signal
+import multiprocessing
+
+from contextlib import contextmanager
+
+from pragmatic_sms.conf import settings
+from pragmatic_sms.utils import import_class
+
+
+class TransportSupervisorError(Exception):
+    pass
+
+
+def run_transport(name, purpose, index, ready):
+    """
+        Entry point of a transport process.
+
+        Redirect the standard file descriptors to the transport files,
+        connect the transport to the message broker, signal the supervisor
+        the process is ready then enter the transport loop, until SIGTERM
+        stops it.
+    """
+    from pragmatic_sms.messages import Message, MessageWorker
+
+    conf = settings.MESSAGE_TRANSPORTS[name]
+    klass = import_class(conf['backend'])
+    transport = klass(name, purpose, **conf.get('options', {}))
+    transport.set_index(index)
+
+    stdout = open(transport.stdout_path, 'a', 0)
+    stderr = open(transport.stderr_path, 'a', 0)
+    os.dup2(stdout.fileno(), sys.stdout.fileno())
+    os.dup2(stderr.fileno(), sys.stderr.fileno())
+
+    # the broker connection inherited from the router can't be shared
+    # between processes
+    Message.worker = MessageWorker()
+    Message.worker.connect()
+
+    transport.connect()
+    signal.signal(signal.SIGTERM, lambda signum, frame: transport.stop())
+    ready.set()
+
+    transport.run_loop()
+
+
+class TransportSupervisor(object):
+    """
+        Start, stop and watch transports processes.
+
+        Processes are identified by a (transport name, purpose, index) tuple.
+
+        By default, start_process() and stop_process() wait for the process
+        to be ready or to be finished, killing it if it doesn't exit 
+        'stop_timeout' seconds after being asked to. Use them inside a 'with parallel()'
+        block to start or stop several processes at once and wait for
+        all of them only at the end of the block:
+
+            with supervisor.parallel():
+                for transport in transports:
+                    transport.start_daemons()
+    """
+
+    def __init__(self, ready_timeout=None, stop_timeout=5):
+        if ready_timeout is None:
+            ready_timeout = settings.TRANSPORTS_READY_TIMEOUT
+        self.ready_timeout = ready_timeout
+        self.stop_timeout = stop_timeout
+        self.processes = {}
+        self.events = {}
+        # processes started without waiting, with their ready deadline
+        self.unready = {}
+        self.starting = None
+        self.stopping = None
+
+
+    def start_process(self, name, purpose, index=0, wait=True):
+        """
+            Fork a process running this transport for this purpose. Do
+            nothing if such a process is already running.
+
+            With 'wait' False, return right away: check_unready() tells
+            later if the process failed to get ready.
+        """
+        key = (name, purpose, index)
+
+        if self.is_alive(*key):
+            return
+
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(target=run_transport,
+                                          args=(name, purpose, index, ready),
+                                          name='%s_%s_%s' % key)
+        process.daemon = True
+        process.start()
+
+        self.processes[key] = process
+        self.events[key] = ready
+
+        if not wait:
+            self.unready[key] = time.time() + self.ready_timeout
+        elif self.starting is None:
+            self.wait_ready([key])
+        else:
+            self.starting.append(key)
+
+
+    def stop_process(self, name, purpose, index=0):
+        """
+            Ask the process running this transport for this purpose to stop,
+            with SIGTERM: it finishes its current loop iteration and sends
+            its pending messages first. Do nothing if no such process is
+            running.
+        """
+        key = (name, purpose, index)
+
+        process = self.processes.pop(key, None)
+        self.events.pop(key, None)
+        self.unready.pop(key, None)
+
+        if process is None:
+            return
+
+        if process.is_alive():
+            process.terminate()
+
+        if self.stopping is None:
+            self.join([process])
+        else:
+            self.stopping.append(process)
+
+
+    def join(self, processes):
+        """
+            Wait for these processes to exit, and kill the ones still alive
+            after 'stop_timeout' seconds.
+        """
+        deadline = time.time() + self.stop_timeout
+        for process in processes:
+            process.join(max(deadline - time.time(), 0))
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+
+
+    def restart_process(self, name, purpose, index=0):
+        """
+            Stop then start the process running this transport for
+            this purpose.
+        """
+        self.stop_process(name, purpose, index)
+        self.start_process(name, purpose, index)
+
+
+    def respawn_process(self, name, purpose, index=0):
+        """
+            Kill the process running this transport for this purpose, which
+            crashed or is stuck, and start a new one without waiting for
+            it to be ready, see check_unready().
+        """
+        key = (name, purpose, index)
+
+        process = self.processes.pop(key, None)
+        self.events.pop(key, None)
+        self.unready.pop(key, None)
+
+        if process is not None:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGKILL)
+            process.join()
+
+        self.start_process(name, purpose, index, wait=False)
+
+
+    def check_unready(self, now=None):
+        """
+            Return the keys of the processes started without waiting that
+            died or were not ready 'ready_timeout' seconds after being
+            started, and stop tracking them as well as the ready ones.
+        """
+        now = now or time.time()
+        failed = []
+        for key, deadline in self.unready.items():
+            if self.is_ready(*key):
+                del self.unready[key]
+            elif not self.is_alive(*key) or now >= deadline:
+                del self.unready[key]
+                failed.append(key)
+        return failed
+
+
+    def is_alive(self, name, purpose, index=0):
+        """
+            Return True if a process running this transport for this purpose
+            is alive.
+        """
+        process = self.processes.get((name, purpose, index))
+        return bool(process and process.is_alive())
+
+
+    def exit_code(self, name, purpose, index=0):
+        """
+            Return the exit code of the process running this transport for 
+            this purpose, or None if it's still running or unknown. 
+            
+            The code is negative if the process has been killed by a signal.
+        """
+        process = self.processes.get((name, purpose, index))
+        if process is None:
+            return None
+        return process.exitcode
+
+
+    def is_ready(self, name, purpose, index=0):
+        """
+            Return True if the process running this transport for this purpose
+            is alive and has signaled it's ready.
+        """
+        key = (name, purpose, index)
+        return self.is_alive(*key) and self.events[key].is_set()
+
+
+    def wait_ready(self, keys):
+        """
+            Wait for all the processes matching these keys to signal they are
+            ready, or until 'ready_timeout' seconds passed.
+
+            Raise TransportSupervisorError if some processes died or
+            are not ready in time.
+        """
+        deadline = time.time() + self.ready_timeout
+        failed = []
+
+        for key in keys:
+            ready = self.events[key]
+            process = self.processes[key]
+            while not ready.is_set() and process.is_alive():
+                ready.wait(min(0.1, max(deadline - time.time(), 0)))
+                if time.time() >= deadline:
+                    break
+            if not ready.is_set():
+                failed.append('%s_%s_%s' % key)
+
+        if failed:
+            raise TransportSupervisorError('Transports processes not ready: '\
+                                           '%s. Check their stderr file.' %
+                                           ', '.join(failed))
+
+
+    @contextmanager
+    def parallel(self):
+        """
+            Start or stop processes all at once inside this block, and wait
+            for all of them at the end of the block.
+        """
+        if self.starting is not None:
+            yield
+            return
+
+        self.starting, self.stopping = [], []
+        try:
+            yield
+            self.join(self.stopping)
+            self.wait_ready(self.starting)
+        finally:
+            self.starting, self.stopping = None, None
+
+
+    def stop_all(self):
+        """
+            Stop all the processes in parallel.
+        """
+        with self.parallel():
+            for key in self.processes.keys():
+                self.stop_process(*key)
+
+
+
+# Only one supervisor per process, so the router and the transports
+# instances share the same processes
+supervisor = TransportSupervisor()
@@ -64,6 +64,37 @@ class CounterMessageTransport(MessageTransport):
 
 
 
+class BatchCounterMessageTransport(MessageTransport):
+    """
+        Record the size of each batch of messages sent. Messages with 'fail'
+        in their text are never sent.
+    """
+
+    batch_size = 2
+    batches = []
+
+    def __init__(self, *args, **kwargs):
+        """
+            Reset the batches at each router restart
+        """
+        self.reset()
+        MessageTransport.__init__(self, *args, **kwargs)
+
+
+    def on_send_messages(self, messages):
+        BatchCounterMessageTransport.batches.append(len(messages))
+        return ['fail' not in message.text for message in messages]
+
+
+    @classmethod
+    def reset(cls):
+        """
+            Forget the batches
+        """
+        BatchCounterMessageTransport.batches = []
+
+
+
 class FileCounterMessageTransport(MessageTransport):
     """
         Increment a global counter for each message sent
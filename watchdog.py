@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Keep one slow message processor from freezing the router, which runs
+    them one after the other in the same loop. See Watchdog.
+"""
+
+import time
+import signal
+import bisect
+import logging
+import threading
+import traceback
+
+from contextlib import contextmanager
+
+
+# key of the incoming message bodies requeued after a timeout, with the
+# names of the processors which should get them again
+RETRY_KEY = 'retry_processors'
+
+
+
+class ProcessorTimeout(BaseException):
+    """
+        Raised in a message processor which ran out of time. It's not an
+        Exception so 'except Exception' in the processor doesn't catch it.
+    """
+    pass
+
+
+
+# critical sections of the current thread, see uninterruptible()
+_local = threading.local()
+
+
+@contextmanager
+def uninterruptible():
+    """
+        Defer the ProcessorTimeout of a slow processor until the end of 
+        this block, for code which must not stop halfway: publishing on
+        the broker, writing to a database, holding a lock:
+
+            with uninterruptible():
+                producer.publish(body=body, routing_key=key)
+
+        Blocks can be nested, the timeout is raised at the end of the
+        outermost one.
+    """
+    _local.depth = getattr(_local, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _local.depth -= 1
+        if not _local.depth and getattr(_local, 'deferred', False):
+            _local.deferred = False
+            raise ProcessorTimeout()
+
+
+
+class Histogram(object):
+    """
+        Count values, usually durations in seconds, in buckets: 'counts[i]'
+        is the number of values lower than or equal to 'bounds[i]', and
+        greater than the previous bound. The last count is for the values
+        greater than the last bound.
+    """
+
+    BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+
+    def percentile(self, percent):
+        """
+            Return the upper bound of the bucket of this percentile, or the
+            max value for the last bucket.
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+
+    def to_dict(self):
+        return {'bounds': self.bounds, 'counts': self.counts,
+                'count': self.count, 'total': self.total, 'max': self.max,
+                'p50': self.percentile(50), 'p99': self.percentile(99)}
+
+
+
+class ProcessorRecord(object):
+    """
+        Run times and timeouts of one message processor.
+    """
+
+    def __init__(self):
+        self.histogram = Histogram()
+        self.timeouts = 0
+        self.consecutive_timeouts = 0
+        self.skipped = 0
+        self.quarantined_until = None
+
+
+    def to_dict(self):
+        return {'histogram': self.histogram.to_dict(),
+                'timeouts': self.timeouts, 'skipped': self.skipped,
+                'quarantined_until': self.quarantined_until}
+
+
+
+class Watchdog(object):
+    """
+        Run the callbacks of the message processors with a time budget:
+        the 'timeout' attribute of the processor, or 'timeout' seconds.
+
+        A callback still running after its budget is interrupted with a
+        ProcessorTimeout, raised by a SIGALRM set with setitimer(), then
+        logged with the stack of where it was stuck. If it's in an
+        uninterruptible() block, such as publishing a message, the
+        exception is raised at the end of the block instead. The message is
+        skipped by this processor and kept in 'interrupted', with the names
+        of the processors in 'interrupted_by': the router requeues the
+        incoming ones no processor acknowledged, once all the processors
+        saw them, marked with RETRY_KEY so only these processors get them
+        again. Outgoing ones go on to the next callbacks. Signals only work
+        in the main thread: elsewhere, or if 'timeout' is None, slow
+        callbacks are only logged once done.
+
+        After 'quarantine_after' timeouts in a row, the processor is
+        skipped for all messages during 'quarantine_delay' seconds.
+
+        The run time of each processor is counted in a Histogram, see
+        stats().
+    """
+
+    def __init__(self, timeout=5, quarantine_after=3, quarantine_delay=300,
+                 logger=None):
+        self.timeout = timeout
+        self.quarantine_after = quarantine_after
+        self.quarantine_delay = quarantine_delay
+        self.logger = logger or logging.getLogger('psms')
+        self.records = {}
+        # the processor running, and the stack where it was interrupted
+        self.running = None
+        self.stack = None
+        # the last message a processor took too long to handle, and the
+        # names of the processors interrupted with it
+        self.interrupted = None
+        self.interrupted_by = []
+
+
+    def get_record(self, processor):
+        name = processor.__class__.__name__
+        record = self.records.get(name)
+        if record is None:
+            record = self.records[name] = ProcessorRecord()
+        return record
+
+
+    def wrap(self, processor, callback):
+        """
+            Return a function calling this callback of the processor with
+            run(), unless the message was requeued for other processors.
+        """
+        name = processor.__class__.__name__
+        def guarded(body, message):
+            retry = body.get(RETRY_KEY)
+            if retry is not None:
+                if name not in retry:
+                    return
+                body = dict(body)
+                del body[RETRY_KEY]
+            return self.run(processor, callback, body, message)
+        return guarded
+
+
+    def on_alarm(self, signum, frame):
+        if self.running is not None:
+            self.stack = ''.join(traceback.format_stack(frame))
+            if getattr(_local, 'depth', 0):
+                _local.deferred = True
+                return
+            raise ProcessorTimeout()
+
+
+    def run(self, processor, callback, body, message):
+        """
+            Call callback(body, message) unless the processor is in
+            quarantine, interrupting it after the processor time budget.
+        """
+        name = processor.__class__.__name__
+        record = self.get_record(processor)
+        now = time.time()
+
+        if record.quarantined_until is not None:
+            if now < record.quarantined_until:
+                record.skipped += 1
+                return
+            record.quarantined_until = None
+            self.logger.info('%s is out of quarantine' % name)
+
+        budget = getattr(processor, 'timeout', None) or self.timeout
+        interrupt = budget is not None and \
+                    threading.current_thread().name == 'MainThread'
+        self.running, self.stack = processor, None
+        if interrupt:
+            previous = signal.signal(signal.SIGALRM, self.on_alarm)
+            signal.setitimer(signal.ITIMER_REAL, budget)
+
+        try:
+            callback(body, message)
+        except ProcessorTimeout:
+            if self.interrupted is not message:
+                self.interrupted, self.interrupted_by = message, []
+            self.interrupted_by.append(name)
+        finally:
+            # the alarm may go off right as the callback returns: it's
+            # disarmed first, and its timeout dropped
+            try:
+                if interrupt:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+            except ProcessorTimeout:
+                pass
+            self.running = None
+            if interrupt:
+                signal.signal(signal.SIGALRM, previous or signal.SIG_DFL)
+            _local.deferred = False
+
+        elapsed = time.time() - now
+        record.histogram.add(elapsed)
+
+        if budget is None or elapsed < budget:
+            record.consecutive_timeouts = 0
+            return
+
+        record.timeouts += 1
+        record.consecutive_timeouts += 1
+        self.logger.error('%s took %.2fs with message %s, more than its %ss'
+                          '%s' % (name, elapsed, body.get('id'), budget,
+                                  ', interrupted in:\n' + self.stack
+                                  if self.stack else ''))
+
+        if record.consecutive_timeouts >= self.quarantine_after:
+            record.consecutive_timeouts = 0
+            record.quarantined_until = time.time() + self.quarantine_delay
+            self.logger.error('%s timed out %s times in a row, skipped for %s '
+                              'seconds' % (name, self.quarantine_after,
+                                           self.quarantine_delay))
+
+
+    def stats(self):
+        """
+            Return a dict with the histogram of the run times, the number
+            of timeouts and of skipped messages, and the end of the
+            quarantine of each processor.
+        """
+        return dict((name, record.to_dict())
+                    for name, record in self.records.iteritems())
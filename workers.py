@@ -6,11 +6,13 @@
     Base classes for all the workers in PSMS
 """
 
+import errno
 import socket
 import logging
 
 from conf import settings
 from utils import import_class
+from watchdog import uninterruptible
 
 from kombu.connection import BrokerConnection
 from kombu.messaging import Exchange, Queue, Consumer, Producer
@@ -43,6 +45,8 @@ class Worker(object):
         self.logger = self.get_logger()
 
         self.run = False
+        # stop() was called, maybe before the main loop started
+        self.stopping = False
         self.connection = None
         self.channel = None
 
@@ -106,7 +110,8 @@ class Worker(object):
             which is no limit.
         """
 
-        self.run = True
+        self.run = not self.stopping
+        self.stopping = False
 
         self.on_main_loop()
 
@@ -118,6 +123,12 @@ class Worker(object):
                     # this happens when timeout is reached and no message is
                     # in the queue
                     limit -= 1
+                except socket.error, e:
+                    # interrupted by a signal, like the SIGTERM the
+                    # transports get to stop, see stop()
+                    if e.errno != errno.EINTR:
+                        raise
+                self.on_main_loop_iteration()
 
         except self.connection.connection_errors, e:
             self.logger.error("Error while connecting with Kombu: %s" % e)
@@ -128,11 +139,15 @@ class Worker(object):
         except (KeyboardInterrupt, SystemExit) as e:
             self.logger.info("\nStopping %s" % self.name)
 
+        self.stopping = False
         try:
-            self.connection.release()
-        except AssertionError:
-            # todo: find why there is this assertion error about state
-            pass
+            self.on_main_loop_stopped()
+        finally:
+            try:
+                self.connection.release()
+            except AssertionError:
+                # todo: find why there is this assertion error about state
+                pass
 
     
     def start(self, timeout=1, limit=-1, force_purge=False):
@@ -167,6 +182,16 @@ class Worker(object):
         self.logger.info('%s stopped' % self.name)
 
 
+    def stop(self):
+        """
+            Make the main loop return once the current iteration is done, 
+            so on_main_loop_stopped() is called. It can be called from a 
+            signal handler, even before the main loop starts.
+        """
+        self.run = False
+        self.stopping = True
+
+
     def on_worker_starts(self):
         """
             Override this if you want to perform an action when the worker start
@@ -189,6 +214,25 @@ class Worker(object):
         pass
 
 
+    def on_main_loop_iteration(self):
+        """
+            Action to perform after each turn of the main loop, wether a
+            message has been received or the timeout has been reached.
+
+            Keep it cheap: it is called once for every message.
+        """
+        pass
+
+
+    def on_main_loop_stopped(self):
+        """
+            Action to perform right after the main loop, while the worker
+            is still connected: the last chance to acknowledge or publish
+            messages.
+        """
+        pass
+
+
     def on_worker_connected(self):
         """
             Override this if you want to perform an action when the worker 
@@ -271,6 +315,22 @@ class Worker(object):
         pass
 
 
+    def get_queue_size(self, name):
+        """
+            Return the number of messages waiting in the queue with this name.
+
+            The queue is declared passively so this doesn't create it if it
+            doesn't exist yet.
+        """
+        try:
+            name, size, consumers = self.queues[name].queue_declare(passive=True)
+        except NotBoundError:
+            raise WorkerError('You cannot get the size of a queue before '\
+                              'binding queues. Either start the worker or '\
+                              'call connect()')
+        return size
+
+
     def purge(self):
         """
             Remove message from all queues. Call this if you want to reset
@@ -318,6 +378,7 @@ class PSMSWorker(Worker):
             to use:
 
             - log queue to all the router to receive logs from external process
+            - heartbeat queue to let the router know external process are alive
             - undelivered kombo message queues to handle orphan messages
         """
         queues = {} 
@@ -327,6 +388,11 @@ class PSMSWorker(Worker):
                                  routing_key="logs",
                                  durable=False)
 
+        queues['heartbeats'] = Queue('heartbeats', 
+                                     exchange=self.exchanges['psms'],
+                                     routing_key="heartbeats",
+                                     durable=False)
+
                         
         queues['undelivered_kombu_message'] = Queue('ae.undeliver', 
                                               exchange=self.exchanges['psms'],
@@ -384,4 +450,14 @@ class PSMSWorker(Worker):
             can pop it and print it on the main terminal.
         """
         log = {'lvl': lvl, 'msg': msg, 'args': args, 'kwargs': kwargs}
-        self.producers['psms'].publish(body=log, routing_key="logs")  
+        self.publish(log, "logs")
+
+
+    def publish(self, body, routing_key):
+        """
+            Publish this body on the psms exchange. A slow message processor
+            calling it is not interrupted in the middle, see 
+            pragmatic_sms.watchdog.
+        """
+        with uninterruptible():
+            self.producers['psms'].publish(body=body, routing_key=routing_key)  